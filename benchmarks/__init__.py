@@ -0,0 +1,11 @@
+"""Benchmark suite for the hot paths of sb4dfritzlib (parsing, statistics,
+login, idle detection, requests against a local stand-in FRITZ!Box).
+
+Run from the repository root:
+
+    python -m benchmarks                    # run all benchmarks
+    python -m benchmarks -filter parsing    # run benchmarks matching a pattern
+    python -m benchmarks -save              # store results as new baseline
+
+Results are compared with the baseline file `benchmarks/baseline.json`
+(if present), so regressions show up as relative changes."""
@@ -0,0 +1,50 @@
+import argparse
+import os
+import re
+import sys
+from .runner import measure, load_baseline, save_baseline, compare, is_regression, format_report
+from .cases import Fixtures, collect
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+if __name__ == "__main__":
+    # define command line options
+    parser = argparse.ArgumentParser(description="Benchmarks for sb4dfritzlib.")
+    parser.add_argument("-filter", default=None, help="Regular expression selecting benchmarks (by name or group).")
+    parser.add_argument("-time", type=float, default=1.0, help="Minimum measuring time per benchmark (in seconds).")
+    parser.add_argument("-trace", default=None, help="Recorded trace file providing payloads.")
+    parser.add_argument("-offline", action="store_true", help="Skip benchmarks against the stand-in server.")
+    parser.add_argument("-baseline", default=BASELINE_FILE, help="Baseline file to compare with.")
+    parser.add_argument("-save", action="store_true", help="Store the results as new baseline.")
+    parser.add_argument("-tolerance", type=float, default=0.15, help="Relative change counted as regression.")
+    parser.add_argument("-check", action="store_true", help="Exit with status 1 on regressions.")
+    args = parser.parse_args()
+
+    fixtures = Fixtures(trace=args.trace, network=not args.offline)
+    try:
+        benchmarks = collect(fixtures)
+        if args.filter:
+            pattern = re.compile(args.filter)
+            benchmarks = [
+                bench for bench in benchmarks
+                if pattern.search(bench.name) or pattern.search(bench.group)
+            ]
+        results = []
+        for bench in benchmarks:
+            results.append(measure(bench, min_time=args.time))
+            print(f"measured {bench.name}", file=sys.stderr)
+    finally:
+        fixtures.close()
+    baseline = load_baseline(args.baseline)
+    print(format_report(results, baseline, args.tolerance))
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f"\nBaseline saved to {args.baseline}")
+    regressions = [
+        result['name'] for result in results
+        if is_regression(compare(result, baseline.get(result['name'])), args.tolerance)
+    ]
+    if args.check and regressions:
+        sys.exit(1)
@@ -0,0 +1,170 @@
+"""Hot paths of sb4dfritzlib measured by the benchmark suite.
+
+All benchmarks run offline: payloads are synthesized by a simulated fleet
+of smart plugs or taken from a recorded trace, and network round trips go
+to a local `StandInServer`."""
+
+import secrets
+from datetime import timedelta
+from sb4dfritzlib.connection import ahahttp, tr064, _login
+from sb4dfritzlib.homeauto.devicemodels import HomeAutoDevice
+from sb4dfritzlib.homeauto.cache import StatsCache
+from sb4dfritzlib.homeauto.watcher import DeviceListWatcher
+from sb4dfritzlib.homeauto.fleet import FleetSimulator
+from sb4dfritzlib.homeauto.simulations import SmartPlugSimulator
+from sb4dfritzlib.homeauto.standin import StandInServer
+from sb4dfritzlib.homeauto.traces import TraceReplay
+from sb4dfritzlib.utilities.clock import VirtualClock
+from sb4dfritzlib.utilities.xml import xml_to_dict
+from sb4dfritzlib.utilities.stats import prepare_stats_dict
+from .runner import Benchmark
+
+
+class Fixtures():
+    """Payloads, simulators and the stand-in server shared by all
+    benchmarks.
+
+    ARGUMENTS:
+    - size : number of simulated plugs in device lists
+    - trace : path of a recorded trace whose payloads are used instead of
+      synthetic ones where available (optional)
+    - network : if False, benchmarks against the stand-in server are skipped
+    """
+
+    def __init__(self, size:int=50, trace:str=None, network:bool=True):
+        self.clock = VirtualClock()
+        self.fleet = FleetSimulator(size, clock=self.clock, seed=0, latency=False)
+        self.ain = self.fleet.session.ains[0]
+        self.devicelist = self.fleet.getdevicelistinfos_raw()
+        self.server = StandInServer(self.fleet, seed=0)
+        self.devicestats = self.server.devicestats_xml(0)
+        # a second device list differing in one power value
+        self.clock.sleep(self.fleet.GRID)
+        self.devicelist_changed = self.fleet.getdevicelistinfos_raw()
+        if trace:
+            self._use_trace(trace)
+        self.network = network
+        if network:
+            self.server.start()
+            self.server.configure_client()
+            self.sid = _login.get_sid(self.server.user, self.server.password, self.server.address)
+
+    def _use_trace(self, path:str):
+        with TraceReplay(path, speed=None) as replay:
+            # NOTE: payloads of the end of the trace
+            replay.clock.sleep(replay.end_time - replay.start_time)
+            if replay.ains:
+                self.ain = replay.ains[0]
+                self.devicestats = replay.getbasicdevicestats_raw(self.ain)
+            try:
+                devicelist = replay.getdevicelistinfos_raw()
+            except KeyError:
+                devicelist = None
+            if devicelist:
+                self.devicelist = devicelist
+                self.devicelist_changed = devicelist.replace(b"<present>1", b"<present>0", 1)
+
+    def close(self)->None:
+        if self.network:
+            self.server.stop()
+
+
+class _PayloadDevice(HomeAutoDevice):
+    """Device answering every request with the same raw statistics."""
+
+    def __init__(self, ain:str, payload:bytes):
+        self.ain = ain
+        self.sid = None
+        self.payload = payload
+
+    def _fetch_raw_basic_device_stats(self)->bytes:
+        return self.payload
+
+
+def collect(fx:Fixtures)->list[Benchmark]:
+    """Returns all benchmarks using the given fixtures."""
+    benchmarks = [
+        # parsing
+        Benchmark("xml_to_dict/devicelist", group="parsing",
+                  func=lambda: xml_to_dict(fx.devicelist.decode())),
+        Benchmark("xml_to_dict/devicestats", group="parsing",
+                  func=lambda: xml_to_dict(fx.devicestats.decode())),
+        Benchmark("parse_devicelistinfos", group="parsing",
+                  func=lambda: ahahttp.parse_devicelistinfos(fx.devicelist)),
+        Benchmark("parse_basicdevicestats", group="parsing",
+                  func=lambda: ahahttp.parse_basicdevicestats(fx.devicestats)),
+        # stats decoding
+        Benchmark("prepare_stats_dict", group="stats", setup=lambda: _prepare_stats(fx)),
+        Benchmark("basic_device_stats/process", group="stats",
+                  func=_PayloadDevice(fx.ain, fx.devicestats)._fetch_basic_device_stats),
+        Benchmark("basic_device_stats/cache_hit", group="stats", setup=lambda: _cache_hit(fx)),
+        Benchmark("watcher/process_changed", group="stats", setup=lambda: _watcher(fx)),
+        # login
+        Benchmark("login/pbkdf2_response", group="login", setup=lambda: _pbkdf2(fx)),
+        Benchmark("login/md5_response", group="login",
+                  func=lambda: _login.calculate_md5_response("1234567z", "secret")),
+        # simulations and idle detection
+        Benchmark("switch_off_when_idle/simulator", group="idle", func=_switch_off_when_idle),
+        Benchmark("fleet/advance_1000_plugs", group="idle", setup=_fleet_advance),
+    ]
+    if fx.network:
+        benchmarks += [
+            Benchmark("standin/login", group="network",
+                      func=lambda: _login.get_sid(
+                          fx.server.user, fx.server.password, fx.server.address)),
+            Benchmark("standin/getdevicelistinfos", group="network",
+                      func=lambda: ahahttp.getdevicelistinfos(fx.sid)),
+            Benchmark("standin/getbasicdevicestats", group="network",
+                      func=lambda: ahahttp.getbasicdevicestats(fx.ain, fx.sid)),
+            Benchmark("standin/tr064_device_info", group="network",
+                      func=lambda: tr064.get_specific_device_info(
+                          fx.server.user, fx.server.password, "127.0.0.1", fx.ain)),
+        ]
+    return benchmarks
+
+
+def _prepare_stats(fx:Fixtures):
+    parsed = ahahttp.parse_basicdevicestats(fx.devicestats)
+    items = [data['stats'] for data in parsed.values() if isinstance(data['stats'], dict)]
+    # NOTE: `prepare_stats_dict` converts in place, so work on copies
+    return lambda: [prepare_stats_dict(dict(item)) for item in items]
+
+
+def _cache_hit(fx:Fixtures):
+    device = _PayloadDevice(fx.ain, fx.devicestats)
+    device.stats_cache = StatsCache()
+    device.stats_cache.put(device._cache_key, device._fetch_basic_device_stats())
+    # NOTE: freeze time just before the entry expires
+    expiry = device.stats_cache.expiry(device._cache_key)
+    device.clock = VirtualClock(expiry - timedelta(seconds=1))
+    return device.get_basic_device_stats
+
+
+def _watcher(fx:Fixtures):
+    watcher = DeviceListWatcher(session=None)
+    payloads = [fx.devicelist, fx.devicelist_changed]
+    state = {'idx': 0}
+    def process():
+        state['idx'] ^= 1
+        return watcher.process(payloads[state['idx']])
+    return process
+
+
+def _pbkdf2(fx:Fixtures):
+    iter1, iter2 = fx.server.iterations
+    challenge = f"2${iter1}${secrets.token_hex(16)}${iter2}${secrets.token_hex(16)}"
+    return lambda: _login.calculate_pbkdf2_response(challenge, "secret")
+
+
+def _switch_off_when_idle():
+    plug = SmartPlugSimulator(clock=VirtualClock(), seed=3)
+    return plug.switch_off_when_idle(debug_mode=True)
+
+
+def _fleet_advance():
+    clock = VirtualClock()
+    fleet = FleetSimulator(1000, clock=clock, seed=0, latency=False)
+    def advance():
+        clock.sleep(fleet.GRID)
+        fleet.advance()
+    return advance
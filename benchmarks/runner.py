@@ -0,0 +1,155 @@
+"""Measures benchmarks and compares the results with a stored baseline."""
+
+import gc
+import json
+import os
+import time
+import tracemalloc
+
+
+class Benchmark():
+    """A named hot path. `func` is called repeatedly without arguments;
+    `setup` (optional) is called once before measuring and may return a
+    function to use instead of `func`."""
+
+    def __init__(self, name:str, func=None, setup=None, group:str="misc"):
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.group = group
+
+    def __repr__(self):
+        return f"Benchmark({self.name!r})"
+
+
+def percentile(values:list[float], q:float)->float:
+    """Returns the `q`-th percentile of sorted values (nearest rank)."""
+    idx = min(int(q / 100 * len(values)), len(values) - 1)
+    return values[idx]
+
+
+def measure(
+        benchmark:Benchmark,
+        min_time:float=1.0,
+        min_calls:int=5,
+        max_calls:int=100000,
+        memory_calls:int=3,
+        )->dict:
+    """Runs a benchmark and returns its results.
+
+    ARGUMENTS:
+    - benchmark : benchmark to run
+    - min_time : minimum measuring time in seconds
+    - min_calls, max_calls : bounds for the number of timed calls
+    - memory_calls : number of calls traced for peak memory
+    """
+    func = benchmark.func
+    if benchmark.setup:
+        func = benchmark.setup() or func
+    # warm up (caches, connections, lazy imports)
+    func()
+    # time single calls
+    durations = []
+    perf_counter = time.perf_counter
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = perf_counter()
+        while len(durations) < max_calls:
+            before = perf_counter()
+            func()
+            after = perf_counter()
+            durations.append(after - before)
+            if len(durations) >= min_calls and after - start >= min_time:
+                break
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    total = sum(durations)
+    durations.sort()
+    # trace memory separately (tracing slows down the calls)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for _ in range(memory_calls):
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'name': benchmark.name,
+        'group': benchmark.group,
+        'calls': len(durations),
+        'ops': len(durations) / total if total > 0 else float("inf"),
+        'p50': percentile(durations, 50),
+        'p99': percentile(durations, 99),
+        'peak_memory': peak,
+    }
+
+
+def load_baseline(path:str)->dict[str,dict]:
+    """Loads stored results by benchmark name (empty if there are none)."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)['results']
+
+
+def save_baseline(path:str, results:list[dict])->None:
+    """Stores results as new baseline, keeping entries of benchmarks that
+    were not run."""
+    baseline = load_baseline(path)
+    baseline.update({result['name']:result for result in results})
+    with open(path, "w") as file:
+        json.dump({'results': baseline}, file, indent=2, sort_keys=True)
+
+
+def compare(result:dict, reference:dict|None)->dict:
+    """Returns the relative changes of a result compared to its baseline
+    entry, e.g. `{'ops': -0.12}` for 12% fewer operations per second."""
+    if not reference:
+        return {}
+    changes = {}
+    for key in ('ops', 'p50', 'p99', 'peak_memory'):
+        if reference.get(key):
+            changes[key] = result[key] / reference[key] - 1
+    return changes
+
+
+def is_regression(changes:dict, tolerance:float)->bool:
+    """True if throughput dropped or latency or memory grew by more than
+    `tolerance` (relative)."""
+    return changes.get('ops', 0) < -tolerance or \
+        changes.get('p50', 0) > tolerance or \
+        changes.get('peak_memory', 0) > tolerance
+
+
+def format_duration(seconds:float)->str:
+    for unit, factor in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= factor:
+            return f"{seconds / factor:7.2f} {unit}"
+    return f"{seconds / 1e-9:7.0f} ns"
+
+
+def format_report(results:list[dict], baseline:dict[str,dict], tolerance:float)->str:
+    """Formats results (and changes against the baseline) as a table."""
+    lines = [
+        f"{'benchmark':<34} {'ops/s':>11} {'p50':>10} {'p99':>10} {'peak mem':>10}  vs. baseline",
+        "-" * 100,
+    ]
+    for result in results:
+        changes = compare(result, baseline.get(result['name']))
+        if not changes:
+            verdict = "(new)"
+        else:
+            verdict = (
+                f"ops {changes.get('ops', 0):+6.1%} | p50 {changes.get('p50', 0):+6.1%}"
+                f" | mem {changes.get('peak_memory', 0):+6.1%}"
+            )
+            if is_regression(changes, tolerance):
+                verdict += "  REGRESSION"
+        lines.append(
+            f"{result['name']:<34} {result['ops']:>11.1f} {format_duration(result['p50']):>10} "
+            f"{format_duration(result['p99']):>10} {result['peak_memory'] / 1024:>7.1f} KiB  {verdict}"
+        )
+    return "\n".join(lines)
@@ -1,7 +1,33 @@
 from sb4dfritzlib.homeauto.simulations import SmartPlugSimulator
-from time import sleep
+from sb4dfritzlib.utilities.clock import SYSTEM_CLOCK, VirtualClock
+from sb4dfritzlib.utilities.tracing import ChromeTraceSink
+import argparse
 
 if __name__ == "__main__":
+    # define command line options
+    parser = argparse.ArgumentParser(
+        description="Demonstration of sb4dfritz using a simulated smart plug."
+    )
+    parser.add_argument(
+        "-virtual", action="store_true", 
+        help="Run on a virtual clock (finishes instantly)."
+    )
+    parser.add_argument(
+        "-seed", type=int, default=None, 
+        help="Seed for reproducible simulations."
+    )
+    parser.add_argument(
+        "-trace", default=None, metavar="FILE",
+        help="Write the phases of each poll to a Chrome trace file."
+    )
+    parser.add_argument(
+        "-profile", action="store_true", 
+        help="Add samples of a sampling profiler to the trace file."
+    )
+    args = parser.parse_args()
+    clock = VirtualClock() if args.virtual else SYSTEM_CLOCK
+    sleep = clock.sleep
+
     hline = "-"*80
     intro_text= """This is a demonstration of sb4dfritz. 
 
@@ -24,7 +50,9 @@ information. In fact, the power consumption is only provided every 10 seconds.
     print(intro_text)
     print(hline)
     sleep(5)
-    smartplug_simulation = SmartPlugSimulator(name="Smart Plug Simulation")
+    smartplug_simulation = SmartPlugSimulator(
+        name="Smart Plug Simulation", clock=clock, seed=args.seed
+    )
     print("\nStarting simulation...\n")
     print(hline)
     sleep(5)
@@ -34,4 +62,9 @@ to be idle to switch it off...
 """)
 
     sleep(2)
-    smartplug_simulation.switch_off_when_idle(status_messages='console')
+    if args.trace:
+        with ChromeTraceSink(args.trace, profile=args.profile):
+            smartplug_simulation.switch_off_when_idle(status_messages='console')
+        print(f"\nTrace written to {args.trace}")
+    else:
+        smartplug_simulation.switch_off_when_idle(status_messages='console')
@@ -4,6 +4,8 @@ Repeatedly checks whether the connected devices are idle and only turns off in
 that case. 
 
 CHANGELOG:
+0.5: power records are streamed to the log file while monitoring (-log)
+0.5: added daemon mode driven by a rules file (-daemon, -state)
 0.4.3: asking for a second device improved
 0.4.2: minor changes required by updates in sb4dfritzlib
 0.4.1: added logging option (-log).
@@ -12,11 +14,12 @@ CHANGELOG:
 0.4: code self-contained (no longer relies on fritzconnection)
 """
 __author__      = "Stefan Behrens"
-__version__     = "0.4.3"
+__version__     = "0.5"
 
 from sb4dfritzlib.homeauto import HomeAutoSystem, HomeAutoDevice
+from sb4dfritzlib.homeauto.daemon import SwitchOffDaemon, read_state
+from sb4dfritzlib.connection.session import FritzBoxSession
 import json
-import os
 import argparse
 
 # load config file
@@ -29,6 +32,8 @@ PWD = CONFIG['login']['pwd']
 IP = CONFIG['login']['ip']
 # width of console interface
 WIDTH = 80
+# log file for power records
+LOG_FILE = "logs/switchoffwhenidle.log"
 
 
 class SwitchOffWhenIdle():
@@ -72,13 +77,11 @@ class SwitchOffWhenIdle():
         # switch off when idle and get power records
         power_records = plug.switch_off_when_idle(
             status_messages='console', 
+            log_file=LOG_FILE if self.logging else None,
             debug_mode=self.debug_mode)
         # print separator
         print("="*self.width)
         print("")
-        # write log if something is weird
-        if self.logging:
-            log_power_records(power_records)
         # ask to run again
         while True:
             user_input = input(
@@ -124,6 +127,28 @@ class SwitchOffWhenIdle():
         return plug
 
 
+def run_daemon(rules_path:str, state_path:str=None)->None:
+    """Run non-interactively: apply the rules in `rules_path` to all 
+    smart plugs until interrupted. With a state file, a restart reuses 
+    the session and the progress of the rules."""
+    state = read_state(state_path) if state_path else None
+    if state:
+        print("Resuming from state file...")
+        session = FritzBoxSession(USER, PWD, IP, sid=state['sid'], ains=state['ains'])
+    else:
+        print("Connecting to FRITZ!Box...")
+        session = FritzBoxSession(USER, PWD, IP)
+    daemon = SwitchOffDaemon(
+        session, rules_path, state_path=state_path, status_messages='console'
+    )
+    print(f"Monitoring {len(session.ains)} devices. Press Ctrl+C to stop.")
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        daemon.save_state()
+        print("")
+
+
 def verify_input(user_input:str,bound:int)->bool:
     """Checks if user_input is an integer between 1 and the given bound."""
     input_ok = False 
@@ -139,32 +164,6 @@ def verify_input(user_input:str,bound:int)->bool:
         print(f"Input invalid. Please enter a number between 1 and {bound}.")
     return input_ok
 
-def log_power_records(power_records:list[dict], log_file:str="logs/switchoffwhenidle.log")->None:
-    """Write list of power records to log file in csv format if the 
-    minimal latency is either negative or over 2 seconds. """
-    # check latencies, only log if minimum is not between 0 and 2 seconds
-    latencies = [record['latency'] for record in power_records]
-    if 0 <= min(latencies) < 2:
-        return
-    # check if log_file exists, if not create it and write header
-    if not os.path.exists(log_file):
-        os.makedirs(os.path.dirname(log_file), exist_ok=True)
-        with open(log_file, "w") as f:
-            f.write("date,starttime,datatime,endtime,duration,latency,power\n")
-    # write records to the log file
-    with open(log_file, "a") as file:
-        for record in power_records:
-            record_str = ",".join([
-                record['starttime'].strftime("%Y-%m-%d,%H:%M:%S.%f")[:-4],
-                record['datatime'].strftime("%H:%M:%S"),
-                record['endtime'].strftime("%H:%M:%S.%f")[:-4],
-                f"{record['duration']:0.2f}",
-                f"{record['latency']:0.2f}",
-                f"{record['power']:0.2f}",
-            ])
-            file.write(record_str + "\n")
-
-
 if __name__ == "__main__":
     # define command line options
     parser = argparse.ArgumentParser(
@@ -175,12 +174,16 @@ if __name__ == "__main__":
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-debug", action="store_true", help="Run in debug mode")
     group.add_argument("-log", action="store_true", help="Write power records to log file.")
+    group.add_argument("-daemon", metavar="RULES", help="Run non-interactively using a rules file.")
+    parser.add_argument("-state", metavar="STATE", help="State file for daemon mode.")
     args = parser.parse_args()
 
     # handle command line options
-    if args.debug:
+    if args.daemon:
+        run_daemon(args.daemon, args.state)
+    elif args.debug:
         SwitchOffWhenIdle(debug_mode=True, logging=True).run()
     elif args.log:
-        SwitchOffWhenIdle(write_log=True).run()
+        SwitchOffWhenIdle(logging=True).run()
     else:
         SwitchOffWhenIdle().run()  # default option
\ No newline at end of file
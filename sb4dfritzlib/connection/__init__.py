@@ -1,10 +1,23 @@
 """Handles communitaction with the FRITZ!Box and connected home
 automation devices."""
 
+# timeouts, deadlines and circuit breakers
+from . import resilience
+from .resilience import FritzBoxError, DeadlineExceeded, BoxUnavailableError, deadline
+
 # TR-064 Interface
 from . import tr064
 
 # AHA-HTTP Interface
 from . import ahahttp
 from . import session
+from . import broker
+
+# routing between AHA-HTTP and TR-064
+from . import router
+from .router import TransportRouter
 from .session import FritzBoxSession
+
+# overlapping login and discovery
+from . import startup
+from .startup import StartupPipeline
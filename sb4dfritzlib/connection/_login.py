@@ -12,6 +12,9 @@ import time
 import urllib.request
 import urllib.parse
 import xml.etree.ElementTree as ET
+from ..utilities import metrics
+from .ahahttp import netloc
+from .resilience import guarded_call, current_deadline, FritzBoxError, DeadlineExceeded
 
 LOGIN_SID_ROUTE = "/login_sid.lua?version=2"
 
@@ -22,6 +25,14 @@ class LoginState:
         self.is_pbkdf2 = challenge.startswith("2$")
 
 
+def urlopen(request, box:str, timeout:float=None):
+    """Opens a URL of the login procedure with a timeout (see
+    `resilience.guarded_call`)."""
+    return guarded_call(
+        box, 'login', lambda seconds: urllib.request.urlopen(request, timeout=seconds), timeout
+    )
+
+
 def check_sid_validity(sid:str|int, address:str="fritz.box")->bool:
     """Check if the given SID is valid.
     
@@ -32,8 +43,8 @@ def check_sid_validity(sid:str|int, address:str="fritz.box")->bool:
     Returns
     - sid_is_valid : Boolean, True if SID is valid, False else
     """
-    url = f"http://{address}/login_sid.lua?version=2&sid={sid}"
-    resp = urllib.request.urlopen(url)
+    url = f"http://{netloc(address)}/login_sid.lua?version=2&sid={sid}"
+    resp = urlopen(url, address)
     root = ET.fromstring(resp.read())
     sid_value = root.find("SID").text
     sid_is_valid = (sid_value != "0000000000000000")
@@ -43,33 +54,70 @@ def check_sid_validity(sid:str|int, address:str="fritz.box")->bool:
 def get_sid(username: str, password: str, address:str="fritz.box") -> str:
     """ Get a sid by solving the PBKDF2 (or MD5) challenge-response
     process. """
-    box_url = "http://" + address
+    box_url = "http://" + netloc(address)
+    state = fetch_login_state(box_url)
+    challenge_response = calculate_response(state, password)
+    wait_for_blocktime(state.blocktime)
+    sid = login_with_response(box_url, username, challenge_response)
+    return sid
+
+
+def fetch_login_state(box_url: str) -> LoginState:
+    """ Like `get_login_state`, but wraps errors other than timeouts and
+    unavailable boxes. """
     try:
-        state = get_login_state(box_url)
+        return get_login_state(box_url)
+    except FritzBoxError:
+        # keep timeouts and unavailable boxes distinguishable
+        raise
     except Exception as ex:
         raise Exception("failed to get challenge") from ex
+
+
+def calculate_response(state: LoginState, password: str) -> str:
+    """ Calculate the response for the challenge of the login state via
+    PBKDF2 (or MD5 if not supported) """
     if state.is_pbkdf2:
         # print("PBKDF2 supported")
-        challenge_response = calculate_pbkdf2_response(state.challenge, password)
-    else:
-        # print("Falling back to MD5")
-        challenge_response = calculate_md5_response(state.challenge, password)
-    if state.blocktime > 0:
-        # print(f"Waiting for {state.blocktime} seconds...")
-        time.sleep(state.blocktime)
+        return calculate_pbkdf2_response(state.challenge, password)
+    # print("Falling back to MD5")
+    return calculate_md5_response(state.challenge, password)
+
+
+def wait_for_blocktime(blocktime: float) -> None:
+    """ Wait for the block time (in seconds) before sending a response """
+    if blocktime > 0:
+        # print(f"Waiting for {blocktime} seconds...")
+        # fail right away if the block time exceeds the current deadline
+        current = current_deadline()
+        if current is not None and time.monotonic() + blocktime > current:
+            raise DeadlineExceeded(f"login blocked for {blocktime} s beyond deadline")
+        time.sleep(blocktime)
+
+
+def login_with_response(box_url: str, username: str, challenge_response: str) -> str:
+    """ Send the response and return the sid. Raises an Exception if the
+    login fails. """
+    address = box_url.split("://", 1)[-1]
     try:
         sid = send_response(box_url, username, challenge_response)
+    except FritzBoxError:
+        raise
     except Exception as ex:
         raise Exception("failed to login") from ex
     if sid == "0000000000000000":
+        if metrics.ENABLED:
+            metrics.LOGINS.inc((address, "failed"))
         raise Exception("wrong username or password")
+    if metrics.ENABLED:
+        metrics.LOGINS.inc((address, "ok"))
     return sid
 
 
 def get_login_state(box_url: str) -> LoginState:
     """ Get login state from FRITZ!Box using login_sid.lua?version=2 """
     url = box_url + LOGIN_SID_ROUTE
-    http_response = urllib.request.urlopen(url)
+    http_response = urlopen(url, box_url.split("://", 1)[-1])
     xml = ET.fromstring(http_response.read())
     # print(f"xml: {xml}")
     challenge = xml.find("Challenge").text
@@ -113,7 +161,7 @@ def send_response(box_url: str, username: str, challenge_response: str)->str:
     url = box_url + LOGIN_SID_ROUTE
     # Send response
     http_request = urllib.request.Request(url, post_data, headers)
-    http_response = urllib.request.urlopen(http_request)
+    http_response = urlopen(http_request, box_url.split("://", 1)[-1])
     # Parse SID from resulting XML.
     xml = ET.fromstring(http_response.read())
     return xml.find("SID").text
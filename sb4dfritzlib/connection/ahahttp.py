@@ -1,7 +1,15 @@
-"""Implements the HTTP interface for FRITZ!Box routers provided by AVM."""
+"""Implements the HTTP interface for FRITZ!Box routers provided by AVM.
+
+All requests take the address of the box as optional argument `box`
+(IP or host name, optionally with port). Without it, they go to the
+default address set by `set_address`."""
 
 import requests
+import time
+import urllib.parse
 from ..utilities.xml import xml_to_dict, pretty_print
+from ..utilities import metrics
+from .resilience import guarded_call
 
 ###  BASIC REQUEST TEMPLATES  ###
 
@@ -9,20 +17,96 @@ URL_BASE = 'http://fritz.box/'
 AHA = 'webservices/homeautoswitch.lua'
 DATA = 'data.lua'
 
-def basic_request(params:dict[str:str])->requests.Response:
-    """Basa HTTP GET request for the AHA-HTTP interface."""
+# sends GET requests: the `requests` module or a pooled `requests.Session`
+HTTP = requests
+
+def set_address(address:str)->None:
+    """Sets the default FRITZ!Box IP or address (optionally with port) of
+    AHA-HTTP requests without `box` argument."""
+    global URL_BASE
+    URL_BASE = f"http://{netloc(address)}/"
+
+
+def split_address(address:str)->tuple[str,int|None]:
+    """Splits an address into host and port (None if not given). IPv6
+    literals may be given with brackets (required with port) or without."""
+    if address.count(":") > 1 and not address.startswith("["):
+        # bare IPv6 literal
+        return address, None
+    url = urllib.parse.urlsplit(f"//{address}")
+    return url.hostname, url.port
+
+
+def netloc(address:str, default_port:int=None)->str:
+    """Returns the address as used in URLs, i.e. with IPv6 literals in
+    brackets, adding `default_port` if the address has no port."""
+    host, port = split_address(address)
+    host = f"[{host}]" if ":" in host else host
+    port = port if port else default_port
+    return f"{host}:{port}" if port else host
+
+
+def default_box()->str:
+    """Returns the address of the box set by `set_address`."""
+    return URL_BASE[len("http://"):-1]
+
+
+def use_connection_pool(enabled:bool=True)->None:
+    """Reuses connections to the box across AHA-HTTP requests (keep-alive)
+    if enabled. Meant for processes sending all requests from one thread,
+    e.g. the gateway (see `homeauto.gateway`)."""
+    global HTTP
+    if enabled and HTTP is requests:
+        HTTP = requests.Session()
+    elif not enabled and HTTP is not requests:
+        HTTP.close()
+        HTTP = requests
+
+
+def basic_request(params:dict[str:str], timeout:float=None, box:str=None, http=None)->requests.Response:
+    """Basa HTTP GET request for the AHA-HTTP interface of `box` (default:
+    see `set_address`), sent with `http` (a `requests.Session`, default:
+    `HTTP`). Fails with `DeadlineExceeded` after `timeout`
+    seconds (default: depending on the command, see
+    `resilience.DEFAULT_TIMEOUTS`) and with `BoxUnavailableError` while
+    the box is unreachable."""
+    command = params.get('switchcmd', "")
     # Parameters for the GET request
     params = [f"{key}={val}" for key, val in params.items()]
     params = "&".join(params)
 
-    request_url = f"{URL_BASE}{AHA}?{params}"
-    response = requests.get(request_url, verify=False)  # Use verify=False if self-signed cert
+    box = box if box else default_box()
+    http = http if http else HTTP
+    request_url = f"http://{netloc(box)}/{AHA}?{params}"
+    def send(seconds):
+        # Use verify=False if self-signed cert
+        return http.get(request_url, verify=False, timeout=seconds)
+    if not metrics.ENABLED:
+        return guarded_call(box, command, send, timeout)
+    # record metrics
+    start = time.perf_counter()
+    try:
+        response = guarded_call(box, command, send, timeout)
+    except Exception:
+        metrics.observe_request("aha", command, box, "error", time.perf_counter() - start)
+        raise
+    metrics.observe_request(
+        "aha", command, box, response.status_code,
+        time.perf_counter() - start, len(response.content)
+    )
     return response
 
 
 ###  SPECIFIC REQUESTS FROM AHA-HTTP DOCUMENTATION  ###
 
-def getdevicelistinfos(sid:str)->str:
+def getdevicelistinfos(sid:str, box:str=None)->str:
+    # get raw XML response and parse it
+    raw = getdevicelistinfos_raw(sid, box)
+    return parse_devicelistinfos(raw)
+
+
+def getdevicelistinfos_raw(sid:str, box:str=None)->bytes:
+    """Returns the unparsed XML response of `getdevicelistinfos` as bytes."""
     # assemble parameter dictionary according to AHA-HTTP documentation
     params = {
         'switchcmd':'getdevicelistinfos', 
@@ -31,15 +115,26 @@ def getdevicelistinfos(sid:str)->str:
     # send basic AHA-HTTP request
     # NOTE: response contains XML string
     # ending with a line break
-    reponse = basic_request(params)
-    # convert into list of strings representing the AINs
-    infos = reponse.text.strip()
+    reponse = basic_request(params, box=box)
+    return reponse.content
+
+
+def parse_devicelistinfos(raw:bytes)->list[dict]:
+    """Converts a raw `getdevicelistinfos` response into a list of 
+    device dictionaries."""
+    start = time.perf_counter() if metrics.ENABLED else None
+    infos = raw.decode("utf-8").strip()
     infos = xml_to_dict(infos)
-    device_infos = infos['device']
+    if start is not None:
+        metrics.PARSE_DURATION.observe(time.perf_counter() - start, ('getdevicelistinfos',))
+    device_infos = infos.get('device', []) if infos else []
+    # a single device is not wrapped in a list by `xml_to_dict`
+    if isinstance(device_infos, dict):
+        device_infos = [device_infos]
     return device_infos
 
 
-def getswitchlist(sid:str)->list[str]:
+def getswitchlist(sid:str, box:str=None)->list[str]:
     """Returns the AINs of connected switches as a list of strings."""
     # assemble parameter dictionary according to AHA-HTTP documentation
     params = {
@@ -49,13 +144,13 @@ def getswitchlist(sid:str)->list[str]:
     # send basic AHA-HTTP request
     # NOTE: response contains AINs of switches as comma separated list
     # ending with a line break
-    reponse = basic_request(params)
+    reponse = basic_request(params, box=box)
     # convert into list of strings representing the AINs
     ains = reponse.text.strip().split(",")
     return ains
 
 
-def getswitchstate(ain:str, sid:str)->int:
+def getswitchstate(ain:str, sid:str, box:str=None)->int:
     """Returns the on/off state of the switch with given AIN as 
     "1" for on, "0" for off, and "inval" for an invalid AIN."""
     # assemble parameter dictionary according to AHA-HTTP documentation
@@ -66,13 +161,13 @@ def getswitchstate(ain:str, sid:str)->int:
     }
     # send basic AHA-HTTP request
     # NOTE: response contains "1\n" for on and "0\n" for off
-    reponse = basic_request(params)
+    reponse = basic_request(params, box=box)
     # extract state and convert to integer
     state = reponse.text.strip()
     return int(state)
 
 
-def setswitch(ain:str, sid:str, state:int=None)->int:
+def setswitch(ain:str, sid:str, state:int=None, box:str=None)->int:
     """Sets the switch state of the switch with given AIN.
     
     Parameters:
@@ -94,13 +189,13 @@ def setswitch(ain:str, sid:str, state:int=None)->int:
     # send basic AHA-HTTP request
     # NOTE: response contains AINs of switches as comma separated list
     # ending with a line break
-    reponse = basic_request(params)
+    reponse = basic_request(params, box=box)
     # convert into list of strings representing the AINs
     state = reponse.text.strip()
     return int(state)
 
 
-def getdeviceinfos(ain:str, sid:str)->dict:
+def getdeviceinfos(ain:str, sid:str, box:str=None)->dict:
     """Get basic device information."""
     # assemble parameter dictionary according to AHA-HTTP documentation
     params = {
@@ -110,15 +205,22 @@ def getdeviceinfos(ain:str, sid:str)->dict:
     }
     # send basic AHA-HTTP request
     # NOTE: response contains XML string
-    reponse = basic_request(params)
+    reponse = basic_request(params, box=box)
     infos = reponse.text.strip()
     infos = xml_to_dict(infos)
     return infos
 
 
-def getbasicdevicestats(ain:str, sid:str)->dict:
+def getbasicdevicestats(ain:str, sid:str, box:str=None)->dict:
     """Get basic statistic (temperature, power, voltage, energy) of
     device."""
+    # get raw XML response and parse it
+    raw = getbasicdevicestats_raw(ain, sid, box)
+    return parse_basicdevicestats(raw)
+
+
+def getbasicdevicestats_raw(ain:str, sid:str, box:str=None)->bytes:
+    """Returns the unparsed XML response of `getbasicdevicestats` as bytes."""
     # assemble parameter dictionary according to AHA-HTTP documentation
     params = {
         'ain':ain,
@@ -127,13 +229,21 @@ def getbasicdevicestats(ain:str, sid:str)->dict:
     }
     # send basic AHA-HTTP request
     # NOTE: response contains XML string
-    reponse = basic_request(params)
-    stats = reponse.text
+    reponse = basic_request(params, box=box)
+    return reponse.content
+
+
+def parse_basicdevicestats(raw:bytes)->dict:
+    """Converts a raw `getbasicdevicestats` response into a dictionary."""
+    start = time.perf_counter() if metrics.ENABLED else None
+    stats = raw.decode("utf-8")
     stats = xml_to_dict(stats)
+    if start is not None:
+        metrics.PARSE_DURATION.observe(time.perf_counter() - start, ('getbasicdevicestats',))
     return stats
 
 
-def getswitchpower(ain:str, sid:str)->float:
+def getswitchpower(ain:str, sid:str, box:str=None)->float:
     """Returns the current power consumption."""
     """Get basic device information."""
     # assemble parameter dictionary according to AHA-HTTP documentation
@@ -144,7 +254,7 @@ def getswitchpower(ain:str, sid:str)->float:
     }
     # send basic AHA-HTTP request
     # NOTE: response contains power consumption in mW
-    reponse = basic_request(params)
+    reponse = basic_request(params, box=box)
     # convert power value to Watt
     power = reponse.text.strip()
     power = float(power) / 1000
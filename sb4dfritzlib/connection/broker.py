@@ -0,0 +1,338 @@
+"""Local SID broker shared by all processes talking to the same FRITZ!Box.
+
+The broker owns the login and renewal for each box and user and hands
+out the current SID over a Unix domain socket, so box logins drop to one
+per SID lifetime however many processes are running. Start it with
+
+    python -m sb4dfritzlib.connection.broker
+
+and create sessions with `FritzBoxSession(..., use_broker=True)`; they
+fall back to a direct login if no broker is running.
+
+Protocol: one JSON object per line in each direction. A request
+`{"box": ..., "user": ..., "password": ..., "invalid": <sid or null>}`
+is answered with `{"sid": ...}` or `{"error": ...}`. Clients report a SID
+they found to be expired as `invalid`; the broker only logs in again if
+it still hands out that SID, so many clients noticing the same expired
+SID cause a single login.
+
+NOTE: the socket is only accessible to the user running the broker, and
+clients only send their password to sockets owned by themselves (in a
+private directory unless `XDG_RUNTIME_DIR` is set). A request with a
+password other than the one of the current SID gets a SID of its own
+login; the broker keeps the login data of the last successful login.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+import time
+from ._login import get_sid, check_sid_validity
+
+
+def default_socket_path()->str:
+    """Returns the default path of the broker socket: in the runtime
+    directory of the user if available, else in a private directory (mode
+    0700) in the temporary directory."""
+    directory = os.environ.get("XDG_RUNTIME_DIR")
+    if not directory:
+        directory = _private_directory(
+            os.path.join(tempfile.gettempdir(), f"sb4dfritz-{os.getuid()}")
+        )
+    return os.path.join(directory, f"sb4dfritz-broker-{os.getuid()}.sock")
+
+
+def _private_directory(path:str)->str:
+    """Creates the directory with mode 0700 if needed. Raises
+    `PermissionError` if it is not owned by the current user or
+    accessible to others."""
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() \
+            or stat.S_IMODE(info.st_mode) & 0o077:
+        raise PermissionError(f"{path} is not a private directory of the current user")
+    return path
+
+
+def check_socket_owner(path:str)->None:
+    """Raises `PermissionError` unless `path` is a socket owned by the
+    current user and only accessible to them (mode 0600), so passwords are
+    never sent to a socket bound by another user."""
+    info = os.lstat(path)
+    if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid() \
+            or stat.S_IMODE(info.st_mode) & 0o077:
+        raise PermissionError(f"{path} is not a private socket of the current user")
+
+
+def _check_peer(sock:socket.socket)->None:
+    """Raises `PermissionError` unless the process at the other end of the
+    connection runs as the current user (where supported)."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    if uid != os.getuid():
+        raise PermissionError("broker runs as another user")
+
+
+class BrokerError(Exception):
+    """The broker answered with an error."""
+
+
+###  BROKER  ###
+
+class _Entry():
+    """SID of one box and user."""
+
+    def __init__(self, box:str, user:str, password:str, sid:str, lock:threading.Lock):
+        self.box = box
+        self.user = user
+        self.password = password
+        self.digest = _digest(password)
+        self.sid = sid
+        # time.monotonic of the last successful validity check or login
+        self.checked = time.monotonic()
+        self.logins = 1
+        # shared by all entries of the same box and user
+        self.lock = lock
+
+
+def _digest(password:str)->bytes:
+    return hashlib.sha256(password.encode()).digest()
+
+
+class SIDBroker():
+    """Logs in to boxes on behalf of clients and keeps their SIDs valid.
+
+    ARGUMENTS:
+    - path : path of the Unix domain socket (default: `default_socket_path()`)
+    - check_interval : SIDs older than this (in seconds) are checked for
+      validity before being handed out
+    - refresh_interval : time between validity checks of all SIDs in
+      seconds, keeping them from expiring (SIDs expire after 20 minutes
+      of inactivity)
+    - login : function called as `login(user, password, box)` (default:
+      `get_sid`)
+    - check : function called as `check(sid, box)` (default:
+      `check_sid_validity`)
+    """
+
+    def __init__(
+            self,
+            path:str=None,
+            check_interval:float=60,
+            refresh_interval:float=15 * 60,
+            login=None,
+            check=None,
+            ):
+        self.path = path if path else default_socket_path()
+        self.check_interval = check_interval
+        self.refresh_interval = refresh_interval
+        self.login = login if login else get_sid
+        self.check = check if check else check_sid_validity
+        # entries by (box, user), only stored after a successful login
+        self.entries:dict[tuple[str,str],_Entry] = {}
+        # locks serializing the logins by (box, user)
+        self._locks:dict[tuple[str,str],threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._server:socketserver.ThreadingUnixStreamServer = None
+        self._stop = threading.Event()
+
+    ###  SIDS  ###
+
+    def sid_for(self, box:str, user:str, password:str, invalid:str=None)->str:
+        """Returns a valid SID for the given box and user, logging in only
+        if there is no valid SID yet."""
+        key = (box, user)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        # NOTE: the lock serializes clients of the same box and user, so
+        # concurrent requests result in a single login
+        with lock:
+            entry = self.entries.get(key)
+            if entry is None or not hmac.compare_digest(entry.digest, _digest(password)):
+                # first request or other password (e.g. changed on the box):
+                # the entry is replaced only if the login succeeds, so a
+                # wrong password does not lock out other clients
+                sid = self.login(user, password, box)
+                with self._lock:
+                    self.entries[key] = _Entry(box, user, password, sid, lock)
+                return sid
+            if entry.sid and invalid == entry.sid:
+                entry.sid = None
+            if entry.sid and time.monotonic() - entry.checked > self.check_interval:
+                if not self.check(entry.sid, box):
+                    entry.sid = None
+                entry.checked = time.monotonic()
+            if not entry.sid:
+                entry.sid = self.login(user, password, box)
+                entry.checked = time.monotonic()
+                entry.logins += 1
+            return entry.sid
+
+    def refresh(self)->None:
+        """Checks all SIDs (which keeps them alive) and renews expired
+        ones."""
+        with self._lock:
+            entries = list(self.entries.values())
+        for entry in entries:
+            try:
+                with entry.lock:
+                    if entry.sid and not self.check(entry.sid, entry.box):
+                        entry.sid = self.login(entry.user, entry.password, entry.box)
+                        entry.logins += 1
+                    entry.checked = time.monotonic()
+            except Exception:
+                # box unreachable: try again on the next request
+                entry.sid = None
+
+    def _refresher(self):
+        while not self._stop.wait(self.refresh_interval):
+            self.refresh()
+
+    ###  SERVER  ###
+
+    def start(self)->"SIDBroker":
+        """Binds the socket and serves clients from daemon threads."""
+        if os.path.exists(self.path):
+            if broker_available(self.path):
+                raise RuntimeError(f"a broker is already running at {self.path}")
+            # remove the socket of a broker that did not shut down
+            os.unlink(self.path)
+        # only the current user may connect
+        old_umask = os.umask(0o177)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(self.path, _BrokerHandler)
+        finally:
+            os.umask(old_umask)
+        self._server.daemon_threads = True
+        self._server.broker = self
+        self._stop.clear()
+        threading.Thread(
+            name="sb4dfritz SID broker", target=self._server.serve_forever, daemon=True
+        ).start()
+        threading.Thread(
+            name="sb4dfritz SID broker refresh", target=self._refresher, daemon=True
+        ).start()
+        return self
+
+    def stop(self)->None:
+        """Stops serving and removes the socket."""
+        self._stop.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def serve_forever(self)->None:
+        """Runs the broker until interrupted."""
+        self.start()
+        try:
+            self._stop.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        broker:SIDBroker = self.server.broker
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                sid = broker.sid_for(
+                    request['box'], request['user'], request['password'], request.get('invalid')
+                )
+                answer = {'sid': sid}
+            except Exception as ex:
+                answer = {'error': f"{type(ex).__name__}: {ex}"}
+            self.wfile.write(json.dumps(answer).encode() + b"\n")
+            self.wfile.flush()
+
+
+###  CLIENT  ###
+
+def request_sid(
+        box:str,
+        user:str,
+        password:str,
+        invalid:str=None,
+        path:str=None,
+        timeout:float=30,
+        )->str:
+    """Gets a SID from the broker at `path`. Raises `OSError` if no broker
+    is running (`PermissionError` if the socket or the broker belongs to
+    another user) and `BrokerError` if the broker failed to log in.
+
+    ARGUMENTS:
+    - box : address of the box
+    - user, password : login data
+    - invalid : SID found to be expired (optional)
+    - path : path of the broker socket (default: `default_socket_path()`)
+    - timeout : maximum time to wait for the SID in seconds
+    """
+    path = path if path else default_socket_path()
+    request = {'box': box, 'user': user, 'password': password, 'invalid': invalid}
+    check_socket_owner(path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        _check_peer(sock)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as file:
+            line = file.readline()
+    if not line:
+        raise BrokerError("broker closed the connection")
+    answer = json.loads(line)
+    if 'error' in answer:
+        raise BrokerError(answer['error'])
+    return answer['sid']
+
+
+def broker_available(path:str=None)->bool:
+    """True if a broker of the current user accepts connections at
+    `path`."""
+    try:
+        path = path if path else default_socket_path()
+        check_socket_owner(path)
+    except OSError:
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(1)
+        try:
+            sock.connect(path)
+            _check_peer(sock)
+        except OSError:
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SID broker for sb4dfritz.")
+    parser.add_argument("-socket", default=None, help="Path of the Unix domain socket.")
+    parser.add_argument("-refresh", type=float, default=15, help="Time between SID checks (in minutes).")
+    args = parser.parse_args()
+    broker = SIDBroker(args.socket, refresh_interval=args.refresh * 60)
+    print(f"SID broker listening on {broker.path}")
+    broker.serve_forever()
@@ -0,0 +1,216 @@
+"""Bounds the time of requests to the FRITZ!Box and fails fast while a box
+is unreachable.
+
+Every request gets a timeout: the one passed to the low-level request
+functions (`ahahttp.basic_request`, `tr064.soap_post`), else a default for
+its command (see `DEFAULT_TIMEOUTS`), shortened to the remaining time of
+an enclosing `deadline` block. The high-level functions take no timeout;
+wrap them in a `deadline` block instead:
+
+    with deadline(3):
+        stats = ahahttp.getbasicdevicestats(ain, sid)
+
+A `CircuitBreaker` per box and interface counts consecutive failures.
+Once open, all requests to the box fail immediately with
+`BoxUnavailableError`. After
+`reset_timeout` seconds a single probe request is let through (half-open);
+it closes the breaker on success and reopens it on failure."""
+
+import requests
+import threading
+import time
+from contextlib import contextmanager
+from ..utilities.quantiles import LATENCIES
+
+
+###  ERRORS  ###
+
+class FritzBoxError(Exception):
+    """Base class of errors raised when talking to a FRITZ!Box."""
+
+
+class DeadlineExceeded(FritzBoxError, TimeoutError):
+    """A request did not finish within its timeout or deadline."""
+
+
+class BoxUnavailableError(FritzBoxError, ConnectionError):
+    """The box cannot be reached (or its circuit breaker is open)."""
+
+
+###  TIMEOUTS AND DEADLINES  ###
+
+# default timeout in seconds for commands without entry in DEFAULT_TIMEOUTS
+DEFAULT_TIMEOUT = 5.0
+# default timeouts by AHA-HTTP switchcmd, TR-064 action or 'login'
+DEFAULT_TIMEOUTS = {
+    'login': 10.0,
+    'getdevicelistinfos': 10.0,
+    'getbasicdevicestats': 5.0,
+    'getdeviceinfos': 5.0,
+    'getswitchstate': 3.0,
+    'getswitchpower': 3.0,
+    'setswitchon': 5.0,
+    'setswitchoff': 5.0,
+    'setswitchtoggle': 5.0,
+    'GetInfo': 10.0,
+    'GetGenericDeviceInfos': 10.0,
+    'GetSpecificDeviceInfos': 10.0,
+    'SetSwitch': 10.0,
+}
+
+_local = threading.local()
+
+
+def current_deadline()->float|None:
+    """Returns the deadline (in terms of `time.monotonic`) of the
+    innermost `deadline` block of the current thread, if any."""
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def deadline(seconds:float):
+    """Limits the total time of all requests within the block. Nested
+    blocks can only shorten the deadline."""
+    previous = current_deadline()
+    new = time.monotonic() + seconds
+    _local.deadline = new if previous is None else min(previous, new)
+    try:
+        yield _local.deadline
+    finally:
+        _local.deadline = previous
+
+
+def request_timeout(command:str, timeout:float=None)->float:
+    """Returns the timeout for a request. Raises `DeadlineExceeded` if the
+    current deadline has passed already."""
+    seconds = timeout
+    if seconds is None:
+        seconds = DEFAULT_TIMEOUTS.get(command, DEFAULT_TIMEOUT)
+    current = current_deadline()
+    if current is not None:
+        remaining = current - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"deadline passed before '{command}'")
+        seconds = min(seconds, remaining)
+    return seconds
+
+
+###  CIRCUIT BREAKER  ###
+
+class CircuitBreaker():
+    """Tracks the health of one box.
+
+    ARGUMENTS:
+    - box : address of the box (for error messages)
+    - failure_threshold : consecutive failures that open the breaker
+    - reset_timeout : seconds until an open breaker lets a probe through
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, box:str, failure_threshold:int=3, reset_timeout:float=10.0):
+        self.box = box
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_request(self)->None:
+        """Raises `BoxUnavailableError` unless a request may be sent."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and \
+                    time.monotonic() - self._opened_at >= self.reset_timeout:
+                # let exactly one probe through
+                self.state = self.HALF_OPEN
+                return
+            retry_in = max(self._opened_at + self.reset_timeout - time.monotonic(), 0)
+        raise BoxUnavailableError(
+            f"{self.box} is unavailable (circuit {self.state}, retry in {retry_in:.1f} s)"
+        )
+
+    def record_success(self)->None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def release(self)->None:
+        """Ends a request that neither succeeded nor failed at the box
+        (e.g. interrupted or failed locally). A half-open breaker lets the
+        next request probe again."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_failure(self)->None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+_breakers:dict[tuple[str,str],CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(box:str, interface:str="aha")->CircuitBreaker:
+    """Returns the circuit breaker of the given box and interface ('aha'
+    for AHA-HTTP and login, 'tr064' for TR-064), created on demand."""
+    key = (box, interface)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(key, CircuitBreaker(f"{box} ({interface})"))
+    return breaker
+
+
+def guarded_call(box:str, command:str, send, timeout:float=None, interface:str="aha"):
+    """Calls `send(timeout)` through the circuit breaker of `box` and
+    `interface` and converts network errors (connection errors and
+    timeouts) into `DeadlineExceeded` or `BoxUnavailableError`. Responses
+    with status 5xx count as failures but are returned as they are. Other
+    exceptions (e.g. invalid URLs, interrupts or bugs of the caller)
+    propagate without affecting the breaker. Durations of successful
+    requests are recorded in `quantiles.LATENCIES`."""
+    seconds = request_timeout(command, timeout)
+    breaker = breaker_for(box, interface)
+    breaker.before_request()
+    start = time.perf_counter()
+    try:
+        response = send(seconds)
+    except TimeoutError as ex:
+        breaker.record_failure()
+        raise DeadlineExceeded(
+            f"'{command}' to {box} timed out after {seconds:.1f} s"
+        ) from ex
+    except OSError as ex:
+        # NOTE: all errors of `requests` are OS errors, but only those of
+        # the connection are failures of the box
+        if isinstance(ex, requests.RequestException) and \
+                not isinstance(ex, (requests.ConnectionError, requests.Timeout)):
+            breaker.release()
+            raise
+        breaker.record_failure()
+        # NOTE: some libraries wrap timeouts into other OS errors
+        if isinstance(getattr(ex, 'reason', None), TimeoutError) or \
+                "Timeout" in type(ex).__name__ or "timed out" in str(ex):
+            raise DeadlineExceeded(
+                f"'{command}' to {box} timed out after {seconds:.1f} s"
+            ) from ex
+        raise BoxUnavailableError(f"'{command}' to {box} failed: {ex}") from ex
+    except BaseException:
+        breaker.release()
+        raise
+    status = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+    if status is not None and status >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+        LATENCIES.observe(box, command, time.perf_counter() - start)
+    return response
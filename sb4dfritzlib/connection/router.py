@@ -0,0 +1,246 @@
+"""Routes device operations to the AHA-HTTP or the TR-064 interface,
+whichever is currently faster and healthy.
+
+Both interfaces can read and switch smart plugs, but behave very
+differently under load. `TransportRouter` keeps rolling statistics
+(exponentially weighted) of latency and error rate for each transport and
+operation, sends each call to the faster healthy transport and fails over
+to the other one if the call fails. Now and then a call is sent to the
+other transport to keep its statistics up to date, so a recovered
+interface is used again:
+
+    router = TransportRouter(session)
+    router.set_switch(ain, False)
+    print(router.stats())
+"""
+
+import threading
+import time
+from . import ahahttp, tr064
+from .resilience import breaker_for, CircuitBreaker
+
+
+AHA = "aha"
+TR064 = "tr064"
+TRANSPORTS = (AHA, TR064)
+
+
+class TransportStats():
+    """Rolling latency and error rate of one transport and operation."""
+
+    __slots__ = ('latency', 'error_rate', 'calls', 'errors')
+
+    def __init__(self):
+        # exponentially weighted means (latency in seconds)
+        self.latency:float = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, seconds:float, failed:bool, weight:float)->None:
+        self.calls += 1
+        self.error_rate += weight * (float(failed) - self.error_rate)
+        if failed:
+            self.errors += 1
+        else:
+            # NOTE: failures are often timeouts, only successful calls
+            # describe the latency of a working transport
+            self.latency = seconds if self.latency is None else \
+                self.latency + weight * (seconds - self.latency)
+
+    def as_dict(self)->dict:
+        return {
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'calls': self.calls,
+            'errors': self.errors,
+        }
+
+
+class TransportRouter():
+    """Implements the operations of `HomeAutoDevice` over both transports.
+
+    ARGUMENTS:
+    - session : `FritzBoxSession` providing login data, address and SID
+    - weight : weight of the latest call in the rolling statistics
+    - max_error_rate : transports with a higher error rate are degraded
+      and only used if no healthy transport is left
+    - explore_every : every n-th call of an operation goes to the
+      transport that is not preferred (0 disables exploration)
+    - failover : if True, failed calls of idempotent operations are
+      retried on the other transport (see `NOT_IDEMPOTENT`)
+    """
+
+    # operations never retried on the other transport: a call may have
+    # reached the box although it failed (e.g. timed out), so a retry of a
+    # toggle would switch the plug back
+    NOT_IDEMPOTENT = frozenset({'toggle_switch'})
+
+    def __init__(
+            self,
+            session,
+            weight:float=0.2,
+            max_error_rate:float=0.5,
+            explore_every:int=20,
+            failover:bool=True,
+            ):
+        self.session = session
+        self.weight = weight
+        self.max_error_rate = max_error_rate
+        self.explore_every = explore_every
+        self.failover = failover
+        # statistics by (transport, operation)
+        self._stats:dict[tuple[str,str],TransportStats] = {
+            (transport, operation):TransportStats()
+            for transport in TRANSPORTS for operation in self.OPERATIONS
+        }
+        self._counts = {operation:0 for operation in self.OPERATIONS}
+        self._lock = threading.Lock()
+
+    ###  ROUTING  ###
+
+    def _breaker(self, transport:str)->CircuitBreaker:
+        # NOTE: the breakers are keyed like in `ahahttp` and `tr064`
+        if transport == AHA:
+            return breaker_for(self.session.ip)
+        return breaker_for(self.session.ip, TR064)
+
+    def is_healthy(self, transport:str, operation:str)->bool:
+        """True unless the transport's circuit breaker is open or its error
+        rate exceeds `max_error_rate`."""
+        if self._breaker(transport).state == CircuitBreaker.OPEN:
+            return False
+        return self._stats[(transport, operation)].error_rate <= self.max_error_rate
+
+    def route(self, operation:str)->list[str]:
+        """Returns the transports in the order they are tried for the next
+        call of `operation`."""
+        def score(transport):
+            stats = self._stats[(transport, operation)]
+            healthy = self.is_healthy(transport, operation)
+            # NOTE: transports without successful calls yet count as fastest,
+            # so both get measured
+            latency = stats.latency if stats.latency is not None else 0.0
+            return (not healthy, latency)
+        order = sorted(TRANSPORTS, key=score)
+        with self._lock:
+            self._counts[operation] += 1
+            explore = self.explore_every and self._counts[operation] % self.explore_every == 0
+        if explore and self._breaker(order[1]).state != CircuitBreaker.OPEN:
+            order.reverse()
+        return order
+
+    def call(self, operation:str, *args):
+        """Runs an operation (see `OPERATIONS`) on the preferred transport,
+        failing over to the other one on errors (idempotent operations
+        only)."""
+        order = self.route(operation)
+        if not self.failover or operation in self.NOT_IDEMPOTENT:
+            order = order[:1]
+        error = None
+        for transport in order:
+            start = time.perf_counter()
+            try:
+                result = self.OPERATIONS[operation][transport](self, *args)
+            except Exception as ex:
+                self._record(transport, operation, time.perf_counter() - start, True)
+                error = ex
+                continue
+            self._record(transport, operation, time.perf_counter() - start, False)
+            return result
+        raise error
+
+    def _record(self, transport:str, operation:str, seconds:float, failed:bool):
+        with self._lock:
+            self._stats[(transport, operation)].record(seconds, failed, self.weight)
+
+    def stats(self)->dict[str,dict[str,dict]]:
+        """Returns the statistics by operation and transport."""
+        with self._lock:
+            return {
+                operation:{
+                    transport:self._stats[(transport, operation)].as_dict()
+                    for transport in TRANSPORTS
+                }
+                for operation in self.OPERATIONS
+            }
+
+    ###  OPERATIONS  ###
+
+    def get_switch_state(self, ain:str)->bool:
+        """Get current switch state (on=True ,off=False)."""
+        return self.call('get_switch_state', ain)
+
+    def set_switch(self, ain:str, state:bool)->bool:
+        """Set switch state (on=True ,off=False)."""
+        return self.call('set_switch', ain, state)
+
+    def toggle_switch(self, ain:str)->bool:
+        """Toggle switch state and return the new state."""
+        return self.call('toggle_switch', ain)
+
+    def get_switch_power(self, ain:str)->float:
+        """Current power consumption in W."""
+        return self.call('get_switch_power', ain)
+
+    def get_present(self, ain:str)->bool:
+        """True if the device is connected to the box."""
+        return self.call('get_present', ain)
+
+    # AHA-HTTP
+
+    def _aha_switch_state(self, ain:str)->bool:
+        return bool(ahahttp.getswitchstate(ain, self.session.sid, self.session.ip))
+
+    def _aha_set_switch(self, ain:str, state:bool)->bool:
+        return bool(ahahttp.setswitch(ain, self.session.sid, int(state), self.session.ip))
+
+    def _aha_toggle_switch(self, ain:str)->bool:
+        return bool(ahahttp.setswitch(ain, self.session.sid, 2, self.session.ip))
+
+    def _aha_switch_power(self, ain:str)->float:
+        return ahahttp.getswitchpower(ain, self.session.sid, self.session.ip)
+
+    def _aha_present(self, ain:str)->bool:
+        infos = ahahttp.getdeviceinfos(ain, self.session.sid, self.session.ip)
+        return bool(int(infos['present']))
+
+    # TR-064
+
+    def _tr064_infos(self, ain:str)->dict[str,str]:
+        session = self.session
+        response = tr064.get_specific_device_info(session.user, session.pwd, session.ip, ain)
+        return tr064.parse_response(response)
+
+    def _tr064_set(self, ain:str, target:str)->None:
+        session = self.session
+        response = tr064.set_switch(session.user, session.pwd, session.ip, ain, target)
+        tr064.parse_response(response)
+
+    def _tr064_switch_state(self, ain:str)->bool:
+        return self._tr064_infos(ain)['NewSwitchState'] == "ON"
+
+    def _tr064_set_switch(self, ain:str, state:bool)->bool:
+        self._tr064_set(ain, "ON" if state else "OFF")
+        return bool(state)
+
+    def _tr064_toggle_switch(self, ain:str)->bool:
+        # NOTE: SetSwitch has no output, the new state needs another request
+        self._tr064_set(ain, "TOGGLE")
+        return self._tr064_switch_state(ain)
+
+    def _tr064_switch_power(self, ain:str)->float:
+        # NOTE: NewMultimeterPower is given in 0.01 W
+        return int(self._tr064_infos(ain)['NewMultimeterPower']) / 100
+
+    def _tr064_present(self, ain:str)->bool:
+        return self._tr064_infos(ain)['NewPresent'] == "CONNECTED"
+
+    # implementations by operation and transport
+    OPERATIONS = {
+        'get_switch_state': {AHA: _aha_switch_state, TR064: _tr064_switch_state},
+        'set_switch': {AHA: _aha_set_switch, TR064: _tr064_set_switch},
+        'toggle_switch': {AHA: _aha_toggle_switch, TR064: _tr064_toggle_switch},
+        'get_switch_power': {AHA: _aha_switch_power, TR064: _tr064_switch_power},
+        'get_present': {AHA: _aha_present, TR064: _tr064_present},
+    }
@@ -1,5 +1,8 @@
 from . import ahahttp
 from ._login import get_sid, check_sid_validity
+from . import broker
+from .startup import StartupPipeline, StartupResult
+from ..utilities import metrics
 
 import threading
 from threading import Thread
@@ -8,13 +11,33 @@ from time import sleep
 
 class FritzBoxSession():
 
-    def __init__(self, user, pwd, ip):
+    def __init__(self, user, pwd, ip, sid:str=None, ains:list[str]=None, use_broker:bool=False, broker_path:str=None,
+                 parallel_startup:bool=False):
+        """Logs in to the FRITZ!Box and discovers all smart home devices.
+        To resume an earlier session, pass its `sid` (only replaced if it
+        has expired) and `ains` (skips the discovery of devices). With
+        `use_broker`, SIDs are obtained from a running SID broker (see
+        `connection.broker`). With `parallel_startup`, independent steps
+        of the login and discovery overlap (see `connection.startup`; the
+        devices are then always listed, cached `ains` are only checked)
+        and `startup` holds the results and timings of all steps."""
         # extract login data
         self.user = user
         self.pwd = pwd
         self.ip = ip
-        # get initial sid
-        self.sid = self.get_sid()
+        self.use_broker = use_broker
+        self.broker_path = broker_path
+        self.startup:StartupResult = None
+        # error of the last failed SID update of the SID manager (if any)
+        self.last_sid_error:Exception = None
+        if parallel_startup:
+            self.startup = self._run_startup(sid, ains)
+            sid = self.startup.sid
+            ains = self.startup.ains
+        # get initial sid (reuse given sid if still valid)
+        self.sid = sid
+        if not parallel_startup:
+            self.update_sid()
         # run daemon thread to keep valid sid
         self.sid_manager = Thread(
             name="sb4dfritz SID manager", 
@@ -23,24 +46,47 @@ class FritzBoxSession():
         )
         self.sid_manager.start()
         # get device info
-        self.ains = self.get_ains()
+        self.ains = list(ains) if ains or self.startup else self.get_ains()
         # self.switches = ahahttp.getswitchlist(self.sid)
 
-    def get_sid(self):
-        """Obtains a valid session id (sid) using the FRITZ!Box
-        login procedure."""
+    def _run_startup(self, sid:str, ains:list[str])->StartupResult:
+        """Logs in and lists the devices with the `StartupPipeline`."""
+        login = None
+        if self.use_broker and broker.broker_available(self.broker_path):
+            login = lambda: self.get_sid(invalid=sid)
+        pipeline = StartupPipeline(self.user, self.pwd, self.ip, sid=sid, ains=ains, login=login)
+        return pipeline.run()
+
+    @property
+    def startup_timings(self)->dict[str,float]:
+        """Durations of the startup phases in seconds (empty without
+        `parallel_startup`)."""
+        return self.startup.timings if self.startup else {}
+
+    def get_sid(self, invalid:str=None):
+        """Obtains a valid session id (sid) from the SID broker or, if no
+        broker is running, using the FRITZ!Box login procedure. Pass an
+        expired sid as `invalid` to have the broker renew it."""
+        if self.use_broker and broker.broker_available(self.broker_path):
+            try:
+                return broker.request_sid(self.ip, self.user, self.pwd, invalid, self.broker_path)
+            except (OSError, broker.BrokerError):
+                # broker went away or failed: fall back to direct login
+                pass
         return get_sid(self.user, self.pwd, self.ip)
     
     def update_sid(self):
         """Checks if the current SID is valid and gets a new one
         if needed."""
         sid = self.sid 
-        all_good = bool(sid) and check_sid_validity(sid)
+        all_good = bool(sid) and check_sid_validity(sid, self.ip)
         if not all_good:
-            new_sid = self.get_sid()
+            if sid and metrics.ENABLED:
+                metrics.RELOGINS.inc((self.ip,))
+            new_sid = self.get_sid(invalid=sid)
             self.sid = new_sid
     
-    def __sid_updater__(self, minutes=15):
+    def __sid_updater__(self, minutes=15, retry_minutes=1):
         """
         Infinite loop that checks the current SID and updates it
         if needed periodically. Note: SIDs expire automatically after
@@ -48,13 +94,22 @@ class FritzBoxSession():
         
         Args:
         - minutes : Time between updates in minutes (default: 15)
+        - retry_minutes : Time until the next attempt after a failed
+          update, e.g. while the box reboots (default: 1)
         """
+        delay = minutes
         while True:
-            sleep(minutes * 60)
-            self.update_sid()
+            sleep(delay * 60)
+            try:
+                self.update_sid()
+                delay = minutes
+            except Exception as ex:
+                # keep the thread alive: the box may be back soon
+                self.last_sid_error = ex
+                delay = min(retry_minutes, minutes)
 
     def get_ains(self):
-        devices = ahahttp.getdevicelistinfos(self.sid)
+        devices = ahahttp.getdevicelistinfos(self.sid, self.ip)
         ains = [dev['identifier'].replace(" ", "") for dev in devices]
         return ains
     
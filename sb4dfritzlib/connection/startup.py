@@ -0,0 +1,221 @@
+"""Overlaps the independent steps of starting a session.
+
+A plain login runs strictly in sequence: fetch the challenge, compute the
+PBKDF2 response, wait for the block time, post the response, then
+discover the devices. The `StartupPipeline` runs the steps that do not
+depend on each other at the same time:
+
+- DNS lookup and the first (keep-alive) connection of the pipeline's
+  own connection pool run while the challenge is fetched and the
+  response is computed
+- the PBKDF2 response is computed in a worker while the block time runs
+- once the SID is available, the device list and TR-064 `GetInfo` are
+  fetched concurrently
+- a cached SID is validated while the device list is already fetched with
+  it (a full login follows only if it has expired), and cached AINs are
+  checked against the device list
+
+Each step is timed:
+
+    result = StartupPipeline("admin", "secret", "fritz.box").run()
+    print(result.report())
+"""
+
+import requests
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from ..utilities import tracing
+from . import ahahttp
+from . import tr064
+from ._login import (
+    check_sid_validity, fetch_login_state, calculate_response,
+    wait_for_blocktime, login_with_response,
+)
+from .resilience import request_timeout
+
+
+class StartupResult():
+    """Outcome of a `StartupPipeline` run."""
+
+    def __init__(self):
+        self.sid:str = None
+        # True if the cached SID was still valid
+        self.sid_reused = False
+        # device dictionaries of `getdevicelistinfos`
+        self.devices:list[dict] = []
+        # AINs of all devices (without spaces)
+        self.ains:list[str] = []
+        # cached AINs no longer in the device list
+        self.stale_ains:list[str] = []
+        # TR-064 `GetInfo` of the smart home service (None if it failed)
+        self.box_info:dict[str,str] = None
+        # errors of optional steps by phase
+        self.errors:dict[str,Exception] = {}
+        # durations of the phases in seconds (in order of completion)
+        self.timings:dict[str,float] = {}
+
+    def report(self)->str:
+        """Returns the timing breakdown as text. Since phases overlap,
+        their sum exceeds the total time."""
+        lines = ["startup phase      time [ms]"]
+        phases = [phase for phase in self.timings if phase != 'total']
+        for phase in phases:
+            lines.append(f"{phase:<16} {1000 * self.timings[phase]:>11.1f}")
+        if 'total' in self.timings:
+            serial = sum(self.timings[phase] for phase in phases)
+            lines.append(f"{'total':<16} {1000 * self.timings['total']:>11.1f}")
+            lines.append(f"{'(sequential)':<16} {1000 * serial:>11.1f}")
+        for phase, error in self.errors.items():
+            lines.append(f"{phase} failed: {error}")
+        return "\n".join(lines)
+
+
+class StartupPipeline():
+    """Logs in to a FRITZ!Box and discovers its devices, overlapping
+    independent steps (see module documentation).
+
+    ARGUMENTS:
+    - user, pwd, ip : login data and address of the box
+    - sid : SID of an earlier session (optional, replaced if expired)
+    - ains : AINs of an earlier session (optional, checked against the
+      device list)
+    - login : function returning a new SID, e.g. from the SID broker
+      (optional, default: login procedure with the response computed in
+      a worker)
+    - box_info : fetch the TR-064 `GetInfo` of the smart home service
+    - pool_connections : send the AHA-HTTP requests of the pipeline over
+      a keep-alive connection opened while logging in (a
+      `requests.Session` of the pipeline, closed after the run; the global
+      `ahahttp.HTTP` is left alone)
+    """
+
+    def __init__(self, user:str, pwd:str, ip:str, sid:str=None, ains:list[str]=None,
+                 login=None, box_info:bool=True, pool_connections:bool=True):
+        self.user = user
+        self.pwd = pwd
+        self.ip = ip
+        self.sid = sid
+        self.ains = list(ains) if ains else None
+        self.login = login
+        self.box_info = box_info
+        self.pool_connections = pool_connections
+        self._http:requests.Session = None
+        self._lock = threading.Lock()
+
+    def run(self)->StartupResult:
+        """Runs all steps and returns their results. Fails like
+        `get_sid` if no valid SID can be obtained and like
+        `ahahttp.getdevicelistinfos` if the devices cannot be listed."""
+        result = StartupResult()
+        start = time.perf_counter()
+        # NOTE: the pool of the pipeline is only used by its own workers
+        self._http = requests.Session() if self.pool_connections else None
+        try:
+            return self._run(result, start)
+        finally:
+            if self._http is not None:
+                self._http.close()
+                self._http = None
+
+    def _run(self, result:StartupResult, start:float)->StartupResult:
+        with ThreadPoolExecutor(max_workers=4, thread_name_prefix="sb4dfritz startup") as pool:
+            warmup = pool.submit(self._warm_up, result)
+            sid = self.sid
+            devices, box_info = None, None
+            if sid:
+                # speculate that the cached SID is still valid
+                validation = pool.submit(
+                    self._timed, result, 'validate_sid', check_sid_validity, sid, self.ip
+                )
+                devices, box_info = self._discover(pool, result, sid)
+                if validation.result():
+                    result.sid_reused = True
+                else:
+                    # discard the device list fetched with the expired SID
+                    # (`GetInfo` does not need the SID and is kept)
+                    wait([devices])
+                    sid = None
+            if not sid:
+                sid = self._login(pool, result)
+                phase = 'devicelist_retry' if devices else 'devicelist'
+                devices, box_info = self._discover(pool, result, sid, box_info, phase)
+            result.sid = sid
+            result.devices = devices.result()
+            if box_info is not None:
+                try:
+                    result.box_info = box_info.result()
+                except Exception as ex:
+                    result.errors['box_info'] = ex
+            warmup.result()
+        result.ains = [dev['identifier'].replace(" ", "") for dev in result.devices]
+        if self.ains:
+            present = set(result.ains)
+            result.stale_ains = [ain for ain in self.ains if ain.replace(" ", "") not in present]
+        result.timings['total'] = time.perf_counter() - start
+        return result
+
+    def _timed(self, result:StartupResult, phase:str, function, *args):
+        """Calls the function and records its duration as phase."""
+        start = time.perf_counter()
+        try:
+            with tracing.span("startup", phase=phase):
+                return function(*args)
+        finally:
+            with self._lock:
+                result.timings[phase] = time.perf_counter() - start
+
+    def _warm_up(self, result:StartupResult)->None:
+        """Resolves the address of the box and opens the first pooled
+        connection. Failures are recorded, not raised: the actual
+        requests will report them."""
+        host, port = ahahttp.split_address(self.ip)
+        try:
+            self._timed(result, 'dns', socket.getaddrinfo, host, port or 80)
+            if self._http is not None:
+                self._timed(result, 'connect', self._connect)
+        except Exception as ex:
+            result.errors['warmup'] = ex
+
+    def _connect(self)->None:
+        # NOTE: the response is read completely, so the connection is
+        # returned to the pool
+        self._http.get(f"http://{ahahttp.netloc(self.ip)}/", verify=False, timeout=request_timeout('warmup'))
+
+    def _login(self, pool:ThreadPoolExecutor, result:StartupResult)->str:
+        """Obtains a new SID. The response is computed in a worker while
+        the block time runs."""
+        if self.login:
+            return self._timed(result, 'login', self.login)
+        box_url = "http://" + self.ip
+        state = self._timed(result, 'challenge', fetch_login_state, box_url)
+        fetched = time.monotonic()
+        phase = 'pbkdf2' if state.is_pbkdf2 else 'md5'
+        response = pool.submit(self._timed, result, phase, calculate_response, state, self.pwd)
+        if state.blocktime > 0:
+            remaining = state.blocktime - (time.monotonic() - fetched)
+            self._timed(result, 'blocktime', wait_for_blocktime, remaining)
+        challenge_response = response.result()
+        return self._timed(
+            result, 'response', login_with_response, box_url, self.user, challenge_response
+        )
+
+    def _discover(self, pool:ThreadPoolExecutor, result:StartupResult, sid:str,
+                  box_info=None, phase:str='devicelist')->tuple:
+        """Starts fetching the device list (timed as `phase`) and the
+        TR-064 `GetInfo` (None if disabled) concurrently. A `GetInfo`
+        already started (`box_info` future) is reused."""
+        devices = pool.submit(self._timed, result, phase, self._get_devices, sid)
+        if self.box_info and box_info is None:
+            box_info = pool.submit(self._timed, result, 'box_info', self._get_box_info)
+        return devices, box_info
+
+    def _get_devices(self, sid:str)->list[dict]:
+        params = {'switchcmd': 'getdevicelistinfos', 'sid': sid}
+        response = ahahttp.basic_request(params, box=self.ip, http=self._http)
+        return ahahttp.parse_devicelistinfos(response.content)
+
+    def _get_box_info(self)->dict[str,str]:
+        response = tr064.get_info(self.user, self.pwd, self.ip)
+        return tr064.parse_response(response)
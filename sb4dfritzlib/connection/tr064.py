@@ -1,12 +1,77 @@
 """Implements the TR-064 API for FRITZ!Box routers provided by AVM."""
 
-import requests, warnings
+import requests, warnings, time
+import xml.etree.ElementTree as ET
 from requests.auth import HTTPDigestAuth
+from ..utilities import metrics
+from .resilience import guarded_call
+from .ahahttp import netloc
+
+# scheme and port of the TR-064 interface of FRITZ!Box routers
+TR064_SCHEME = "https"
+TR064_PORT = 49443
+
+
+def set_port(port:int, scheme:str="https")->None:
+    """Sets port and scheme used by all TR-064 requests."""
+    global TR064_PORT, TR064_SCHEME
+    TR064_PORT = port
+    TR064_SCHEME = scheme
+
+
+def upnp_url(ip:str)->str:
+    """Returns the control URL of the X_AVM-DE_Homeauto service. If `ip`
+    includes a port, it takes precedence over `TR064_PORT` (IPv6 literals
+    with port must be given in brackets)."""
+    host = netloc(ip, default_port=TR064_PORT)
+    return f"{TR064_SCHEME}://{host}/upnp/control/x_homeauto"
+
+
+def soap_post(action:str, ip:str, timeout:float=None, **kwargs)->requests.Response:
+    """Sends a SOAP request via `requests.post` and records metrics. Fails
+    with `DeadlineExceeded` after `timeout` seconds (default: depending on
+    the action) and with `BoxUnavailableError` while the box is
+    unreachable."""
+    def send(seconds):
+        return requests.post(timeout=seconds, **kwargs)
+    if not metrics.ENABLED:
+        return guarded_call(ip, action, send, timeout, interface="tr064")
+    start = time.perf_counter()
+    try:
+        response = guarded_call(ip, action, send, timeout, interface="tr064")
+    except Exception:
+        metrics.observe_request("tr064", action, ip, "error", time.perf_counter() - start)
+        raise
+    metrics.observe_request(
+        "tr064", action, ip, response.status_code,
+        time.perf_counter() - start, len(response.content)
+    )
+    return response
+
+
+class SOAPError(Exception):
+    """The box answered a TR-064 request with a SOAP fault."""
+
+    def __init__(self, code:int, description:str):
+        super().__init__(f"UPnP error {code}: {description}")
+        self.code = code
+        self.description = description
+
+
+def parse_response(response:requests.Response)->dict[str,str]:
+    """Returns the output arguments of a SOAP response (e.g. `NewAIN`) by
+    name. Raises `SOAPError` for SOAP faults."""
+    root = ET.fromstring(response.content)
+    values = {elem.tag.split("}")[-1]:(elem.text or "").strip() for elem in root.iter()}
+    if 'Fault' in values:
+        raise SOAPError(int(values.get('errorCode') or 0), values.get('errorDescription', ""))
+    response.raise_for_status()
+    return values
 
 
 def get_specific_device_info(user:str, pwd:str, ip:str, device_ain:str)->requests.Response:
     """GetSpecificDeviceInfos action for TR-064 interfaces."""
-    UPNP_URL = "https://" + ip + ":49443/upnp/control/x_homeauto"
+    UPNP_URL = upnp_url(ip)
     TR064_SERVICE = "urn:dslforum-org:service:X_AVM-DE_Homeauto:1"
     SOAP_ACTION = "GetSpecificDeviceInfos"
     # header for POST request
@@ -31,7 +96,8 @@ def get_specific_device_info(user:str, pwd:str, ip:str, device_ain:str)->request
     # temporary ignore warnings (caused by self-signed certificate of FRITZ!Box)
     warnings.simplefilter('ignore')
     # send POST request
-    request_result = requests.post(
+    request_result = soap_post(
+        SOAP_ACTION, ip,
         url=UPNP_URL, 
         auth=HTTPDigestAuth(user, pwd), 
         headers=request_headers, 
@@ -45,7 +111,7 @@ def get_specific_device_info(user:str, pwd:str, ip:str, device_ain:str)->request
 
 def set_switch(user:str, pwd:str, ip:str, device_ain:str, target_state:str)->requests.Response:
     """GetSpecificDeviceInfos action for TR-064 interfaces."""
-    UPNP_URL = "https://" + ip + ":49443/upnp/control/x_homeauto"
+    UPNP_URL = upnp_url(ip)
     TR064_SERVICE = "urn:dslforum-org:service:X_AVM-DE_Homeauto:1"
     SOAP_ACTION = "SetSwitch"
 
@@ -76,7 +142,8 @@ def set_switch(user:str, pwd:str, ip:str, device_ain:str, target_state:str)->req
     # temporary ignore warnings (caused by self-signed certificate of FRITZ!Box)
     warnings.simplefilter('ignore')
     # send POST request
-    request_result = requests.post(
+    request_result = soap_post(
+        SOAP_ACTION, ip,
         url=UPNP_URL, 
         auth=HTTPDigestAuth(user, pwd), 
         headers=request_headers, 
@@ -90,7 +157,7 @@ def set_switch(user:str, pwd:str, ip:str, device_ain:str, target_state:str)->req
 
 def get_generic_device_infos(user:str, pwd:str, ip:str, device_index:str)->requests.Response:
     """GetSpecificDeviceInfos action for TR-064 interfaces."""
-    UPNP_URL = "https://" + ip + ":49443/upnp/control/x_homeauto"
+    UPNP_URL = upnp_url(ip)
     TR064_SERVICE = "urn:dslforum-org:service:X_AVM-DE_Homeauto:1"
     SOAP_ACTION = "GetGenericDeviceInfos"
     # header for POST request
@@ -115,7 +182,8 @@ def get_generic_device_infos(user:str, pwd:str, ip:str, device_index:str)->reque
     # temporary ignore warnings (caused by self-signed certificate of FRITZ!Box)
     warnings.simplefilter('ignore')
     # send POST request
-    request_result = requests.post(
+    request_result = soap_post(
+        SOAP_ACTION, ip,
         url=UPNP_URL, 
         auth=HTTPDigestAuth(user, pwd), 
         headers=request_headers, 
@@ -129,7 +197,7 @@ def get_generic_device_infos(user:str, pwd:str, ip:str, device_index:str)->reque
 
 def get_info(user:str, pwd:str, ip:str)->requests.Response:
     """GetInfo action for TR-064 interfaces."""
-    UPNP_URL = "https://" + ip + ":49443/upnp/control/x_homeauto"
+    UPNP_URL = upnp_url(ip)
     TR064_SERVICE = "urn:dslforum-org:service:X_AVM-DE_Homeauto:1"
     SOAP_ACTION = "GetInfo"
     # header for POST request
@@ -153,7 +221,8 @@ def get_info(user:str, pwd:str, ip:str)->requests.Response:
     # temporary ignore warnings (caused by self-signed certificate of FRITZ!Box)
     warnings.simplefilter('ignore')
     # send POST request
-    request_result = requests.post(
+    request_result = soap_post(
+        SOAP_ACTION, ip,
         url=UPNP_URL, 
         auth=HTTPDigestAuth(user, pwd), 
         headers=request_headers, 
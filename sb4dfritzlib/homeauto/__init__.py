@@ -4,4 +4,36 @@ home automation devices within an AVM FRITZ!Box network."""
 from . import devicemodels
 from .devicemodels import HomeAutoSystem, HomeAutoDevice
 
-from . import simulations
\ No newline at end of file
+from . import watcher
+from .watcher import DeviceListWatcher
+
+from . import cache
+from .cache import StatsCache
+
+from . import subscriptions
+from .subscriptions import Subscription
+
+from . import traces
+from .traces import TraceRecorder, TraceReplay, TraceEnded
+
+from . import capabilities
+from .capabilities import CapabilityIndex
+
+from . import polling
+from .polling import AdaptivePollingPolicy, AdaptivePoller
+
+from . import daemon
+from .daemon import SwitchOffDaemon
+from ..utilities.bitmask import Capability
+
+from . import gateway
+from .gateway import Gateway
+
+# NOTE: the simulations depend on NumPy/SciPy and are only loaded when
+# `homeauto.simulations`, `homeauto.fleet`, `homeauto.standin` or
+# `homeauto.sweep` is accessed for the first time
+def __getattr__(name):
+    if name in ("simulations", "fleet", "standin", "sweep"):
+        import importlib
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
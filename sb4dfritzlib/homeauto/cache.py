@@ -0,0 +1,91 @@
+"""Provides a cache for device statistics that respects the measurement
+grids of FRITZ! smart home devices.
+
+Device statistics only change when one of their grids ticks over (every
+10 seconds for power and voltage, every 900 seconds for temperature).
+Within a grid slot, repeated requests return the same data, so they can
+be served from the cache without network I/O."""
+
+import threading
+from datetime import datetime, timedelta
+from ..utilities import metrics
+
+
+def next_grid_tick(stats:dict[str,dict])->datetime|None:
+    """Returns the earliest time at which one of the given processed
+    statistics is expected to change, i.e. the minimum of `datatime + grid`.
+    Returns None if no such time can be determined."""
+    ticks = [
+        item['datatime'] + timedelta(seconds=item['grid'])
+        for item in stats.values()
+        if isinstance(item.get('datatime'), datetime) and item.get('grid')
+    ]
+    return min(ticks) if ticks else None
+
+
+class StatsCache():
+    """Per-device cache for processed device statistics. An entry expires
+    as soon as the next grid slot of any quantity is expected to start.
+    Devices are given by AIN or, if the cache is shared by several boxes,
+    by any other key such as `(box, AIN)`.
+
+    ARGUMENTS:
+    - now : function returning the current time (optional, default:
+      `datetime.now`)
+    """
+
+    def __init__(self, now=datetime.now):
+        self.now = now
+        self._entries:dict[str|tuple,tuple[datetime,dict]] = {}
+        self._lock = threading.Lock()
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ain:str|tuple, now:datetime=None)->dict|None:
+        """Returns the cached statistics of the device with given AIN if
+        they are still valid at time `now` (default: current time), None
+        else."""
+        now = now if now else self.now()
+        with self._lock:
+            entry = self._entries.get(ain)
+            if entry and now < entry[0]:
+                self.hits += 1
+                if metrics.ENABLED:
+                    metrics.CACHE_LOOKUPS.inc(('hit',))
+                return entry[1]
+            self.misses += 1
+            if metrics.ENABLED:
+                metrics.CACHE_LOOKUPS.inc(('miss',))
+            return None
+
+    def put(self, ain:str|tuple, stats:dict[str,dict])->None:
+        """Stores processed statistics of the device with given AIN until
+        the next expected grid tick."""
+        expiry = next_grid_tick(stats)
+        if expiry is None:
+            return
+        with self._lock:
+            self._entries[ain] = (expiry, stats)
+
+    def expiry(self, ain:str|tuple)->datetime|None:
+        """Returns the expiry time of the cached entry for given AIN."""
+        entry = self._entries.get(ain)
+        return entry[0] if entry else None
+
+    def invalidate(self, ain:str|tuple=None)->None:
+        """Removes the entry for given AIN, or all entries if no AIN is
+        given."""
+        with self._lock:
+            if ain is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(ain, None)
+
+    def stats(self)->dict[str,int]:
+        """Returns the hit/miss counters and the number of entries."""
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'entries':len(self._entries),
+        }
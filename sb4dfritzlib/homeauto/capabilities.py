@@ -0,0 +1,88 @@
+"""Indexes devices by their capabilities (decoded function bit masks), so
+queries like "all switchable energy meters" do not scan and decode the
+whole device list."""
+
+import threading
+from ..utilities.bitmask import Capability
+
+
+# single-bit capabilities, each of which is always indexed
+BASIC_CAPABILITIES = [flag for flag in Capability if flag]
+
+
+class CapabilityIndex():
+    """Maps capabilities to the devices providing them.
+
+    Every single capability has its own index. Combinations of
+    capabilities get their own index on first query. All indexes are
+    updated incrementally whenever a device is added, changed or removed,
+    so queries take time proportional to the size of the result.
+    """
+
+    def __init__(self):
+        # AIN -> (device, capabilities)
+        self._devices:dict[str,tuple[object,Capability]] = {}
+        # capabilities -> {AIN: device}
+        self._indexes:dict[Capability,dict[str,object]] = {
+            flag:{} for flag in BASIC_CAPABILITIES
+        }
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, ain:str):
+        return ain.replace(" ", "") in self._devices
+
+    def add(self, ain:str, device, capabilities:Capability)->None:
+        """Adds a device or updates its capabilities."""
+        ain = ain.replace(" ", "")
+        capabilities = Capability(capabilities)
+        with self._lock:
+            self._devices[ain] = (device, capabilities)
+            for flags, index in self._indexes.items():
+                if capabilities & flags == flags:
+                    index[ain] = device
+                else:
+                    index.pop(ain, None)
+
+    # NOTE: updating is the same as adding again
+    update = add
+
+    def remove(self, ain:str)->None:
+        """Removes a device from all indexes."""
+        ain = ain.replace(" ", "")
+        with self._lock:
+            if self._devices.pop(ain, None) is None:
+                return
+            for index in self._indexes.values():
+                index.pop(ain, None)
+
+    def capabilities_of(self, ain:str)->Capability:
+        """Returns the capabilities of the device with given AIN."""
+        entry = self._devices.get(ain.replace(" ", ""))
+        return entry[1] if entry else Capability.NONE
+
+    def devices_with(self, capabilities:Capability)->list:
+        """Returns all devices providing all given capabilities."""
+        capabilities = Capability(capabilities)
+        with self._lock:
+            if not capabilities:
+                return [device for device, _ in self._devices.values()]
+            index = self._indexes.get(capabilities)
+            if index is None:
+                index = self._build_index(capabilities)
+                self._indexes[capabilities] = index
+            return list(index.values())
+
+    def _build_index(self, capabilities:Capability)->dict[str,object]:
+        # start from the smallest index of a single capability involved
+        candidates = [
+            self._indexes[flag] for flag in BASIC_CAPABILITIES if flag in capabilities
+        ]
+        smallest = min(candidates, key=len) if candidates else \
+            {ain:device for ain, (device, _) in self._devices.items()}
+        return {
+            ain:device for ain, device in smallest.items()
+            if self._devices[ain][1] & capabilities == capabilities
+        }
@@ -0,0 +1,309 @@
+"""Switches off smart plugs when their appliances are idle, driven by a
+file of rules instead of console prompts.
+
+All rules are evaluated together on each poll of the device list, so a
+single session and a single `getdevicelistinfos` request per interval
+serve any number of plugs. The rules file is reloaded whenever it
+changes. A small state file (readable by its owner only) keeps the SID,
+the AINs, the progress of all rules and the last power meter readings, so
+a restarted daemon resumes without a full re-login, without rediscovering
+the devices and without counting old measurements again.
+
+The rules file is a JSON file of the form
+
+    {"rules": [
+        {"name": "espresso machine", "ains": ["087610000434"],
+         "power_threshold": 5, "network_threshold": 0.95, "idle_cycles": 2,
+         "window": ["06:00", "23:00"], "debug_mode": false}
+    ]}
+
+where only `name` and `ains` are required (`"ains": "*"` selects all
+devices) and `window` restricts switching off to a daily time window.
+`network_threshold` may also be a quantile of the recent durations of
+device list requests, e.g. `"p90"`.
+"""
+
+import json
+import os
+import threading
+from datetime import datetime, time as daytime
+from ..connection import ahahttp
+from ..utilities.clock import SYSTEM_CLOCK
+from ..utilities.quantiles import resolve_threshold, parse_quantile
+from .watcher import DeviceListWatcher
+from .subscriptions import extract_fields
+
+
+# progress of plugs that have been switched off
+HANDLED = -1
+
+
+class IdleRule():
+    """Rule to switch off plugs once they have been idle for `idle_cycles`
+    consecutive polls (see `HomeAutoDevice.switch_off_when_idle`)."""
+
+    # admissible keys of rules in the rules file
+    KEYS = (
+        'name', 'ains', 'power_threshold', 'network_threshold',
+        'idle_cycles', 'window', 'debug_mode',
+    )
+
+    def __init__(
+            self,
+            name:str,
+            ains:list[str]|str,
+            power_threshold:float=5,
+            network_threshold:float|str=0.95,
+            idle_cycles:int=2,
+            window:tuple[str,str]=None,
+            debug_mode:bool=False,
+            ):
+        self.name = name
+        self.ains = "*" if ains == "*" else [ain.replace(" ", "") for ain in ains]
+        self.power_threshold = power_threshold
+        if isinstance(network_threshold, str):
+            # fail on invalid quantiles when loading the rules
+            parse_quantile(network_threshold)
+        self.network_threshold = network_threshold
+        self.idle_cycles = idle_cycles
+        self.window = tuple(daytime.fromisoformat(val) for val in window) if window else None
+        self.debug_mode = debug_mode
+
+    @classmethod
+    def from_dict(cls, rule:dict)->"IdleRule":
+        unknown = set(rule) - set(cls.KEYS)
+        if unknown:
+            raise ValueError(f"Unknown keys in rule: {', '.join(sorted(unknown))}")
+        return cls(**rule)
+
+    def __repr__(self):
+        return f"IdleRule(name={self.name!r}, ains={self.ains!r})"
+
+    def in_window(self, now:datetime)->bool:
+        """True if switching off is allowed at the given time."""
+        if self.window is None:
+            return True
+        start, end = self.window
+        current = now.time()
+        if start <= end:
+            return start <= current < end
+        # window spans midnight
+        return current >= start or current < end
+
+
+def load_rules(path:str)->list[IdleRule]:
+    """Loads the rules from a JSON rules file."""
+    with open(path, "r") as file:
+        config = json.load(file)
+    return [IdleRule.from_dict(rule) for rule in config['rules']]
+
+
+class SwitchOffDaemon():
+    """Runs idle rules against all devices of a FRITZ!Box.
+
+    ARGUMENTS:
+    - session : object providing a valid SID as attribute `sid`, usually
+      a `FritzBoxSession`
+    - rules_path : path of the JSON rules file
+    - state_path : path of the state file (optional)
+    - interval : time between polls in seconds (default: 10, the power grid)
+    - watcher : `DeviceListWatcher` to poll (optional)
+    - switch_off : function switching off the plug with given AIN
+      (optional, default: `ahahttp.setswitch`)
+    - clock : clock used for timing (optional, e.g. `VirtualClock`)
+    - status_messages : target for status message output
+    """
+
+    def __init__(
+            self,
+            session,
+            rules_path:str,
+            state_path:str=None,
+            interval:float=10,
+            watcher:DeviceListWatcher=None,
+            switch_off=None,
+            clock=None,
+            status_messages:str=None,
+            ):
+        self.session = session
+        # address of the box (None for simulated sessions)
+        self.box = getattr(session, 'ip', None)
+        self.rules_path = rules_path
+        self.state_path = state_path
+        self.interval = interval
+        self.watcher = watcher if watcher else DeviceListWatcher(session)
+        self.switch_off = switch_off if switch_off else \
+            lambda ain: ahahttp.setswitch(ain, self.session.sid, 0, self.box)
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.status_messages = status_messages
+        self.rules:list[IdleRule] = []
+        self._rules_mtime = None
+        # progress by rule name and AIN: number of consecutive idle polls
+        # with new measurements
+        self.idle_polls:dict[str,dict[str,int]] = {}
+        # last power meter reading by AIN: (power, energy, voltage)
+        self._readings:dict[str,tuple] = {}
+        self.last_error:Exception = None
+        self._saved_state = None
+        self._stop = threading.Event()
+        self.load_state()
+        self.reload_rules()
+
+    def status_update(self, *args):
+        # available targets and their output functions
+        OUTPUT_TARGETS = {
+            'console' : print,
+        }
+        if self.status_messages in OUTPUT_TARGETS:
+            OUTPUT_TARGETS[self.status_messages](*args)
+
+    ###  RULES AND STATE  ###
+
+    def reload_rules(self, force:bool=False)->bool:
+        """Reloads the rules file if it changed since the last load.
+        Progress of rules that are kept (by name) is preserved."""
+        mtime = os.stat(self.rules_path).st_mtime_ns
+        if mtime == self._rules_mtime and not force:
+            return False
+        self.rules = load_rules(self.rules_path)
+        self._rules_mtime = mtime
+        names = {rule.name for rule in self.rules}
+        self.idle_polls = {
+            name:progress for name, progress in self.idle_polls.items() if name in names
+        }
+        self.status_update(f"Loaded {len(self.rules)} rules from {self.rules_path}.")
+        return True
+
+    def state(self)->dict:
+        """Returns the state that is kept in the state file."""
+        return {
+            'sid': self.session.sid,
+            'ains': list(self.session.ains),
+            'idle_polls': self.idle_polls,
+            'readings': self._readings,
+        }
+
+    def save_state(self)->None:
+        """Writes the state file (only if the state changed)."""
+        if not self.state_path:
+            return
+        state = json.dumps(self.state(), indent=2)
+        if state == self._saved_state:
+            return
+        # NOTE: write to a temporary file first, so a crash never leaves a
+        # truncated state file behind; only the owner may read the SID
+        temp_path = self.state_path + ".tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # NOTE: the mode only applies to new files
+        os.fchmod(fd, 0o600)
+        with open(fd, "w") as file:
+            file.write(state)
+        os.replace(temp_path, self.state_path)
+        self._saved_state = state
+
+    def load_state(self)->None:
+        """Restores the progress of all rules and the last readings of the
+        plugs from the state file."""
+        state = read_state(self.state_path) if self.state_path else None
+        if state:
+            self.idle_polls = state.get('idle_polls', {})
+            # NOTE: JSON turns the tuples into lists
+            self._readings = {
+                ain:tuple(reading) for ain, reading in state.get('readings', {}).items()
+            }
+
+    ###  MAIN LOOP  ###
+
+    def run(self)->None:
+        """Polls and applies the rules until `stop` is called."""
+        self._stop.clear()
+        while not self._stop.is_set():
+            try:
+                self.reload_rules()
+                self.tick()
+                self.save_state()
+            except Exception as ex:
+                self.last_error = ex
+                self.status_update(f"Error: {ex!r}")
+            self.clock.sleep(self.interval)
+
+    def stop(self)->None:
+        """Stops the main loop after the current poll."""
+        self._stop.set()
+
+    def tick(self)->list[tuple[str,str]]:
+        """Polls the device list once, applies all rules and returns the
+        `(rule name, AIN)` pairs of plugs that were switched off."""
+        start = self.clock.now()
+        self.watcher.poll()
+        duration = (self.clock.now() - start).total_seconds()
+        fresh = self._fresh_readings()
+        switched_off = []
+        for rule in self.rules:
+            progress = self.idle_polls.setdefault(rule.name, {})
+            for ain in self._ains_of(rule):
+                if self._apply(rule, ain, progress, duration, ain in fresh):
+                    switched_off.append((rule.name, ain))
+        return switched_off
+
+    def _fresh_readings(self)->set[str]:
+        """Returns the AINs of plugs whose power meter reading changed
+        since the last poll, i.e. that took a new measurement."""
+        # NOTE: the voltage changes with almost every measurement, so
+        # plugs with constant power are recognized as well
+        fresh = set()
+        for ain, (device, flat) in self.watcher.snapshot.items():
+            reading = tuple(extract_fields(flat, ('power', 'energy', 'voltage')).values())
+            if self._readings.get(ain) != reading:
+                self._readings[ain] = reading
+                fresh.add(ain)
+        return fresh
+
+    def _ains_of(self, rule:IdleRule)->list[str]:
+        if rule.ains == "*":
+            return list(self.watcher.snapshot)
+        return [ain for ain in rule.ains if ain in self.watcher.snapshot]
+
+    def _apply(self, rule:IdleRule, ain:str, progress:dict[str,int], duration:float, fresh:bool=True)->bool:
+        """Updates the progress of a rule for one plug and switches the
+        plug off if it has been idle long enough. Polls without a new
+        measurement of the plug (`fresh` is False) do not count."""
+        device, flat = self.watcher.snapshot[ain]
+        values = extract_fields(flat, ('state', 'present', 'power'))
+        # only plugs that are switched on are monitored
+        if not values['state'] or not values['present'] or values['power'] is None:
+            progress.pop(ain, None)
+            return False
+        if not fresh:
+            return False
+        network_threshold = resolve_threshold(
+            rule.network_threshold, self.box if self.box else ahahttp.default_box(),
+            'getdevicelistinfos', fallback=0.95
+        )
+        is_idle = values['power'] < rule.power_threshold and duration < network_threshold
+        count = progress.get(ain, 0)
+        # NOTE: -1 marks plugs already handled (in debug mode, they stay
+        # on), they are monitored again once they are busy
+        if count == HANDLED:
+            progress[ain] = HANDLED if is_idle else 0
+            return False
+        progress[ain] = count + 1 if is_idle else 0
+        if progress[ain] < rule.idle_cycles or not rule.in_window(self.clock.now()):
+            return False
+        self.status_update(
+            f'Rule "{rule.name}": "{device.get("name", ain)}" is idle. Switching off...'
+        )
+        if not rule.debug_mode:
+            self.switch_off(ain)
+        progress[ain] = HANDLED
+        return True
+
+
+def read_state(path:str)->dict|None:
+    """Reads a state file of `SwitchOffDaemon`. Returns None if it does
+    not exist or cannot be read."""
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
@@ -3,32 +3,85 @@ home automation devices"""
 
 from ..connection.session import FritzBoxSession
 from ..connection import ahahttp 
+from ..connection.router import TransportRouter
 from ..utilities import bitmask, xml, is_stats_dict, prepare_stats_dict
+from ..utilities.clock import SYSTEM_CLOCK
+from ..utilities.powerlog import PowerLogWriter
+from ..utilities import tracing
+from ..utilities.quantiles import resolve_threshold
+from .watcher import DeviceListWatcher, DeviceEvent, DeviceAdded, DeviceRemoved, DeviceChanged
+from .cache import StatsCache
+from .subscriptions import Subscription, PollingEngine
+from .capabilities import CapabilityIndex
+from .polling import AdaptivePollingPolicy
 from datetime import datetime, timedelta
+import asyncio
+import time
+
+
+def process_basic_device_stats(raw:bytes)->dict:
+    """Parses a raw `getbasicdevicestats` response into the statistics
+    returned by `HomeAutoDevice.get_basic_device_stats`."""
+    stats_raw = ahahttp.parse_basicdevicestats(raw)
+    # process statistics
+    stats_processed = {}
+    for quantity, data in stats_raw.items():
+        stats = data['stats']
+        if is_stats_dict(stats):
+            stats = prepare_stats_dict(stats)
+            stats_processed[quantity] = stats
+        elif type(stats) == list:
+            for idx, item in enumerate(stats):
+                if is_stats_dict(item):
+                    item = prepare_stats_dict(item)
+                    stats_processed[f"{quantity}_{idx+1}"] = item
+    return stats_processed
 
 
 #TODO: add alternative initialization within `HomeAutoSystem`
 #TODO: add stats monitor
 class HomeAutoDevice():
 
-    def __init__(self, ain:str, sid:str):
+    # cache for device statistics shared by all devices (keyed by box and AIN)
+    stats_cache:StatsCache = StatsCache()
+    # clock used for timing (replace by a `VirtualClock` for simulations)
+    clock = SYSTEM_CLOCK
+    # records raw responses if set (see `traces.TraceRecorder`)
+    trace_recorder = None
+    # decoded function bit mask
+    capabilities:bitmask.Capability = bitmask.Capability.NONE
+    # routes switch operations via AHA-HTTP or TR-064 if set
+    transport_router:TransportRouter = None
+    # adaptive polling policy informed about idle jobs (optional)
+    polling_policy:AdaptivePollingPolicy = None
+    # address of the box (None: default address, see `ahahttp.set_address`)
+    box:str = None
+
+    def __init__(self, ain:str, sid:str, clock=None, infos:dict=None, box:str=None):
+        """Pass the `infos` of the device if already known (e.g. from
+        `getdevicelistinfos`) to skip the `getdeviceinfos` request, and
+        the address of the box it is connected to as `box`."""
         self.sid = sid
         self.ain = ain
+        if box:
+            self.box = box
+        if clock:
+            self.clock = clock
         self.switch_mode = None
-        self._info_on_init = self._get_info()
+        self._info_on_init = self._get_info(infos)
     
     def __str__(self):
         return f"{self.name} ({self.model})"
     
-    def _get_info(self):
-        infos = ahahttp.getdeviceinfos(self.ain, self.sid)
+    def _get_info(self, infos:dict=None):
+        if infos is None:
+            infos = ahahttp.getdeviceinfos(self.ain, self.sid, self.box)
         self.name = infos['name']
         self.model = f"{infos['manufacturer']} {infos['productname']}"
         self.device_id = infos['id']
         self.present = bool(int(infos['present']))
-        functionbitmask = int(infos['functionbitmask'])
-        functionbitmask = bitmask.decode(functionbitmask)
-        self.is_switchable = functionbitmask[15]
+        self.capabilities = bitmask.capabilities(infos['functionbitmask'])
+        self.is_switchable = bitmask.Capability.SWITCHABLE in self.capabilities
         if self.is_switchable: 
             self.switch_mode = infos['switch']['mode']
         return infos
@@ -36,21 +89,27 @@ class HomeAutoDevice():
     def get_switch_state(self)->bool:
         """Get current switch state (on=True ,off=False)."""
         if self.is_switchable:
-            state = ahahttp.getswitchstate(self.ain, self.sid)
+            if self.transport_router:
+                return self.transport_router.get_switch_state(self.ain)
+            state = ahahttp.getswitchstate(self.ain, self.sid, self.box)
             return bool(state)
 
 
     def set_switch(self, state:bool)->bool:
         """Set switch state if switchable (on=True ,off=False)."""
         if self.is_switchable:
-            new_state = ahahttp.setswitch(self.ain, self.sid, int(state))
+            if self.transport_router:
+                return self.transport_router.set_switch(self.ain, state)
+            new_state = ahahttp.setswitch(self.ain, self.sid, int(state), self.box)
             return bool(new_state)
         
     def toggle_switch(self)->bool:
         """Toggle switch state if switchable."""
         if self.is_switchable:
-            response = ahahttp.setswitch(self.ain, self.sid, 2)
-            state = int(response.text.strip())
+            if self.transport_router:
+                return self.transport_router.toggle_switch(self.ain)
+            # NOTE: `setswitch` returns the new state as integer
+            state = ahahttp.setswitch(self.ain, self.sid, 2, self.box)
             return bool(state)
     
     #TODO: add logging feature
@@ -59,7 +118,7 @@ class HomeAutoDevice():
     def switch_off_when_idle(
             self, 
             power_threshold:float=5,
-            network_threshold:float=0.95,
+            network_threshold:float|str=0.95,
             idle_cycles:int=2,
             status_messages:str=None,
             log_file:str=None,
@@ -75,10 +134,13 @@ class HomeAutoDevice():
         
         ARGUMENTS:
         - power_threshold : power consumption in idle state (in Watts)
-        - network_threshold : tolerated request duration (in seconds)
+        - network_threshold : tolerated request duration (in seconds), or
+          a quantile of the recent request durations, e.g. "p90" (0.95 s
+          until enough requests have been recorded)
         - idle_cycles : number of idle measurement cycles required
         - status_messages : target for status message output
-        - log_file : path of log file
+        - log_file : path of log file (CSV, or binary for `.pwr` files) or
+          a `PowerLogWriter`
         - debug_mode : if True, the switch state is not changed
         """
         # width for console output
@@ -95,9 +157,11 @@ class HomeAutoDevice():
                 updater = OUTPUT_TARGETS[output_target]
                 # run it on text
                 updater(*args)
-        # TODO add logging feature
-        def log_data(data, log_file=log_file):
-            pass
+        # stream power records to the log file (if any)
+        log_writer = None
+        def log_data(data):
+            if log_writer:
+                log_writer.write(data)
 
         # start main routine
         status_update(f'Switching off "{self.name}" when idle...\n')
@@ -110,68 +174,141 @@ class HomeAutoDevice():
         status_update("Monitoring power consumption..." + "\n" + "-" * WIDTH)
         # get initial power measurement (and wake up device)
         power_monitor = [self.get_latest_power_record()]
-        while switch_is_on:
-            # get the latest power measurement
-            data = self.get_latest_power_record()
-            # add to power_monitor if 'datatime' jumps
-            if data['datatime'] != power_monitor[-1]['datatime']:
-                power_monitor.append(data)
-                log_data(data)
-                status_update(
-                    "Request Duration: {:5.2f} s | Power: {:7.2f} W | Latency: {:5.2f} s".format(
-                        data['duration'], 
-                        data['power'], 
-                        data['latency'], 
-                    )
-                )
-            # check the last measurements for idle status
-            # NOTE: the very first measurement might be unreliable
-            if len(power_monitor) > idle_cycles:
-                last_measurements = power_monitor[-idle_cycles:]
-                last_power_vals = [data['power'] for data in last_measurements]
-                last_durations = [data['duration'] for data in last_measurements]
-                last_latencies = [data['latency'] for data in last_measurements]
-                appliances_are_idle = \
-                    max(last_power_vals) < power_threshold and \
-                    max(last_durations) < network_threshold
-                if appliances_are_idle:
-                    status_update(
-                        "-" * WIDTH + "\n" + "Idle state detected. Switching off..."
-                    )
-                    if debug_mode:
-                        switch_is_on = False
+        if isinstance(log_file, PowerLogWriter):
+            log_writer = log_file
+        elif log_file:
+            log_writer = PowerLogWriter(log_file)
+        # poll this device at the fastest rate while monitoring it
+        # NOTE: the readings below are reported to the policy, so its
+        # poller does not poll the device a second time
+        if self.polling_policy:
+            self.polling_policy.watch(self.ain)
+        try:
+            while switch_is_on:
+                with tracing.span("poll", ain=self.ain) as poll_span:
+                    # get the latest power measurement
+                    data = self.get_latest_power_record()
+                    # add to power_monitor if 'datatime' jumps
+                    if data['datatime'] != power_monitor[-1]['datatime']:
+                        power_monitor.append(data)
+                        log_data(data)
+                        if self.polling_policy:
+                            self.polling_policy.observe(
+                                self.ain, {'power': data['power'], 'state': True}
+                            )
+                        poll_span.set(power=data['power'], duration=data['duration'])
+                        status_update(
+                            "Request Duration: {:5.2f} s | Power: {:7.2f} W | Latency: {:5.2f} s".format(
+                                data['duration'], 
+                                data['power'], 
+                                data['latency'], 
+                            )
+                        )
                     else:
-                        switch_is_on = self.set_switch(False)
+                        # no new data in this grid slot
+                        with tracing.span("wait"):
+                            self._wait_for_next_grid_tick()
+                    # check the last measurements for idle status
+                    # NOTE: the very first measurement might be unreliable
+                    with tracing.span("detector"):
+                        appliances_are_idle = False
+                        if len(power_monitor) > idle_cycles:
+                            last_measurements = power_monitor[-idle_cycles:]
+                            last_power_vals = [data['power'] for data in last_measurements]
+                            last_durations = [data['duration'] for data in last_measurements]
+                            last_latencies = [data['latency'] for data in last_measurements]
+                            appliances_are_idle = \
+                                max(last_power_vals) < power_threshold and \
+                                max(last_durations) < self._duration_threshold(network_threshold)
+                    if appliances_are_idle:
+                        status_update(
+                            "-" * WIDTH + "\n" + "Idle state detected. Switching off..."
+                        )
+                        with tracing.span("switch", debug_mode=debug_mode):
+                            if debug_mode:
+                                switch_is_on = False
+                            else:
+                                switch_is_on = self.set_switch(False)
+        finally:
+            if self.polling_policy:
+                self.polling_policy.unwatch(self.ain)
+            # NOTE: writers passed in by the caller are left open
+            if log_writer and log_writer is not log_file:
+                log_writer.close()
         # return power records for logging (discard first record)
         return power_monitor[1:]
     
-    def get_basic_device_stats(self):
+    def get_basic_device_stats(self, use_cache:bool=True):
         """Get statisticts (temperature, energy, power, ...) recorded 
-        by device."""
+        by device. 
+        
+        Within a measurement grid slot, the statistics are served from
+        `stats_cache` without network I/O. Set `use_cache=False` to 
+        force a request. The result is a copy, changing it does not
+        affect the cache."""
+        # serve from cache if the current grid slot has been fetched before
+        if use_cache:
+            stats_cached = self.stats_cache.get(self._cache_key, now=self.clock.now())
+            if stats_cached is not None:
+                return self._copy_stats(stats_cached)
+        stats_processed = self._fetch_basic_device_stats()
+        # remember until the next grid tick
+        self.stats_cache.put(self._cache_key, stats_processed)
+        return self._copy_stats(stats_processed)
+
+    @staticmethod
+    def _copy_stats(stats:dict)->dict:
+        """Copies statistics including their data lists, which would
+        otherwise be shared with `stats_cache`."""
+        return {
+            key:{name:list(val) if isinstance(val, list) else val for name, val in item.items()}
+            for key, item in stats.items()
+        }
+
+    def _fetch_basic_device_stats(self)->dict:
+        """Requests and processes the device statistics."""
         # get statistics via AHA-HTTP interface for processing
-        stats_raw = ahahttp.getbasicdevicestats(self.ain, self.sid)
-        # process statistics
-        stats_processed = {}
-        for quantity, data in stats_raw.items():
-            stats = data['stats']
-            if is_stats_dict(stats):
-                stats = prepare_stats_dict(stats)
-                stats_processed[quantity] = stats
-            elif type(stats) == list:
-                for idx, item in enumerate(stats):
-                    if is_stats_dict(item):
-                        item = prepare_stats_dict(item)
-                        stats_processed[f"{quantity}_{idx+1}"] = item
-        return stats_processed
-
-    def get_power_measurements(self):
-        stats = self.get_basic_device_stats()
+        with tracing.span("http", command="getbasicdevicestats"):
+            raw = self._fetch_raw_basic_device_stats()
+        if self.trace_recorder:
+            self.trace_recorder.record_basic_device_stats(self.ain, raw)
+        with tracing.span("decode", size=len(raw)):
+            return process_basic_device_stats(raw)
+
+    def _fetch_raw_basic_device_stats(self)->bytes:
+        """Requests the unparsed device statistics."""
+        return ahahttp.getbasicdevicestats_raw(self.ain, self.sid, self.box)
+
+    def _duration_threshold(self, network_threshold:float|str)->float:
+        """Resolves a `network_threshold` given as quantile (e.g. "p90") of
+        the recent durations of `getbasicdevicestats` requests."""
+        box = self.box if self.box else ahahttp.default_box()
+        return resolve_threshold(network_threshold, box, 'getbasicdevicestats', fallback=0.95)
+
+    @property
+    def _cache_key(self)->tuple[str,str]:
+        """Key of the device in `stats_cache` (shared by the devices of
+        all boxes in the process)."""
+        return (self.box, self.ain)
+
+    def _wait_for_next_grid_tick(self)->None:
+        """Waits until the cached statistics of this device expire, so
+        polling loops do not spin on cache hits."""
+        expiry = self.stats_cache.expiry(self._cache_key)
+        if expiry is None:
+            return
+        delay = (expiry - self.clock.now()).total_seconds()
+        if delay > 0:
+            self.clock.sleep(delay)
+
+    def get_power_measurements(self, use_cache:bool=True):
+        stats = self.get_basic_device_stats(use_cache)
         return stats['power']
 
     def get_latest_power_record(self):
-        start = datetime.now()
+        start = self.clock.now()
         power_stats = self.get_power_measurements()
-        end = datetime.now()
+        end = self.clock.now()
         datatime:datetime = power_stats['datatime']
         duration = (end - start).total_seconds()
         latency = (end - datatime).total_seconds()
@@ -192,12 +329,121 @@ class HomeAutoDevice():
 #TODO: improve initialization (takes too long)
 class HomeAutoSystem():
 
-    def __init__(self, user, pwd, ip):
-        self.session = FritzBoxSession(user, pwd, ip)
+    # polling interval of the shared subscription engine in seconds
+    polling_interval:float = 10
+
+    def __init__(self, user, pwd, ip, parallel_startup:bool=False):
+        """Logs in and creates all devices. With `parallel_startup`, see
+        `FritzBoxSession`, the devices are created from the device list
+        without further requests (timed as phase 'devices')."""
+        self.session = FritzBoxSession(user, pwd, ip, parallel_startup=parallel_startup)
         self.devices = self.get_devices()
+        self._polling_engine:PollingEngine = None
+        self._capability_index:CapabilityIndex = None
     
     def get_devices(self):
-        sid = self.session.sid
         ains = self.session.ains
-        devices = [HomeAutoDevice(ain, sid) for ain in ains]
+        startup = self.session.startup
+        if startup is None:
+            devices = [self._new_device(ain) for ain in ains]
+            return devices
+        # reuse the device list fetched at startup
+        start = time.perf_counter()
+        infos = {dev['identifier'].replace(" ", ""):dev for dev in startup.devices}
+        devices = [self._new_device(ain, infos.get(ain)) for ain in ains]
+        startup.timings['devices'] = time.perf_counter() - start
         return devices
+
+    def _new_device(self, ain:str, infos:dict=None)->HomeAutoDevice:
+        device = HomeAutoDevice(ain, self.session.sid, infos=infos, box=self.session.ip)
+        router = getattr(self, 'transport_router', None)
+        if router:
+            device.transport_router = router
+        return device
+
+    def enable_transport_routing(self, **kwargs)->TransportRouter:
+        """Routes the switch operations of all devices to the faster
+        healthy interface (AHA-HTTP or TR-064). Keyword arguments are
+        passed to `TransportRouter`."""
+        self.transport_router = TransportRouter(self.session, **kwargs)
+        for device in self.devices:
+            device.transport_router = self.transport_router
+        return self.transport_router
+
+    def get_device_watcher(self, power_threshold:float=5)->DeviceListWatcher:
+        """Returns a watcher emitting events on changes of the device list.
+        Its events keep the capability index up to date."""
+        watcher = DeviceListWatcher(self.session, power_threshold=power_threshold)
+        watcher.subscribe(self._update_capability_index)
+        return watcher
+
+    @property
+    def polling_engine(self)->PollingEngine:
+        """The polling engine shared by all subscriptions (created lazily)."""
+        if getattr(self, '_polling_engine', None) is None:
+            self._polling_engine = PollingEngine(self.session, self.polling_interval)
+            self._polling_engine.watcher.subscribe(self._update_capability_index)
+        return self._polling_engine
+
+    @property
+    def capability_index(self)->CapabilityIndex:
+        """Index of all devices by capability (created lazily)."""
+        if getattr(self, '_capability_index', None) is None:
+            index = CapabilityIndex()
+            for device in self.devices:
+                index.add(device.ain, device, device.capabilities)
+            self._capability_index = index
+        return self._capability_index
+
+    def devices_with(self, capabilities:bitmask.Capability)->list[HomeAutoDevice]:
+        """Returns all devices providing all given capabilities, e.g.
+        `devices_with(Capability.SWITCHABLE | Capability.ENERGY)`."""
+        return self.capability_index.devices_with(capabilities)
+
+    def _update_capability_index(self, event:DeviceEvent)->None:
+        """Keeps devices and capability index in line with the events of
+        device list watchers."""
+        index = getattr(self, '_capability_index', None)
+        if index is None:
+            return
+        if isinstance(event, DeviceAdded) and event.ain not in index:
+            # NOTE: the event holds the infos of the device list already
+            device = self._new_device(event.ain, event.device)
+            self.devices.append(device)
+            index.add(device.ain, device, device.capabilities)
+        elif isinstance(event, DeviceRemoved) and event.ain in index:
+            index.remove(event.ain)
+            self.devices = [
+                device for device in self.devices
+                if device.ain.replace(" ", "") != event.ain
+            ]
+        elif isinstance(event, DeviceChanged) and 'functionbitmask' in event.changes:
+            for device in self.devices:
+                if device.ain.replace(" ", "") == event.ain:
+                    device.capabilities = bitmask.capabilities(event.device['functionbitmask'])
+                    index.update(device.ain, device, device.capabilities)
+
+    def subscribe(self, ain:str|None, fields:tuple[str], callback)->Subscription:
+        """Calls `callback(ain, values)` whenever one of the given fields
+        (see `subscriptions.FIELDS`) of the device with given AIN changes.
+        Use `ain=None` to subscribe to all devices."""
+        subscription = Subscription(ain, fields, callback)
+        return self.polling_engine.add(subscription)
+
+    def unsubscribe(self, subscription:Subscription)->None:
+        """Cancels a subscription."""
+        self.polling_engine.remove(subscription)
+
+    async def updates(self, ain:str|None, fields:tuple[str]):
+        """Asynchronous iterator over `(ain, values)` tuples whenever one
+        of the given fields of the device with given AIN changes."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        def callback(ain, values):
+            loop.call_soon_threadsafe(queue.put_nowait, (ain, values))
+        subscription = self.subscribe(ain, fields, callback)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.unsubscribe(subscription)
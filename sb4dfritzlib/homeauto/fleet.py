@@ -0,0 +1,215 @@
+"""Simulates large fleets of smart plugs for load testing.
+
+The state of all plugs lives in shared NumPy arrays and all plugs advance
+together in vectorized steps. `FleetSimulator` and
+`FleetPlugSimulator` provide the interfaces of `HomeAutoSystem` and
+`HomeAutoDevice`, so idle detection, caches, watchers and subscriptions
+can be run against thousands of virtual plugs."""
+
+import random
+import threading
+import numpy as np
+from datetime import datetime, timedelta
+from .devicemodels import HomeAutoDevice, HomeAutoSystem
+from .simulations import (
+    APPLIANCE_PROFILES, LatencySampler, MarkovPowerGenerator, add_network_latency,
+    generate_fake_sid, generate_fake_ain,
+)
+from ..utilities.clock import SYSTEM_CLOCK
+from ..utilities.bitmask import FRITZ_DECT_200
+
+
+class SimulatedSession():
+    """Stands in for `FritzBoxSession` within simulations."""
+
+    def __init__(self, sid:str, ains:list[str]):
+        self.sid = sid
+        self.ains = ains
+
+
+class FleetPlugSimulator(HomeAutoDevice):
+    """A single plug of a `FleetSimulator`. All state is kept by the fleet."""
+
+    def __init__(self, fleet:"FleetSimulator", index:int):
+        self.fleet = fleet
+        self.index = index
+        self.clock = fleet.clock
+        self.sid = fleet.session.sid
+        self.ain = fleet.session.ains[index]
+        self.name = f"Simulated {fleet.profiles[index].title()} {index + 1}"
+        self.model = "Smart Plug Simulator"
+        self.device_id = index + 1
+        self.capabilities = FRITZ_DECT_200
+        self.is_switchable = True
+        self.switch_mode = "manuell"
+
+    @property
+    def present(self)->bool:
+        return bool(self.fleet.present[self.index])
+
+    def get_switch_state(self)->bool:
+        """Get current switch state (on=True ,off=False)."""
+        return bool(self.fleet.switch_states[self.index])
+
+    def set_switch(self, state:bool)->bool:
+        """Set switch state (on=True ,off=False)."""
+        self.fleet.switch_states[self.index] = bool(state)
+        return bool(state)
+
+    def toggle_switch(self)->bool:
+        """Toggle switch state."""
+        return self.set_switch(not self.get_switch_state())
+
+    def _fetch_basic_device_stats(self)->dict:
+        if self.fleet.latency:
+            add_network_latency(
+                one_way=False, clock=self.clock, sampler=self.fleet.latency_sampler
+            )
+        return self.fleet.send_basic_device_stats(self.index)
+
+
+class FleetSimulator(HomeAutoSystem):
+    """Simulates a home automation system with many smart plugs.
+
+    ARGUMENTS:
+    - size : number of simulated plugs
+    - profiles : names of appliance profiles to choose from (see
+      `simulations.APPLIANCE_PROFILES`, default: all)
+    - clock : clock driving the simulation (optional, e.g. `VirtualClock`)
+    - seed : seed for reproducible simulations (optional)
+    - latency : if True, requests are delayed by simulated network latency
+    """
+
+    # measurement grid of power values as in FRITZ! smart plugs
+    COUNT = 360
+    GRID = 10
+
+    def __init__(self, size:int=1000, profiles:list[str]=None, clock=None,
+                 seed=None, latency:bool=True):
+        self.size = size
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.rng = np.random.default_rng(seed)
+        self.latency_sampler = LatencySampler(seed=self.random.getrandbits(32))
+        self._lock = threading.Lock()
+        # assign appliance profiles to plugs
+        names = list(profiles) if profiles else list(APPLIANCE_PROFILES)
+        self.profiles = self.rng.choice(names, size=size)
+        self.power_generator = self._init_power_generator()
+        # plug states
+        self.switch_states = np.ones(size, dtype=bool)
+        self.present = np.ones(size, dtype=bool)
+        self.energy = np.zeros(size)        # Wh
+        # power values (unit 0.01 W) in a ring buffer shared by all plugs
+        self.power = np.zeros((size, self.COUNT), dtype=np.int64)
+        self._head = 0
+        self._ticks = 0
+        # NOTE: whole seconds, so the reported datatime is the exact tick
+        self.base_time = self.clock.now().replace(microsecond=0) \
+            - timedelta(seconds=self.COUNT * self.GRID)
+        self.advance()
+        # interfaces of `HomeAutoSystem`
+        sid = generate_fake_sid(self.random)
+        ains = [generate_fake_ain(self.random).replace(" ", "") for _ in range(size)]
+        self.session = SimulatedSession(sid, ains)
+        self.index_by_ain = {ain:idx for idx, ain in enumerate(ains)}
+        self.devices = self.get_devices()
+        self._polling_engine = None
+
+    def _init_power_generator(self)->MarkovPowerGenerator:
+        """Creates one generator for all plugs from the state tables of
+        their appliance profiles."""
+        simulators = {name:APPLIANCE_PROFILES[name]() for name in np.unique(self.profiles)}
+        simulators = [simulators[name] for name in self.profiles]
+        return MarkovPowerGenerator.from_simulators(simulators, seed=self.rng)
+
+    def get_devices(self)->list[FleetPlugSimulator]:
+        return [FleetPlugSimulator(self, idx) for idx in range(self.size)]
+
+    def _step(self, n:int=1):
+        """Advances all plugs by `n` measurement cycles."""
+        power = self.power_generator.generate(n)
+        power = np.where(self.switch_states, power, 0)
+        columns = (self._head + np.arange(n)) % self.COUNT
+        self.power[:, columns] = power.T
+        self._head = (self._head + n) % self.COUNT
+        self.energy += power.sum(axis=0) / 100 * self.GRID / 3600
+
+    def advance(self)->None:
+        """Advances the simulation to the current time of the clock."""
+        with self._lock:
+            elapsed = (self.clock.now() - self.base_time).total_seconds()
+            ticks_due = int(elapsed // self.GRID)
+            missed = ticks_due - self._ticks
+            # NOTE: older values would be overwritten anyway
+            if missed > 0:
+                self._step(min(missed, self.COUNT))
+            self._ticks = max(ticks_due, self._ticks)
+
+    def datatime(self, index:int)->datetime:
+        """Returns the time of the latest measurement of the plug."""
+        # NOTE: all plugs measure at the same ticks, so `datatime + grid`
+        # is when new data exists (as expected by caches and idle loops)
+        tick_time = self.base_time + timedelta(seconds=self._ticks * self.GRID)
+        return tick_time
+
+    def latest_power(self)->np.ndarray:
+        """Returns the latest power values of all plugs (unit 0.01 W)."""
+        return self.power[:, (self._head - 1) % self.COUNT]
+
+    def send_basic_device_stats(self, index:int)->dict:
+        """Returns the device stats of a plug in the format of
+        `HomeAutoDevice.get_basic_device_stats`."""
+        self.advance()
+        order = (self._head - 1 - np.arange(self.COUNT)) % self.COUNT
+        datatime = self.datatime(index)
+        def stats(count, grid, data):
+            return {'count':count, 'grid':grid, 'datatime':datatime, 'data':data}
+        return {
+            'temperature': stats(96, 900, [0] * 96),
+            'voltage': stats(self.COUNT, self.GRID, [0] * self.COUNT),
+            'power': stats(self.COUNT, self.GRID, self.power[index, order].tolist()),
+            'energy': stats(12, 2678400, [int(self.energy[index])] + [0] * 11),
+        }
+
+    def device_xml(self, index:int, power:int=None)->str:
+        """Returns the XML element describing a plug as in the responses of
+        `getdevicelistinfos` and `getdeviceinfos`."""
+        ain = self.session.ains[index]
+        if power is None:
+            power = int(self.latest_power()[index]) * 10    # 0.01 W -> mW
+        return (
+            f'<device identifier="{ain[:5]} {ain[5:]}" id="{index + 1}" '
+            f'functionbitmask="35712" fwversion="04.25" manufacturer="AVM" '
+            f'productname="FRITZ!DECT 200">'
+            f'<present>{int(self.present[index])}</present>'
+            f'<txbusy>0</txbusy>'
+            f'<name>{self.devices[index].name}</name>'
+            f'<switch><state>{int(self.switch_states[index])}</state>'
+            f'<mode>manuell</mode><lock>0</lock><devicelock>0</devicelock></switch>'
+            f'<powermeter><voltage>230000</voltage><power>{power}</power>'
+            f'<energy>{int(self.energy[index])}</energy></powermeter>'
+            f'</device>'
+        )
+
+    def getdevicelistinfos_raw(self, sid:str=None)->bytes:
+        """Returns the device list in the XML format of `getdevicelistinfos`.
+        Can be used as `fetch_raw` of a `DeviceListWatcher`."""
+        self.advance()
+        power = self.latest_power() * 10     # 0.01 W -> mW
+        devices = [self.device_xml(idx, power[idx]) for idx in range(self.size)]
+        xml = '<devicelist version="1">' + "".join(devices) + '</devicelist>\n'
+        return xml.encode("utf-8")
+
+    def get_device_watcher(self, power_threshold:float=5):
+        watcher = super().get_device_watcher(power_threshold)
+        watcher.fetch_raw = self.getdevicelistinfos_raw
+        return watcher
+
+    @property
+    def polling_engine(self):
+        if self._polling_engine is None:
+            engine = super().polling_engine
+            engine.watcher.fetch_raw = self.getdevicelistinfos_raw
+        return self._polling_engine
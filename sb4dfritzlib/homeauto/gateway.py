@@ -0,0 +1,577 @@
+"""Local caching gateway that fans one connection to the FRITZ!Box out to
+many clients.
+
+The gateway holds the only SID and connection pool to the box. A single
+worker thread sends all requests to the box in the order of a priority
+queue (switch commands first, then device statistics, then polls of the
+device list), and identical pending requests are merged. Clients are
+served from caches, so the load on the box does not grow with the number
+of clients:
+
+- the device list is polled every `interval` seconds (one
+  `getdevicelistinfos` request for all devices)
+- device statistics are fetched at most once per measurement grid slot
+  (see `StatsCache`)
+
+HTTP/JSON API:
+
+    GET  /devices                 all devices with their current values
+    GET  /devices/<ain>           one device
+    GET  /devices/<ain>/stats     device statistics
+    POST /devices/<ain>/switch    body {"state": true|false|"toggle"}
+    GET  /ws                      WebSocket push channel
+
+The WebSocket channel sends a message `{"type": "snapshot", "devices":
+[...]}` on connect, followed by `{"type": "update", "device": {...}}` and
+`{"type": "removed", "ain": ...}` on changes of the device list.
+
+Requests from web pages of other sites are rejected (`Origin` header not
+local), and POST bodies must be sent as `application/json`. If a `token`
+is set, requests must present it as `Authorization: Bearer <token>` (or
+as query parameter `?token=<token>`, e.g. for WebSocket clients in
+browsers).
+
+Start the gateway with
+
+    python -m sb4dfritzlib.homeauto.gateway -config sb4dfritz_secrets.ini
+
+where the config file (despite its extension, as in the scripts of this
+repository) contains JSON of the form
+`{"login": {"user": ..., "pwd": ..., "ip": ...}}`.
+"""
+
+import argparse
+import base64
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import queue
+import select
+import struct
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ..connection import ahahttp
+from ..connection.resilience import FritzBoxError
+from .watcher import DeviceListWatcher, DeviceAdded, DeviceRemoved, DeviceChanged
+from .subscriptions import FIELDS, extract_fields
+from .cache import StatsCache
+from .devicemodels import process_basic_device_stats
+
+
+# priorities of requests to the box (lower values first)
+SWITCH = 0
+STATS = 1
+POLL = 2
+
+
+###  REQUEST QUEUE  ###
+
+class _Job():
+    """Pending request to the box."""
+
+    def __init__(self, func, args:tuple, key=None):
+        self.func = func
+        self.args = args
+        self.key = key
+        self.done = threading.Event()
+        self.result = None
+        self.error:Exception = None
+
+    def wait(self, timeout:float=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError("request to the box is still queued")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class RequestQueue():
+    """Sends all requests to the box from one worker thread in the order of
+    their priority (FIFO within a priority). Requests submitted with the
+    same `key` while one is pending share its result."""
+
+    def __init__(self):
+        self._heap:list[tuple[int,int,_Job]] = []
+        self._pending:dict = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stop = False
+        # counters
+        self.sent = 0
+        self.merged = 0
+        self._thread = threading.Thread(
+            name="sb4dfritz gateway requests", target=self._run, daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, priority:int, func, *args, key=None)->_Job:
+        """Queues `func(*args)` and returns the job (see `_Job.wait`)."""
+        with self._condition:
+            if key is not None and key in self._pending:
+                self.merged += 1
+                return self._pending[key]
+            job = _Job(func, args, key)
+            if key is not None:
+                self._pending[key] = job
+            heapq.heappush(self._heap, (priority, next(self._counter), job))
+            self._condition.notify()
+        return job
+
+    def call(self, priority:int, func, *args, key=None, timeout:float=None):
+        """Queues `func(*args)` and waits for its result."""
+        return self.submit(priority, func, *args, key=key).wait(timeout)
+
+    def stop(self)->None:
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap and not self._stop:
+                    self._condition.wait()
+                if self._stop:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+            try:
+                job.result = job.func(*job.args)
+            except Exception as ex:
+                job.error = ex
+            with self._condition:
+                if job.key is not None:
+                    self._pending.pop(job.key, None)
+                self.sent += 1
+            job.done.set()
+
+
+###  GATEWAY  ###
+
+class Gateway():
+    """Serves the devices of one FRITZ!Box to local clients.
+
+    ARGUMENTS:
+    - session : `FritzBoxSession` (the only session talking to the box)
+    - host, port : address of the HTTP server (default: 127.0.0.1:8765)
+    - interval : time between polls of the device list in seconds
+    - timeout : maximum time clients wait for a queued request in seconds
+    - stats_cache : cache for device statistics (optional)
+    - min_refresh : minimum time between two fetches of the statistics of
+      a device in seconds (guards against stale data whose next grid tick
+      has already passed)
+    - pool_connections : if True, connections to the box are kept alive
+    - token : secret clients must present (optional, see module
+      documentation)
+    """
+
+    def __init__(
+            self,
+            session,
+            host:str="127.0.0.1",
+            port:int=8765,
+            interval:float=10,
+            timeout:float=30,
+            stats_cache:StatsCache=None,
+            min_refresh:float=2,
+            pool_connections:bool=True,
+            token:str=None,
+            ):
+        self.session = session
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.timeout = timeout
+        self.stats_cache = stats_cache if stats_cache else StatsCache()
+        self.min_refresh = min_refresh
+        # latest fetched statistics by AIN: (time.monotonic, stats)
+        self._fetched:dict[str,tuple[float,dict]] = {}
+        self.pool_connections = pool_connections
+        self.token = token
+        self.watcher = DeviceListWatcher(session)
+        self.watcher.subscribe(self._on_event)
+        self.requests:RequestQueue = None
+        self.last_error:Exception = None
+        # message queues of connected WebSocket clients
+        self._clients:set[queue.Queue] = set()
+        self._clients_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._httpd:ThreadingHTTPServer = None
+
+    @property
+    def address(self)->str:
+        return f"{self.host}:{self.port}"
+
+    def start(self)->"Gateway":
+        """Polls the device list once and starts serving clients."""
+        if self.pool_connections:
+            ahahttp.use_connection_pool()
+        self.requests = RequestQueue()
+        self.poll()
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _GatewayHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.gateway = self
+        # NOTE: port 0 picks a free port
+        self.port = self._httpd.server_address[1]
+        self._stop.clear()
+        threading.Thread(
+            name="sb4dfritz gateway server", target=self._httpd.serve_forever, daemon=True
+        ).start()
+        threading.Thread(
+            name="sb4dfritz gateway polling", target=self._poll_loop, daemon=True
+        ).start()
+        return self
+
+    def stop(self)->None:
+        self._stop.set()
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+        with self._clients_lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.put_nowait(None)
+            except queue.Full:
+                pass
+        if self.requests:
+            self.requests.stop()
+        if self.pool_connections:
+            ahahttp.use_connection_pool(False)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def serve_forever(self)->None:
+        """Runs the gateway until interrupted."""
+        self.start()
+        try:
+            self._stop.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    ###  BOX  ###
+
+    def poll(self, wait:bool=True)->None:
+        """Polls the device list (merged with a pending poll)."""
+        job = self.requests.submit(POLL, self.watcher.poll, key="poll")
+        if wait:
+            job.wait(self.timeout)
+
+    def _poll_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as ex:
+                self.last_error = ex
+
+    def device(self, ain:str)->dict|None:
+        """Returns name and current values of a device from the cached
+        device list."""
+        entry = self.watcher.snapshot.get(ain)
+        if entry is None:
+            return None
+        device, flat = entry
+        values = extract_fields(flat, tuple(FIELDS))
+        return {'ain': ain, 'name': device.get('name'), **values}
+
+    def devices(self)->list[dict]:
+        return [self.device(ain) for ain in list(self.watcher.snapshot)]
+
+    def stats(self, ain:str)->dict:
+        """Returns the device statistics, fetched at most once per grid
+        slot."""
+        stats = self._cached_stats(ain)
+        if stats is None:
+            stats = self.requests.call(
+                STATS, self._fetch_stats, ain, key=("stats", ain), timeout=self.timeout
+            )
+        return stats
+
+    def _cached_stats(self, ain:str)->dict|None:
+        stats = self.stats_cache.get(ain)
+        if stats is None and ain in self._fetched:
+            fetched, latest = self._fetched[ain]
+            if time.monotonic() - fetched < self.min_refresh:
+                stats = latest
+        return stats
+
+    def _fetch_stats(self, ain:str)->dict:
+        # NOTE: a client may have fetched the statistics while queued
+        stats = self._cached_stats(ain)
+        if stats is None:
+            raw = ahahttp.getbasicdevicestats_raw(ain, self.session.sid, self.session.ip)
+            stats = process_basic_device_stats(raw)
+            self.stats_cache.put(ain, stats)
+            self._fetched[ain] = (time.monotonic(), stats)
+        return stats
+
+    def switch(self, ain:str, state:bool|str)->bool:
+        """Switches a plug on (True), off (False) or toggles it ("toggle")
+        ahead of all other requests. Returns the new state."""
+        value = 2 if state == "toggle" else int(bool(state))
+        new_state = self.requests.call(
+            SWITCH, ahahttp.setswitch, ain, self.session.sid, value, self.session.ip,
+            timeout=self.timeout
+        )
+        # push the new state to clients right away
+        self.poll(wait=False)
+        return bool(new_state)
+
+    ###  PUSH  ###
+
+    def _on_event(self, event):
+        if isinstance(event, DeviceRemoved):
+            self.broadcast({'type': 'removed', 'ain': event.ain})
+        elif isinstance(event, (DeviceAdded, DeviceChanged)):
+            self.broadcast({'type': 'update', 'device': self.device(event.ain)})
+
+    def broadcast(self, message:dict)->None:
+        """Sends a message to all WebSocket clients. Clients that do not
+        keep up are disconnected."""
+        text = to_json(message)
+        with self._clients_lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.put_nowait(text)
+            except queue.Full:
+                self._remove_client(client)
+                with client.mutex:
+                    client.queue.clear()
+                client.put_nowait(None)
+
+    def _add_client(self)->queue.Queue:
+        client = queue.Queue(maxsize=1000)
+        with self._clients_lock:
+            self._clients.add(client)
+        return client
+
+    def _remove_client(self, client:queue.Queue)->None:
+        with self._clients_lock:
+            self._clients.discard(client)
+
+
+def to_json(obj)->str:
+    """Serializes to JSON (datetimes in ISO format)."""
+    return json.dumps(obj, default=lambda val: val.isoformat() if isinstance(val, datetime) else str(val))
+
+
+###  HTTP AND WEBSOCKET  ###
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+# largest accepted request body and incoming WebSocket frame in bytes
+MAX_BODY_SIZE = 64 * 1024
+# hosts of origins allowed to use the gateway from a browser
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+class _GatewayHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    server_version = "sb4dfritz-gateway"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status:int, obj)->None:
+        body = to_json(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self)->tuple[str|None,str]:
+        """Returns AIN (if any) and the action of the request path."""
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if parts == ["devices"]:
+            return None, "devices"
+        if len(parts) == 2 and parts[0] == "devices":
+            return parts[1], "device"
+        if len(parts) == 3 and parts[0] == "devices":
+            return parts[1], parts[2]
+        if parts == ["ws"]:
+            return None, "ws"
+        return None, ""
+
+    def _authorized(self, gateway:Gateway)->bool:
+        """Checks origin and token of the request. Sends an error and
+        returns False if the request is rejected."""
+        origin = self.headers.get("Origin")
+        if origin is not None:
+            host = urllib.parse.urlsplit(origin).hostname
+            if host not in LOCAL_HOSTS + (gateway.host,):
+                self._send_json(403, {'error': "foreign origin"})
+                return False
+        if gateway.token:
+            token = ""
+            authorization = self.headers.get("Authorization", "")
+            if authorization.startswith("Bearer "):
+                token = authorization[len("Bearer "):]
+            else:
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+                token = query.get('token', [""])[0]
+            if not hmac.compare_digest(token.encode(), gateway.token.encode()):
+                self._send_json(401, {'error': "invalid token"})
+                return False
+        return True
+
+    def do_GET(self):
+        gateway:Gateway = self.server.gateway
+        if not self._authorized(gateway):
+            return
+        ain, action = self._route()
+        if action == "ws":
+            return self._websocket(gateway)
+        if action == "devices":
+            return self._send_json(200, gateway.devices())
+        if ain is None or ain not in gateway.watcher.snapshot or action not in ("device", "stats"):
+            return self._send_json(404, {'error': "not found"})
+        if action == "device":
+            return self._send_json(200, gateway.device(ain))
+        self._call(lambda: gateway.stats(ain))
+
+    def do_POST(self):
+        gateway:Gateway = self.server.gateway
+        if not self._authorized(gateway):
+            return
+        ain, action = self._route()
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_SIZE:
+            self.close_connection = True
+            return self._send_json(413, {'error': "request body too large"})
+        body = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            return self._send_json(415, {'error': "expected Content-Type application/json"})
+        if action != "switch" or ain not in gateway.watcher.snapshot:
+            return self._send_json(404, {'error': "not found"})
+        try:
+            state = json.loads(body)['state']
+            if state not in (True, False, "toggle"):
+                raise ValueError(state)
+        except (ValueError, KeyError, TypeError):
+            return self._send_json(400, {'error': 'expected {"state": true|false|"toggle"}'})
+        self._call(lambda: {'ain': ain, 'state': gateway.switch(ain, state)})
+
+    def _call(self, func)->None:
+        """Sends the result of `func` or an error."""
+        try:
+            result = func()
+        except TimeoutError as ex:
+            return self._send_json(504, {'error': str(ex)})
+        except (FritzBoxError, OSError, ValueError) as ex:
+            return self._send_json(502, {'error': str(ex)})
+        self._send_json(200, result)
+
+    # WebSocket (RFC 6455, text frames from server to client only)
+
+    def _websocket(self, gateway:Gateway)->None:
+        key = self.headers.get("Sec-WebSocket-Key")
+        if self.headers.get("Upgrade", "").lower() != "websocket" or not key:
+            return self._send_json(400, {'error': "WebSocket upgrade expected"})
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        client = gateway._add_client()
+        try:
+            self._send_frame(0x1, to_json({'type': 'snapshot', 'devices': gateway.devices()}).encode())
+            while True:
+                try:
+                    text = client.get(timeout=0.5)
+                except queue.Empty:
+                    text = ""
+                if text is None:
+                    break
+                if text:
+                    self._send_frame(0x1, text.encode())
+                if not self._handle_incoming():
+                    break
+        except OSError:
+            pass
+        finally:
+            gateway._remove_client(client)
+
+    def _send_frame(self, opcode:int, payload:bytes)->None:
+        size = len(payload)
+        if size < 126:
+            header = struct.pack("!BB", 0x80 | opcode, size)
+        elif size < 1 << 16:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, size)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, size)
+        self.wfile.write(header + payload)
+        self.wfile.flush()
+
+    def _frame_pending(self)->bool:
+        """True if data of the client is buffered by `rfile` or waiting
+        on the socket (or the connection was closed)."""
+        # NOTE: `peek` blocks on an empty buffer unless the socket is
+        # non-blocking
+        timeout = self.connection.gettimeout()
+        self.connection.setblocking(False)
+        try:
+            buffered = self.rfile.peek(1)
+        finally:
+            self.connection.settimeout(timeout)
+        return bool(buffered) or bool(select.select([self.connection], [], [], 0)[0])
+
+    def _handle_incoming(self)->bool:
+        """Answers pings and close frames of the client. Returns False once
+        the connection is closed."""
+        while self._frame_pending():
+            header = self.rfile.read(2)
+            if len(header) < 2:
+                return False
+            opcode = header[0] & 0x0F
+            size = header[1] & 0x7F
+            if size == 126:
+                size = struct.unpack("!H", self.rfile.read(2))[0]
+            elif size == 127:
+                size = struct.unpack("!Q", self.rfile.read(8))[0]
+            if size > MAX_BODY_SIZE:
+                # close with status 1009 (message too big)
+                self._send_frame(0x8, struct.pack("!H", 1009))
+                return False
+            mask = self.rfile.read(4) if header[1] & 0x80 else b"\0\0\0\0"
+            payload = bytes(byte ^ mask[idx % 4] for idx, byte in enumerate(self.rfile.read(size)))
+            if opcode == 0x8:
+                self._send_frame(0x8, payload[:2])
+                return False
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+        return True
+
+
+if __name__ == "__main__":
+    from ..connection.session import FritzBoxSession
+    parser = argparse.ArgumentParser(description="Caching gateway for a FRITZ!Box.")
+    parser.add_argument("-config", required=True, help="JSON file with login data.")
+    parser.add_argument("-host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("-port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument("-interval", type=float, default=10, help="Time between polls (in seconds).")
+    parser.add_argument("-token", default=None, help="Secret clients must present (optional).")
+    args = parser.parse_args()
+    with open(args.config, "r") as file:
+        login = json.load(file)['login']
+    session = FritzBoxSession(login['user'], login['pwd'], login['ip'])
+    gateway = Gateway(session, args.host, args.port, interval=args.interval, token=args.token)
+    print(f"Gateway listening on http://{gateway.host}:{gateway.port}")
+    gateway.serve_forever()
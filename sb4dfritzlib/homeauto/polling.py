@@ -0,0 +1,321 @@
+"""Activity-adaptive polling rates for fleets of devices.
+
+Most plugs are stable most of the time (off, or steadily idle), so
+polling all of them at the same rate wastes requests. The
+`AdaptivePollingPolicy` polls a device at the fastest rate while its
+power or state is changing, or while an idle job is watching it, and
+backs off exponentially (up to `max_interval`) while it is stable. All
+rates are scaled down together if they would exceed a global request
+budget, with watched devices served first:
+
+    policy = AdaptivePollingPolicy(budget=2)
+    poller = AdaptivePoller.for_devices(system.devices, policy)
+    poller.start()
+    print(policy.rates())       # effective polls per second by AIN
+"""
+
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+from ..utilities.clock import SYSTEM_CLOCK
+
+
+class DevicePollState():
+    """Polling state of one device."""
+
+    __slots__ = ('interval', 'next_due', 'last_values', 'watchers', 'polls', 'version')
+
+    def __init__(self, interval:float, next_due:float):
+        # interval requested by the device's activity in seconds
+        self.interval = interval
+        # unix timestamp of the next poll
+        self.next_due = next_due
+        self.last_values:dict = None
+        # number of jobs watching the device
+        self.watchers = 0
+        self.polls = 0
+        # invalidates outdated entries in the schedule
+        self.version = 0
+
+
+class AdaptivePollingPolicy():
+    """Decides when each device is polled next.
+
+    ARGUMENTS:
+    - min_interval : interval of changing or watched devices in seconds
+      (default: 10, the power grid)
+    - max_interval : longest interval of stable devices in seconds
+    - backoff : factor the interval grows by with each stable poll
+    - power_tolerance : power changes up to this value (in W) count as stable
+    - budget : maximum number of polls per second of all devices together
+      (optional)
+    - reserve : share of the budget kept for unwatched devices if watched
+      devices alone would exceed it (between 0 and 1, exclusive)
+    - clock : clock used for timing (optional, e.g. `VirtualClock`)
+    """
+
+    def __init__(
+            self,
+            min_interval:float=10,
+            max_interval:float=600,
+            backoff:float=2.0,
+            power_tolerance:float=1.0,
+            budget:float=None,
+            reserve:float=0.1,
+            clock=None,
+            ):
+        if not 0 < reserve < 1:
+            raise ValueError("reserve must be between 0 and 1 (exclusive)")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.power_tolerance = power_tolerance
+        self.budget = budget
+        self.reserve = reserve
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.devices:dict[str,DevicePollState] = {}
+        # schedule of polls: (next_due, counter, ain, version)
+        self._schedule:list[tuple[float,int,str,int]] = []
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+        # cached budget scales (watched, unwatched), None if outdated
+        self._scales:tuple[float,float] = None
+
+    ###  DEVICES  ###
+
+    def add(self, ain:str)->None:
+        """Adds a device, polled right away."""
+        with self._lock:
+            if ain not in self.devices:
+                self.devices[ain] = DevicePollState(self.min_interval, self.clock.time())
+                self._scales = None
+                self._push(ain)
+
+    def remove(self, ain:str)->None:
+        with self._lock:
+            if self.devices.pop(ain, None):
+                self._scales = None
+
+    def watch(self, ain:str)->None:
+        """Polls the device at the fastest rate until `unwatch` is called
+        (e.g. while an idle job monitors it). Jobs polling the device
+        themselves report their readings with `observe`, which defers the
+        next scheduled poll, so the device is not polled twice."""
+        with self._lock:
+            self.add(ain)
+            state = self.devices[ain]
+            state.watchers += 1
+            if state.watchers == 1:
+                state.interval = self.min_interval
+                self._scales = None
+                # poll earlier if the device was backed off
+                now = self.clock.time()
+                if now + self.effective_interval(ain) < state.next_due:
+                    self._reschedule(ain, now)
+
+    def unwatch(self, ain:str)->None:
+        with self._lock:
+            state = self.devices.get(ain)
+            if state and state.watchers > 0:
+                state.watchers -= 1
+                self._scales = None
+
+    @contextmanager
+    def watching(self, ain:str):
+        """Watches the device within the block."""
+        self.watch(ain)
+        try:
+            yield
+        finally:
+            self.unwatch(ain)
+
+    ###  RATES  ###
+
+    def is_change(self, old:dict|None, new:dict)->bool:
+        """True if the values of a device changed significantly. Values
+        other than `power` count as changed if they differ at all."""
+        if old is None:
+            return True
+        for key, value in new.items():
+            previous = old.get(key)
+            if key == 'power' and value is not None and previous is not None:
+                if abs(value - previous) > self.power_tolerance:
+                    return True
+            elif value != previous:
+                return True
+        return False
+
+    def observe(self, ain:str, values:dict|None)->None:
+        """Updates the interval of a device after a poll and schedules the
+        next one. Pass None for failed polls (the interval is kept)."""
+        with self._lock:
+            self.add(ain)
+            state = self.devices[ain]
+            state.polls += 1
+            if values is not None:
+                if state.watchers or self.is_change(state.last_values, values):
+                    interval = self.min_interval
+                else:
+                    interval = min(state.interval * self.backoff, self.max_interval)
+                if interval != state.interval:
+                    state.interval = interval
+                    self._scales = None
+                state.last_values = values
+            self._reschedule(ain, self.clock.time())
+
+    def _budget_scales(self)->tuple[float,float]:
+        """Returns the factors stretching the intervals of watched and
+        unwatched devices so that all polls fit into the budget."""
+        if self._scales is not None:
+            return self._scales
+        scales = (1.0, 1.0)
+        if self.budget:
+            watched = sum(1 / state.interval for state in self.devices.values() if state.watchers)
+            others = sum(1 / state.interval for state in self.devices.values() if not state.watchers)
+            # watched devices are served first, but not at the expense of
+            # the reserve of unwatched ones
+            watched_budget = self.budget * (1 - self.reserve) if others else self.budget
+            watched_scale = max(1.0, watched / watched_budget)
+            # NOTE: unwatched devices always keep at least the reserve
+            remaining = max(self.budget - watched / watched_scale, self.budget * self.reserve)
+            others_scale = max(1.0, others / remaining) if others else 1.0
+            scales = (watched_scale, others_scale)
+        self._scales = scales
+        return scales
+
+    def effective_interval(self, ain:str)->float:
+        """Interval of a device in seconds, including budget scaling."""
+        with self._lock:
+            state = self.devices[ain]
+            watched_scale, others_scale = self._budget_scales()
+            return state.interval * (watched_scale if state.watchers else others_scale)
+
+    def rates(self)->dict[str,float]:
+        """Returns the effective polls per second by AIN."""
+        with self._lock:
+            return {ain:1 / self.effective_interval(ain) for ain in self.devices}
+
+    def total_rate(self)->float:
+        """Returns the effective polls per second of all devices."""
+        return sum(self.rates().values())
+
+    ###  SCHEDULE  ###
+
+    def _push(self, ain:str):
+        state = self.devices[ain]
+        heapq.heappush(self._schedule, (state.next_due, next(self._counter), ain, state.version))
+
+    def _reschedule(self, ain:str, now:float):
+        state = self.devices[ain]
+        state.next_due = now + self.effective_interval(ain)
+        state.version += 1
+        self._push(ain)
+
+    def next_due(self)->tuple[float,str]|None:
+        """Returns time (unix timestamp) and AIN of the next poll, None if
+        there are no devices."""
+        with self._lock:
+            while self._schedule:
+                when, _, ain, version = self._schedule[0]
+                state = self.devices.get(ain)
+                if state is not None and state.version == version:
+                    return when, ain
+                # drop outdated entries
+                heapq.heappop(self._schedule)
+            return None
+
+
+class AdaptivePoller():
+    """Polls devices as scheduled by an `AdaptivePollingPolicy`.
+
+    ARGUMENTS:
+    - policy : polling policy (its devices are polled)
+    - fetch : function mapping an AIN to a dict of values, e.g.
+      `{'power': ..., 'state': ...}`
+    - callback : function called as `callback(ain, values)` after each
+      successful poll (optional)
+    """
+
+    def __init__(self, policy:AdaptivePollingPolicy, fetch, callback=None):
+        self.policy = policy
+        self.fetch = fetch
+        self.callback = callback
+        self.clock = policy.clock
+        self.last_error:Exception = None
+        self.polls = 0
+        self._last_poll:float = None
+        self._stop = threading.Event()
+        self._thread:threading.Thread = None
+
+    @classmethod
+    def for_devices(cls, devices:list, policy:AdaptivePollingPolicy=None, callback=None)->"AdaptivePoller":
+        """Poller of `HomeAutoDevice` objects reading the latest power
+        record and the switch state."""
+        policy = policy if policy else AdaptivePollingPolicy()
+        by_ain = {device.ain:device for device in devices}
+        def fetch(ain):
+            device = by_ain[ain]
+            return {
+                'power': device.get_latest_power_record()['power'],
+                'state': device.get_switch_state(),
+            }
+        for ain in by_ain:
+            policy.add(ain)
+        return cls(policy, fetch, callback)
+
+    def poll_next(self)->str|None:
+        """Waits for the next scheduled poll and runs it. Returns the AIN
+        of the polled device (None if there are no devices)."""
+        while True:
+            scheduled = self.policy.next_due()
+            if scheduled is None:
+                return None
+            when, ain = scheduled
+            # NOTE: the budget also limits the spacing of single polls
+            if self.policy.budget and self._last_poll is not None:
+                when = max(when, self._last_poll + 1 / self.policy.budget)
+            delay = when - self.clock.time()
+            if delay > 0:
+                # NOTE: real waits end early on `stop`
+                if self.clock is SYSTEM_CLOCK:
+                    if self._stop.wait(delay):
+                        return None
+                else:
+                    self.clock.sleep(delay)
+            # skip polls deferred while waiting (e.g. by an idle job
+            # reporting its own reading)
+            if self.policy.next_due() == scheduled:
+                break
+        self._last_poll = self.clock.time()
+        self.polls += 1
+        try:
+            values = self.fetch(ain)
+        except Exception as ex:
+            self.last_error = ex
+            self.policy.observe(ain, None)
+            return ain
+        self.policy.observe(ain, values)
+        if self.callback:
+            self.callback(ain, values)
+        return ain
+
+    def run(self, max_polls:int=None)->None:
+        """Polls until `stop` is called (or `max_polls` polls are done)."""
+        self._stop.clear()
+        polls = 0
+        while not self._stop.is_set() and (max_polls is None or polls < max_polls):
+            if self.poll_next() is None:
+                self._stop.wait(self.policy.min_interval)
+            polls += 1
+
+    def start(self)->"AdaptivePoller":
+        """Polls from a daemon thread."""
+        self._thread = threading.Thread(
+            name="sb4dfritz adaptive poller", target=self.run, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self)->None:
+        self._stop.set()
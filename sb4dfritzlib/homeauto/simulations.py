@@ -1,13 +1,15 @@
 from .devicemodels import HomeAutoDevice, HomeAutoSystem
+from ..utilities.clock import SYSTEM_CLOCK
+from ..utilities.bitmask import FRITZ_DECT_200
+from ..utilities import tracing
 import random
-from time import sleep
 from datetime import datetime, timedelta
-from scipy.stats import skewnorm
+import numpy as np
 import threading
 
 
-def choose_random_string_of_integers(length:int)->str:
-    random_integers = [random.randint(0, 9) for _ in range(length)]
+def choose_random_string_of_integers(length:int, rng:random.Random=random)->str:
+    random_integers = [rng.randint(0, 9) for _ in range(length)]
     integer_string = ''.join(str(num) for num in random_integers)
     return integer_string
 
@@ -15,45 +17,117 @@ def generate_random_boolean():
     random_bool = random.choice([True, False])
     return random_bool
 
-def generate_fake_sid():
-    fake_sid = choose_random_string_of_integers(16)
+def generate_fake_sid(rng:random.Random=random):
+    fake_sid = choose_random_string_of_integers(16, rng)
     return fake_sid
 
-def generate_fake_ain():
+def generate_fake_ain(rng:random.Random=random):
     # generate first five numbers
-    fake_ain = choose_random_string_of_integers(5)
+    fake_ain = choose_random_string_of_integers(5, rng)
     # add space
     fake_ain += " "
     # generate remaining seven numbers
-    fake_ain += choose_random_string_of_integers(7)
+    fake_ain += choose_random_string_of_integers(7, rng)
     return fake_ain
 
-def add_network_latency(one_way=True):
-    """Simulates network latency by sampling from a skew normal distribution."""
+class LatencySampler():
+    """Serves samples of a skew normal distribution from a buffer that is
+    refilled in large blocks, which is much cheaper than sampling one value
+    per request. Uses SciPy if available and NumPy otherwise.
+
+    ARGUMENTS:
+    - shape, loc, scale : parameters of the skew normal distribution
+    - seed : seed or `numpy.random.Generator` (optional)
+    - block_size : number of samples generated per refill (default: 4096)
+    """
+
+    def __init__(self, shape:float=5, loc:float=0.74, scale:float=0.1, 
+                 seed=None, block_size:int=4096):
+        self.shape = shape
+        self.loc = loc
+        self.scale = scale
+        self.block_size = block_size
+        self.rng = np.random.default_rng(seed)
+        self._buffer = np.empty(0)
+        self._position = 0
+        self._lock = threading.Lock()
+
+    def sample(self)->float:
+        """Returns the next sample."""
+        with self._lock:
+            if self._position >= len(self._buffer):
+                self._buffer = self._generate_block(self.block_size)
+                self._position = 0
+            value = self._buffer[self._position]
+            self._position += 1
+        return float(value)
+
+    def _generate_block(self, size:int)->np.ndarray:
+        try:
+            from scipy.stats import skewnorm
+        except ImportError:
+            return self._generate_block_numpy(size)
+        return skewnorm.rvs(
+            self.shape, loc=self.loc, scale=self.scale, size=size, random_state=self.rng
+        )
+
+    def _generate_block_numpy(self, size:int)->np.ndarray:
+        # NOTE: if u, v are independent standard normal variables, then
+        # delta * |u| + sqrt(1 - delta^2) * v is skew normal with shape
+        # parameter a, where delta = a / sqrt(1 + a^2)
+        delta = self.shape / np.sqrt(1 + self.shape**2)
+        u = np.abs(self.rng.standard_normal(size))
+        v = self.rng.standard_normal(size)
+        z = delta * u + np.sqrt(1 - delta**2) * v
+        return self.loc + self.scale * z
+
+
+# sampler used if no other sampler is given
+_default_latency_sampler:LatencySampler = None
+
+def add_network_latency(one_way=True, clock=SYSTEM_CLOCK, sampler:LatencySampler=None):
+    """Simulates network latency by sampling from a skew normal distribution.
+    The waiting is done by `clock`, so a `VirtualClock` returns instantly."""
+    global _default_latency_sampler
+    if sampler is None:
+        if _default_latency_sampler is None:
+            _default_latency_sampler = LatencySampler()
+        sampler = _default_latency_sampler
     # get sample from a suitable skew normal distribution
-    two_way_latency = skewnorm.rvs(5, loc=0.74, scale=0.1, size=1)[0]
+    two_way_latency = sampler.sample()
     # determine latency
     if one_way:
         latency = two_way_latency / 2
     else:
         latency = two_way_latency
     # wait a bit
-    sleep(latency)
+    clock.sleep(latency)
 
 
 class SmartPlugSimulator(HomeAutoDevice):
 
-    def __init__(self, name="Smart Home Simulator", id=None):
+    def __init__(self, name="Smart Home Simulator", id=None, clock=None, seed=None):
+        """Simulated smart plug. Pass a `VirtualClock` as `clock` and an 
+        integer `seed` for fast and reproducible simulations."""
+        # random number generators (reproducible if seed is given)
+        self.random = random.Random(seed)
+        self.latency_sampler = LatencySampler(seed=self.random.getrandbits(32))
         # shared with HomeAutomationDevice
-        self.sid = generate_fake_sid()
-        self.ain = generate_fake_ain()
+        if clock:
+            self.clock = clock
+        self.sid = generate_fake_sid(self.random)
+        self.ain = generate_fake_ain(self.random)
         self.name = name
         self.model = "Smart Plug Simulator"
-        self.device_id = id if id else random.randint(1,16)
+        self.device_id = id if id else self.random.randint(1,16)
         # needed for simulation
+        self.capabilities = FRITZ_DECT_200
         self.is_switchable = True
         self.__switch_state = True
-        self.sensor:MeasurementSimulator = MeasurementSimulator()
+        self.sensor:MeasurementSimulator = MeasurementSimulator(
+            clock=self.clock, 
+            seed=self.random.getrandbits(32)
+        )
     
     def get_switch_state(self)->bool:
         """Get current switch state (on=True ,off=False)."""
@@ -71,11 +145,13 @@ class SmartPlugSimulator(HomeAutoDevice):
         self.__switch_state = new_state
         return self.get_switch_state()
     
-    def get_basic_device_stats(self):
-        # add a bit of latency
-        add_network_latency()
-        # send request for device stats
-        return self.sensor.send_basic_device_stats()
+    def get_basic_device_stats(self, use_cache:bool=True):
+        # NOTE: the simulated plug always answers, `use_cache` is ignored
+        with tracing.span("http", command="getbasicdevicestats", simulated=True):
+            # add a bit of latency
+            add_network_latency(clock=self.clock, sampler=self.latency_sampler)
+            # send request for device stats
+            return self.sensor.send_basic_device_stats()
 
 
 
@@ -88,8 +164,13 @@ class HomeAutoSystemSimulator(HomeAutoSystem):
 class PowerSimulator:
     """Simulates the power consumption of my coffee machine."""
 
-    def __init__(self):
+    # series up to this length are generated without NumPy
+    SCALAR_SERIES_LENGTH = 50
+
+    def __init__(self, rng:random.Random=None):
         """Simulates the power consumption of my coffee machine."""
+        # random number generator
+        self.random = rng if rng else random.Random()
         # states of power consumption
         self.states = ["idle", "mid", "high"]
         # current state (start with "high" consumption)
@@ -114,7 +195,7 @@ class PowerSimulator:
         }
     
     def select_new_state(self):
-        new_region = random.choices(
+        new_region = self.random.choices(
             population=self.states,
             weights=self.chances_by_state.values(),
             k=1
@@ -124,13 +205,229 @@ class PowerSimulator:
 
     def get_current_power(self):
         stickiness = self.stickiness_by_state[self.current_state]
-        if random.random() > stickiness:
+        if self.random.random() > stickiness:
             # Switch to a new region based on weights
             self.current_state = self.select_new_state()
 
         # Generate number in current region
         low, high = self.state_ranges[self.current_state]
-        return random.randint(low, high)
+        return self.random.randint(low, high)
+
+    def get_power_series(self, n:int)->np.ndarray:
+        """Returns the next `n` power values (oldest first), generated in
+        one batch by a `MarkovPowerGenerator` (short series step by step,
+        which is faster for them)."""
+        if n <= self.SCALAR_SERIES_LENGTH:
+            return np.array([self.get_current_power() for _ in range(n)], dtype=np.int64)
+        if getattr(self, '_generator', None) is None:
+            self._generator = MarkovPowerGenerator.from_simulators(
+                [self], seed=self.random.getrandbits(64)
+            )
+        # continue from the current state and remember the final state
+        self._generator.states[0] = self.states.index(self.current_state)
+        power = self._generator.generate(n)[:, 0]
+        self.current_state = self.states[self._generator.states[0]]
+        return power
+
+
+class FridgeSimulator(PowerSimulator):
+    """Simulates the power consumption of a fridge with compressor cycles."""
+
+    def __init__(self, rng:random.Random=None):
+        super().__init__(rng)
+        self.current_state = "idle"
+        self.state_ranges = {
+            "idle": (0, 80),            #  0.0 to  0.8 W
+            "mid": (6000, 9000),        #   60 to   90 W
+            "high": (9000, 15000),      #   90 to  150 W (compressor start)
+        }
+        self.stickiness_by_state = {"idle": 0.95, "mid": 0.9, "high": 0.3}
+        self.chances_by_state = {"idle": 0.5, "mid": 0.3, "high": 0.2}
+
+
+class TelevisionSimulator(PowerSimulator):
+    """Simulates the power consumption of a TV set switching between
+    standby and operation."""
+
+    def __init__(self, rng:random.Random=None):
+        super().__init__(rng)
+        self.current_state = "idle"
+        self.state_ranges = {
+            "idle": (30, 60),           #  0.3 to  0.6 W (standby)
+            "mid": (6000, 9000),        #   60 to   90 W
+            "high": (9000, 14000),      #   90 to  140 W
+        }
+        self.stickiness_by_state = {"idle": 0.99, "mid": 0.95, "high": 0.9}
+        self.chances_by_state = {"idle": 0.4, "mid": 0.4, "high": 0.2}
+
+
+class WashingMachineSimulator(PowerSimulator):
+    """Simulates the power consumption of a washing machine with motor and
+    heating phases."""
+
+    def __init__(self, rng:random.Random=None):
+        super().__init__(rng)
+        self.current_state = "mid"
+        self.state_ranges = {
+            "idle": (100, 200),         #  1.0 to  2.0 W
+            "mid": (15000, 50000),      #  150 to  500 W (motor)
+            "high": (190000, 220000),   # 1900 to 2200 W (heating)
+        }
+        self.stickiness_by_state = {"idle": 0.9, "mid": 0.8, "high": 0.85}
+        self.chances_by_state = {"idle": 0.2, "mid": 0.6, "high": 0.2}
+
+
+class LampSimulator(PowerSimulator):
+    """Simulates the power consumption of a lamp that is rarely switched."""
+
+    def __init__(self, rng:random.Random=None):
+        super().__init__(rng)
+        self.current_state = "mid"
+        self.state_ranges = {
+            "idle": (20, 40),           #  0.2 to  0.4 W
+            "mid": (800, 1000),         #  8.0 to 10.0 W
+            "high": (1000, 1200),       # 10.0 to 12.0 W
+        }
+        self.stickiness_by_state = {"idle": 0.995, "mid": 0.995, "high": 0.99}
+        self.chances_by_state = {"idle": 0.5, "mid": 0.4, "high": 0.1}
+
+
+# appliance profiles available for simulations
+APPLIANCE_PROFILES = {
+    'coffee machine': PowerSimulator,
+    'fridge': FridgeSimulator,
+    'television': TelevisionSimulator,
+    'washing machine': WashingMachineSimulator,
+    'lamp': LampSimulator,
+}
+
+
+def transition_matrix(stickiness:list[float], chances:list[float])->np.ndarray:
+    """Returns the transition matrix of the Markov chain used by 
+    `PowerSimulator`: a state is kept with probability `stickiness`, 
+    otherwise a new state (possibly the same) is chosen according to 
+    `chances`. Entry (i, j) is the probability to go from state i to j."""
+    stickiness = np.asarray(stickiness, dtype=float)
+    chances = np.asarray(chances, dtype=float)
+    chances = chances / chances.sum()
+    num_states = len(chances)
+    return (
+        np.diag(stickiness) 
+        + (1 - stickiness)[:, None] * np.broadcast_to(chances, (num_states, num_states))
+    )
+
+
+class MarkovPowerGenerator():
+    """Generates power values of M independent appliances for N steps at
+    once. Each appliance follows a Markov chain over K states and draws 
+    its power uniformly from the range of its current state.
+
+    ARGUMENTS:
+    - transitions : transition matrices, shape (K, K) or (M, K, K)
+    - lows, highs : power ranges by state (unit 0.01 W), shape (K,) or (M, K)
+    - states : initial state indices, shape (M,) (default: all 0)
+    - size : number of appliances M (only needed if nothing else has
+      shape M)
+    - seed : seed or `numpy.random.Generator` (optional)
+    """
+
+    def __init__(self, transitions, lows, highs, states=None, size:int=None, seed=None):
+        transitions = np.asarray(transitions, dtype=float)
+        lows = np.asarray(lows, dtype=np.int64)
+        highs = np.asarray(highs, dtype=np.int64)
+        if size is None:
+            shapes = [transitions.shape[:-2], lows.shape[:-1], np.shape(states)]
+            size = max([shape[0] for shape in shapes if shape] + [1])
+        num_states = transitions.shape[-1]
+        self.size = size
+        self.num_states = num_states
+        self.rng = np.random.default_rng(seed)
+        # cumulative transition probabilities, shape (M, K, K)
+        cumulative = np.cumsum(transitions, axis=-1)
+        self._cumulative = np.broadcast_to(cumulative, (size, num_states, num_states))
+        # thresholds by target state, shape (K-1, M, K) (the last column is 1)
+        self._thresholds = np.ascontiguousarray(np.moveaxis(self._cumulative[..., :-1], -1, 0))
+        # offsets of the appliances in the flattened maps of a step
+        self._offsets = (np.arange(size, dtype=np.intp) * num_states)[:, None]
+        self.lows = np.broadcast_to(lows, (size, num_states))
+        self.highs = np.broadcast_to(highs, (size, num_states))
+        self.states = np.zeros(size, dtype=np.int64) if states is None \
+            else np.array(states, dtype=np.int64)
+
+    @classmethod
+    def from_simulators(cls, simulators:list[PowerSimulator], seed=None):
+        """Creates a generator with one appliance per given `PowerSimulator`,
+        using their state tables and current states."""
+        transitions, lows, highs, states = [], [], [], []
+        for sim in simulators:
+            transitions.append(transition_matrix(
+                [sim.stickiness_by_state[state] for state in sim.states],
+                [sim.chances_by_state[state] for state in sim.states],
+            ))
+            lows.append([sim.state_ranges[state][0] for state in sim.states])
+            highs.append([sim.state_ranges[state][1] for state in sim.states])
+            states.append(sim.states.index(sim.current_state))
+        return cls(transitions, lows, highs, states, seed=seed)
+
+    def generate_states(self, n:int)->np.ndarray:
+        """Advances all chains by `n` steps and returns the visited states,
+        shape (n, M)."""
+        size, num_states = self.size, self.num_states
+        if n <= 0:
+            return np.empty((0, size), dtype=np.int64)
+        # draw all random numbers at once
+        uniforms = self.rng.random((n, size))[:, :, None]
+        # map of each step: maps[t, m, i] is the state following state i
+        # (inverse transform sampling from row i), stored as flat index
+        # into the maps of step t
+        maps = np.broadcast_to(self._offsets, (n, size, num_states)).copy()
+        for column in self._thresholds:
+            maps += uniforms > column
+        maps = maps.reshape(n, -1)
+        # compose the maps of all steps up to t (parallel prefix scan, so
+        # log2(n) NumPy calls instead of one per step)
+        rows = (np.arange(n, dtype=np.intp) * (size * num_states))[:, None]
+        shift = 1
+        while shift < n:
+            maps[shift:] = np.take(maps, maps[:-shift] + rows[shift:])
+            shift *= 2
+        # apply the composed maps to the current states
+        states = np.take(maps, rows + self._offsets[:, 0] + self.states) - self._offsets[:, 0]
+        self.states = states[-1].copy()
+        return states
+
+    def generate(self, n:int)->np.ndarray:
+        """Advances all chains by `n` steps and returns power values (unit
+        0.01 W), shape (n, M)."""
+        states = self.generate_states(n)
+        rows = np.arange(self.size)
+        lows = self.lows[rows, states]
+        highs = self.highs[rows, states]
+        return self.rng.integers(lows, highs, endpoint=True)
+
+
+
+class RingBuffer():
+    """Fixed-size buffer keeping the most recent values of a series."""
+
+    def __init__(self, size:int, dtype=np.int64):
+        self.size = size
+        self._data = np.zeros(size, dtype=dtype)
+        # index of the next value to be written
+        self._head = 0
+
+    def extend(self, values)->None:
+        """Appends values given in chronological order (oldest first)."""
+        values = np.asarray(values)[-self.size:]
+        num = len(values)
+        idx = (self._head + np.arange(num)) % self.size
+        self._data[idx] = values
+        self._head = (self._head + num) % self.size
+
+    def latest_first(self)->np.ndarray:
+        """Returns the values starting with the most recent one."""
+        idx = (self._head - 1 - np.arange(self.size)) % self.size
+        return self._data[idx]
 
 
 
@@ -138,9 +435,13 @@ class MeasurementSimulator():
     """Simulates the measurement mechanism in FRITZ! smart plugs and produces
     "basic_device_stats" in the fritzconnection dictionary format."""
     
-    def __init__(self):
+    def __init__(self, clock=None, seed=None):
+        # clock and random number generators
+        self.clock = clock if clock else SYSTEM_CLOCK
+        self.random = random.Random(seed)
+        self.latency_sampler = LatencySampler(seed=self.random.getrandbits(32))
         # simulate connected appliances
-        self.appliances:PowerSimulator = PowerSimulator()
+        self.appliances:PowerSimulator = PowerSimulator(self.random)
         # set measure cycle base time
         self.cycle_base_time = None
         self.reset_cycle_base_time()
@@ -157,18 +458,14 @@ class MeasurementSimulator():
     def _generate_basic_device_stats(self):
         # generate template
         device_stats = self._generate_basic_device_stats_template()
-        # generate sufficient data
-        cats = device_stats.keys()
-        max_count = max([device_stats[cat]['count'] for cat in cats])
-        data = {cat:[] for cat in cats}
-        for i in range(max_count):
-            new_data = self._generate_measure_data()
-            for cat in cats:
-                data[cat].append(new_data[cat])
-        # fill device_stats with the right amounts of data
-        for cat in cats:
-            cat_count = device_stats[cat]['count'] 
-            device_stats[cat]['data'] = data[cat][:cat_count]
+        # fill ring buffers with sufficient data (oldest values first)
+        self._series:dict[str,RingBuffer] = {}
+        self._datatimes:dict[str,datetime] = {}
+        for cat, stats in device_stats.items():
+            self._series[cat] = RingBuffer(stats['count'])
+            self._series[cat].extend(self._generate_measure_data_batch(cat, stats['count']))
+            self._datatimes[cat] = stats['datatime']
+            stats['data'] = self._series[cat].latest_first().tolist()
         # pass to the basic_device_stats attribute
         self.basic_device_stats = device_stats
 
@@ -196,6 +493,12 @@ class MeasurementSimulator():
         data = {cat:0 for cat in data_categories}
         data['power'] = self.appliances.get_current_power()
         return data
+
+    def _generate_measure_data_batch(self, cat:str, n:int)->np.ndarray:
+        """Generates `n` consecutive values of category `cat` (oldest first)."""
+        if cat == 'power':
+            return self.appliances.get_power_series(n)
+        return np.zeros(n, dtype=np.int64)
     
     def send_basic_device_stats(self):
         # wake up on request
@@ -206,43 +509,40 @@ class MeasurementSimulator():
         # update data
         self._update_basic_device_stats()
         # add a bit of latency
-        add_network_latency()
+        add_network_latency(clock=self.clock, sampler=self.latency_sampler)
         # send current device stats
         return self.basic_device_stats
     
-    # TODO TEST THIS !!!
     def _update_basic_device_stats(self):
         device_stats = self.basic_device_stats
-        current_time = datetime.now()
-        for cat in device_stats.keys():
-            old_data = device_stats[cat]['data']
-            old_datatime = device_stats[cat]['datatime']
-            grid = device_stats[cat]['grid']
-            grid_delta = timedelta(seconds=grid)
+        current_time = self.clock.now()
+        for cat, stats in device_stats.items():
+            old_datatime = self._datatimes[cat]
+            grid = stats['grid']
+            # number of complete grid cycles since the last update
+            elapsed = (current_time - old_datatime).total_seconds()
+            cycles_passed = int(elapsed // grid) if elapsed >= grid else 0
+            if cycles_passed == 0:
+                continue
             # update datatime
-            new_datatime = old_datatime
-            cycles_passed = 0
-            while new_datatime + grid_delta <= current_time:
-                cycles_passed += 1
-                new_datatime += grid_delta
-            device_stats[cat]['datatime'] = new_datatime.replace(microsecond=0)
-            # add new data values
-            new_data = old_data
-            for _ in range(cycles_passed):
-                new_value = self._generate_measure_data()[cat]
-                new_data = [new_value] + new_data
-                new_data = new_data[:-1]
+            new_datatime = old_datatime + timedelta(seconds=cycles_passed * grid)
+            self._datatimes[cat] = new_datatime
+            stats['datatime'] = new_datatime.replace(microsecond=0)
+            # add new data values (older values would be dropped anyway)
+            series = self._series[cat]
+            num_new = min(cycles_passed, series.size)
+            series.extend(self._generate_measure_data_batch(cat, num_new))
             # update data in device_stats
-            device_stats[cat]['data'] = new_data
+            stats['data'] = series.latest_first().tolist()
         # update basic_device_stats
         self.basic_device_stats = device_stats
 
     
     def reset_cycle_base_time(self):
         # get current time minus one second
-        t = datetime.now() + timedelta(seconds=-1)
+        t = self.clock.now() + timedelta(seconds=-1)
         # replace the microsecond component with a random value
-        t = t.replace(microsecond=random.randint(0,1000000))
+        t = t.replace(microsecond=self.random.randint(0,999999))
         # update the cycle base time
         self.cycle_base_time = t
 
@@ -253,9 +553,7 @@ class MeasurementSimulator():
             self.sleeping = False
             if self._timer:
                 self._timer.cancel()
-            self._timer = threading.Timer(awake_time, self._go_to_sleep)
-            self._timer.daemon = True
-            self._timer.start()
+            self._timer = self.clock.call_later(awake_time, self._go_to_sleep)
 
     def _go_to_sleep(self):
         with self._lock:
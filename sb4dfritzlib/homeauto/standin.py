@@ -0,0 +1,480 @@
+"""Provides a local stand-in for a FRITZ!Box that serves the login,
+AHA-HTTP and TR-064 (X_AVM-DE_Homeauto) interfaces from the state of a
+`FleetSimulator`.
+
+Since the client code in `sb4dfritzlib.connection` is used unchanged, the
+stand-in allows benchmarking the full client stack (login, requests, XML
+parsing) on a single machine. Latency and errors can be injected.
+
+Example:
+
+    with StandInServer(FleetSimulator(100)) as server:
+        server.configure_client()
+        system = HomeAutoSystem(server.user, server.password, server.address)
+"""
+
+import hashlib
+import random
+import re
+import secrets
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .fleet import FleetSimulator
+from .traces import TraceEnded
+from ..connection import ahahttp, tr064
+from ..connection._login import calculate_md5_response
+
+
+INVALID_SID = "0000000000000000"
+# SIDs expire after 20 minutes of inactivity
+SID_LIFETIME = 20 * 60
+# maximal BlockTime in seconds after failed logins
+MAX_BLOCKTIME = 320
+# realm used for digest authentication of TR-064 requests
+DIGEST_REALM = "HTTPS Access"
+TR064_SERVICE = "urn:dslforum-org:service:X_AVM-DE_Homeauto:1"
+
+
+class StandInServer():
+    """Local HTTP server imitating a FRITZ!Box with smart plugs.
+
+    ARGUMENTS:
+    - fleet : simulated devices (default: `FleetSimulator` with 10 plugs)
+    - host, port : address to listen on (default: random free local port)
+    - user, password : login data accepted by the server
+    - pbkdf2 : if False, only the legacy MD5 challenge is offered
+    - iterations : PBKDF2 iterations for the static and dynamic salt
+    - latency : delay per request in seconds, either a number or a function
+      returning a number (default: None)
+    - error_rate : probability that a request fails with `error_status`
+    - error_status : HTTP status code of injected errors (default: 503)
+    - seed : seed for the error injection (optional)
+    - replay : `TraceReplay` serving recorded `getbasicdevicestats` and
+      `getdevicelistinfos` responses where available (optional)
+    """
+
+    def __init__(self, fleet:FleetSimulator=None, host:str="127.0.0.1", port:int=0,
+                 user:str="admin", password:str="secret", pbkdf2:bool=True,
+                 iterations:tuple[int,int]=(10000, 2000), latency=None,
+                 error_rate:float=0.0, error_status:int=503, seed=None, replay=None):
+        self.fleet = fleet if fleet else FleetSimulator(10, latency=False, seed=seed)
+        self.user = user
+        self.password = password
+        self.pbkdf2 = pbkdf2
+        self.iterations = iterations
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.replay = replay
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        # login state
+        self._static_salt = secrets.token_hex(16)
+        self._static_hash = hashlib.pbkdf2_hmac(
+            "sha256", password.encode(), bytes.fromhex(self._static_salt), iterations[0]
+        )
+        self._challenges:dict[str,str] = {}
+        self._sids:dict[str,float] = {}
+        self._failed_logins = 0
+        self._blocked_until = 0.0
+        self._nonces:set[str] = set()
+        # counters
+        self.requests = 0
+        self.logins = 0
+        self.failed_logins = 0
+        self.injected_errors = 0
+        # HTTP server
+        self._httpd = ThreadingHTTPServer((host, port), _StandInHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.standin = self
+        self._thread:threading.Thread = None
+
+    @property
+    def address(self)->str:
+        """Address of the server as `host:port`."""
+        host, port = self._httpd.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self)->"StandInServer":
+        """Starts serving in a daemon thread."""
+        self._thread = threading.Thread(
+            name="sb4dfritz stand-in server",
+            target=self._httpd.serve_forever,
+            daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self)->None:
+        """Stops the server."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def configure_client(self)->None:
+        """Points the AHA-HTTP and TR-064 clients of `sb4dfritzlib` to this
+        server."""
+        port = self._httpd.server_address[1]
+        ahahttp.set_address(self.address)
+        tr064.set_port(port, scheme="http")
+
+    ###  INJECTION  ###
+
+    def _inject(self)->int|None:
+        """Applies latency and returns an error status code if an error
+        is to be injected."""
+        with self._lock:
+            self.requests += 1
+            fail = self.error_rate > 0 and self.random.random() < self.error_rate
+            if fail:
+                self.injected_errors += 1
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+        return self.error_status if fail else None
+
+    ###  LOGIN  ###
+
+    def new_challenge(self)->str:
+        """Issues a new login challenge."""
+        if self.pbkdf2:
+            dynamic_salt = secrets.token_hex(16)
+            iter1, iter2 = self.iterations
+            challenge = f"2${iter1}${self._static_salt}${iter2}${dynamic_salt}"
+            key = dynamic_salt
+        else:
+            challenge = secrets.token_hex(4)
+            key = challenge
+        with self._lock:
+            # NOTE: keep the number of open challenges bounded
+            if len(self._challenges) > 1000:
+                self._challenges.clear()
+            self._challenges[key] = challenge
+        return challenge
+
+    def blocktime(self)->int:
+        """Remaining BlockTime in seconds."""
+        return max(0, int(round(self._blocked_until - time.time())))
+
+    def login(self, username:str, response:str)->str:
+        """Checks a challenge response and returns a new SID or the
+        invalid SID."""
+        valid = username == self.user and self._check_response(response) \
+            and time.time() >= self._blocked_until
+        with self._lock:
+            if not valid:
+                self.failed_logins += 1
+                self._failed_logins += 1
+                blocktime = min(2 ** (self._failed_logins - 1), MAX_BLOCKTIME)
+                self._blocked_until = time.time() + blocktime
+                return INVALID_SID
+            self.logins += 1
+            self._failed_logins = 0
+            sid = f"{secrets.randbits(64):016x}"
+            self._sids[sid] = time.time()
+            return sid
+
+    def _check_response(self, response:str)->bool:
+        if self.pbkdf2:
+            dynamic_salt, _, hash2 = response.partition("$")
+            with self._lock:
+                challenge = self._challenges.pop(dynamic_salt, None)
+            if challenge is None:
+                return False
+            expected = hashlib.pbkdf2_hmac(
+                "sha256", self._static_hash, bytes.fromhex(dynamic_salt), self.iterations[1]
+            )
+            return secrets.compare_digest(hash2, expected.hex())
+        challenge = response.partition("-")[0]
+        with self._lock:
+            challenge = self._challenges.pop(challenge, None)
+        if challenge is None:
+            return False
+        expected = calculate_md5_response(challenge, self.password)
+        return secrets.compare_digest(response, expected)
+
+    def check_sid(self, sid:str)->bool:
+        """Checks if a SID is valid and renews its lifetime."""
+        with self._lock:
+            last_use = self._sids.get(sid)
+            now = time.time()
+            if last_use is None or now - last_use > SID_LIFETIME:
+                self._sids.pop(sid, None)
+                return False
+            self._sids[sid] = now
+            return True
+
+    def session_info(self, sid:str=INVALID_SID)->bytes:
+        """Returns the XML response of `login_sid.lua`."""
+        challenge = self.new_challenge() if sid == INVALID_SID else ""
+        xml = (
+            f'<?xml version="1.0" encoding="utf-8"?><SessionInfo>'
+            f'<SID>{sid}</SID><Challenge>{challenge}</Challenge>'
+            f'<BlockTime>{self.blocktime()}</BlockTime>'
+            f'<Rights>{"<Name>HomeAuto</Name><Access>2</Access>" if sid != INVALID_SID else ""}</Rights>'
+            f'<Users><User last="1">{self.user}</User></Users></SessionInfo>'
+        )
+        return xml.encode("utf-8")
+
+    def check_digest(self, method:str, authorization:str|None)->bool:
+        """Checks the digest authentication header of a TR-064 request."""
+        if not authorization or not authorization.startswith("Digest "):
+            return False
+        fields = {
+            key:(quoted or plain)
+            for key, quoted, plain in re.findall(r'(\w+)=(?:"([^"]*)"|([^,\s]*))', authorization[7:])
+        }
+        if fields.get('nonce') not in self._nonces or fields.get('username') != self.user:
+            return False
+        md5 = lambda text: hashlib.md5(text.encode()).hexdigest()
+        ha1 = md5(f"{self.user}:{DIGEST_REALM}:{self.password}")
+        ha2 = md5(f"{method}:{fields.get('uri')}")
+        if fields.get('qop'):
+            expected = md5(
+                f"{ha1}:{fields['nonce']}:{fields.get('nc')}:{fields.get('cnonce')}:{fields['qop']}:{ha2}"
+            )
+        else:
+            expected = md5(f"{ha1}:{fields['nonce']}:{ha2}")
+        return secrets.compare_digest(expected, fields.get('response', ""))
+
+    def new_nonce(self)->str:
+        nonce = secrets.token_hex(16)
+        with self._lock:
+            if len(self._nonces) > 1000:
+                self._nonces.clear()
+            self._nonces.add(nonce)
+        return nonce
+
+    ###  AHA-HTTP  ###
+
+    def homeautoswitch(self, params:dict[str,str])->tuple[int,bytes]:
+        """Handles a `homeautoswitch.lua` request and returns status code
+        and body."""
+        if not self.check_sid(params.get('sid', INVALID_SID)):
+            return 403, b"Forbidden\n"
+        fleet = self.fleet
+        fleet.advance()
+        command = params.get('switchcmd')
+        # serve recorded responses if available, otherwise simulate
+        try:
+            if self.replay and command == 'getdevicelistinfos':
+                return 200, self.replay.getdevicelistinfos_raw()
+            if self.replay and command == 'getbasicdevicestats':
+                return 200, self.replay.getbasicdevicestats_raw(params.get('ain', ""))
+        except (KeyError, TraceEnded):
+            pass
+        if command == 'getswitchlist':
+            return 200, (",".join(fleet.session.ains) + "\n").encode()
+        if command == 'getdevicelistinfos':
+            return 200, fleet.getdevicelistinfos_raw()
+        # all remaining commands need a valid AIN
+        index = fleet.index_by_ain.get(params.get('ain', "").replace(" ", ""))
+        if index is None or command is None:
+            return 400 if command is None else 200, b"inval\n"
+        device = fleet.devices[index]
+        if command == 'getswitchstate':
+            return 200, f"{int(device.get_switch_state())}\n".encode()
+        if command in ('setswitchon', 'setswitchoff', 'setswitchtoggle'):
+            if command == 'setswitchtoggle':
+                state = device.toggle_switch()
+            else:
+                state = device.set_switch(command == 'setswitchon')
+            return 200, f"{int(state)}\n".encode()
+        if command == 'getswitchpower':
+            return 200, f"{int(fleet.latest_power()[index]) * 10}\n".encode()
+        if command == 'getswitchenergy':
+            return 200, f"{int(fleet.energy[index])}\n".encode()
+        if command == 'getswitchpresent':
+            return 200, f"{int(fleet.present[index])}\n".encode()
+        if command == 'getswitchname':
+            return 200, f"{device.name}\n".encode()
+        if command == 'getdeviceinfos':
+            return 200, (fleet.device_xml(index) + "\n").encode()
+        if command == 'getbasicdevicestats':
+            return 200, self.devicestats_xml(index)
+        return 400, b"Bad Request\n"
+
+    def devicestats_xml(self, index:int)->bytes:
+        """Returns the XML response of `getbasicdevicestats`."""
+        stats = self.fleet.send_basic_device_stats(index)
+        parts = []
+        for quantity, item in stats.items():
+            datatime = int(item['datatime'].timestamp())
+            data = ",".join(str(val) for val in item['data'])
+            parts.append(
+                f'<{quantity}><stats count="{item["count"]}" grid="{item["grid"]}" '
+                f'datatime="{datatime}">{data}</stats></{quantity}>'
+            )
+        return ("<devicestats>" + "".join(parts) + "</devicestats>\n").encode()
+
+    ###  TR-064  ###
+
+    def soap(self, action:str, body:bytes)->tuple[int,bytes]:
+        """Handles a SOAP action of the X_AVM-DE_Homeauto service and
+        returns status code and body."""
+        try:
+            root = ET.fromstring(body.strip())
+        except ET.ParseError:
+            return 500, soap_fault(402, "Invalid Args")
+        args = {elem.tag.split("}")[-1]:(elem.text or "").strip() for elem in root.iter()}
+        fleet = self.fleet
+        fleet.advance()
+        if action == 'GetInfo':
+            return 200, soap_response(action, {
+                'NewAllowedCharsAIN': "0123456789ABCDEFabcdef :-grptmp",
+                'NewMaxCharsAIN': 19,
+                'NewMinCharsAIN': 1,
+                'NewMaxCharsDeviceName': 79,
+                'NewMinCharsDeviceName': 1,
+            })
+        if action == 'GetGenericDeviceInfos':
+            try:
+                index = int(args.get('NewIndex', ""))
+            except ValueError:
+                return 500, soap_fault(402, "Invalid Args")
+            if not 0 <= index < fleet.size:
+                return 500, soap_fault(713, "SpecifiedArrayIndexInvalid")
+            infos = {'NewAIN': fleet.session.ains[index]}
+            infos.update(self._soap_device_infos(index))
+            return 200, soap_response(action, infos)
+        # remaining actions need a valid AIN
+        index = fleet.index_by_ain.get(args.get('NewAIN', "").replace(" ", ""))
+        if action not in ('GetSpecificDeviceInfos', 'SetSwitch'):
+            return 500, soap_fault(401, "Invalid Action")
+        if index is None:
+            return 500, soap_fault(714, "NoSuchEntryInArray")
+        if action == 'GetSpecificDeviceInfos':
+            return 200, soap_response(action, self._soap_device_infos(index))
+        target = args.get('NewSwitchState')
+        device = fleet.devices[index]
+        if target == 'ON':
+            device.set_switch(True)
+        elif target == 'OFF':
+            device.set_switch(False)
+        elif target == 'TOGGLE':
+            device.toggle_switch()
+        else:
+            return 500, soap_fault(402, "Invalid Args")
+        return 200, soap_response(action, {})
+
+    def _soap_device_infos(self, index:int)->dict:
+        fleet = self.fleet
+        device = fleet.devices[index]
+        return {
+            'NewDeviceId': index + 1,
+            'NewFunctionBitMask': 35712,
+            'NewFirmwareVersion': "04.25",
+            'NewManufacturer': "AVM",
+            'NewProductName': "FRITZ!DECT 200",
+            'NewDeviceName': device.name,
+            'NewPresent': "CONNECTED" if fleet.present[index] else "DISCONNECTED",
+            'NewMultimeterIsEnabled': "ENABLED",
+            'NewMultimeterIsValid': "VALID",
+            'NewMultimeterPower': int(fleet.latest_power()[index]),
+            'NewMultimeterEnergy': int(fleet.energy[index]),
+            'NewSwitchIsEnabled': "ENABLED",
+            'NewSwitchIsValid': "VALID",
+            'NewSwitchState': "ON" if device.get_switch_state() else "OFF",
+            'NewSwitchMode': "MANUAL",
+            'NewSwitchLock': 0,
+        }
+
+
+def soap_response(action:str, values:dict)->bytes:
+    """Returns a SOAP response envelope for an action."""
+    args = "".join(f"<{key}>{val}</{key}>" for key, val in values.items())
+    return (
+        '<?xml version="1.0"?>'
+        '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+        's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+        f'<u:{action}Response xmlns:u="{TR064_SERVICE}">{args}</u:{action}Response>'
+        '</s:Body></s:Envelope>'
+    ).encode()
+
+
+def soap_fault(code:int, description:str)->bytes:
+    """Returns a SOAP fault envelope with an UPnP error."""
+    return (
+        '<?xml version="1.0"?>'
+        '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+        's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+        '<s:Fault><faultcode>s:Client</faultcode><faultstring>UPnPError</faultstring>'
+        '<detail><UPnPError xmlns="urn:schemas-upnp-org:control-1-0">'
+        f'<errorCode>{code}</errorCode><errorDescription>{description}</errorDescription>'
+        '</UPnPError></detail></s:Fault></s:Body></s:Envelope>'
+    ).encode()
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """Dispatches requests to the `StandInServer`."""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "sb4dfritz-standin"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def standin(self)->StandInServer:
+        return self.server.standin
+
+    def _send(self, status:int, body:bytes, content_type:str="text/xml", headers:dict=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self)->bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        error = self.standin._inject()
+        if error:
+            return self._send(error, b"Service Unavailable\n", "text/plain")
+        if url.path == "/login_sid.lua":
+            sid = params.get('sid', INVALID_SID)
+            if not self.standin.check_sid(sid):
+                sid = INVALID_SID
+            return self._send(200, self.standin.session_info(sid))
+        if url.path == "/webservices/homeautoswitch.lua":
+            status, body = self.standin.homeautoswitch(params)
+            content_type = "text/xml" if body.startswith(b"<") else "text/plain"
+            return self._send(status, body, content_type)
+        self._send(404, b"Not Found\n", "text/plain")
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        body = self._read_body()
+        error = self.standin._inject()
+        if error:
+            return self._send(error, b"Service Unavailable\n", "text/plain")
+        if url.path == "/login_sid.lua":
+            params = dict(urllib.parse.parse_qsl(body.decode()))
+            sid = self.standin.login(params.get('username', ""), params.get('response', ""))
+            return self._send(200, self.standin.session_info(sid))
+        if url.path == "/upnp/control/x_homeauto":
+            if not self.standin.check_digest("POST", self.headers.get("Authorization")):
+                challenge = (
+                    f'Digest realm="{DIGEST_REALM}", nonce="{self.standin.new_nonce()}", '
+                    f'algorithm=MD5, qop="auth"'
+                )
+                return self._send(401, b"Unauthorized\n", "text/plain",
+                                  {"WWW-Authenticate": challenge})
+            action = self.headers.get("SoapAction", "").split("#")[-1].strip('"')
+            status, body = self.standin.soap(action, body)
+            return self._send(status, body, 'text/xml; charset="utf-8"')
+        self._send(404, b"Not Found\n", "text/plain")
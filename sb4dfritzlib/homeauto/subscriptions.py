@@ -0,0 +1,150 @@
+"""Provides a push-style subscription API for device values.
+
+All subscriptions of a `HomeAutoSystem` share one polling engine. On each
+tick, the engine sends a single `getdevicelistinfos` request, which covers
+the switch state, presence and power readings of all devices at once, and
+delivers values to subscribers only when they changed."""
+
+import threading
+from .watcher import DeviceListWatcher
+
+
+# subscribable fields: name -> (field path in device list, conversion)
+FIELDS = {
+    'state': ('switch/state', lambda val: bool(int(val))),
+    'present': ('present', lambda val: bool(int(val))),
+    'power': ('powermeter/power', lambda val: int(val) / 1000),         # mW -> W
+    'energy': ('powermeter/energy', lambda val: int(val)),              # Wh
+    'voltage': ('powermeter/voltage', lambda val: int(val) / 1000),     # mV -> V
+    'temperature': ('temperature/celsius', lambda val: int(val) / 10),  # 0.1 °C -> °C
+}
+
+
+def extract_fields(flat_device:dict[str,str], fields:tuple[str])->dict:
+    """Extracts the given fields from a flattened device (see
+    `watcher.flatten_device`) and converts them to Python values."""
+    values = {}
+    for field in fields:
+        path, convert = FIELDS[field]
+        raw = flat_device.get(path)
+        try:
+            values[field] = convert(raw)
+        except (TypeError, ValueError):
+            values[field] = None
+    return values
+
+
+class Subscription():
+    """A subscription to some fields of one device (or all devices if
+    `ain` is None). The callback is called as `callback(ain, values)`."""
+
+    def __init__(self, ain:str|None, fields:tuple[str], callback):
+        unknown = set(fields) - FIELDS.keys()
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        self.ain = ain.replace(" ", "") if ain else None
+        self.fields = tuple(fields)
+        self.callback = callback
+        # last delivered values by AIN
+        self.last_values:dict[str,dict] = {}
+
+    def __repr__(self):
+        return f"Subscription(ain={self.ain!r}, fields={self.fields!r})"
+
+
+class PollingEngine():
+    """Runs one polling loop serving all subscriptions.
+
+    ARGUMENTS:
+    - session : object providing a valid SID as attribute `sid`
+    - interval : time between polls in seconds (default: 10, the power grid)
+    - watcher : `DeviceListWatcher` to use (optional)
+    """
+
+    def __init__(self, session, interval:float=10, watcher:DeviceListWatcher=None):
+        self.interval = interval
+        self.watcher = watcher if watcher else DeviceListWatcher(session)
+        self.subscriptions:list[Subscription] = []
+        self.last_error:Exception = None
+        self._new_subscriptions = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread:threading.Thread = None
+
+    def add(self, subscription:Subscription)->Subscription:
+        """Adds a subscription and starts polling if needed."""
+        with self._lock:
+            self.subscriptions.append(subscription)
+            self._new_subscriptions = True
+            self._start()
+        return subscription
+
+    def remove(self, subscription:Subscription)->None:
+        """Removes a subscription and stops polling if none are left."""
+        # NOTE: decided and signalled under the lock, so a concurrent `add`
+        # either keeps the thread running or starts a new one
+        with self._lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+            if not self.subscriptions:
+                self._stop.set()
+
+    def start(self)->None:
+        """Starts the polling thread unless it is running already."""
+        with self._lock:
+            self._start()
+
+    def _start(self)->None:
+        # NOTE: the caller holds the lock
+        if self._thread and not self._stop.is_set():
+            return
+        # every polling thread gets its own stop event
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            name="sb4dfritz polling engine",
+            target=self._run,
+            args=(self._stop,),
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self)->None:
+        """Stops the polling thread after the current tick."""
+        with self._lock:
+            self._stop.set()
+
+    def _run(self, stop:threading.Event):
+        while not stop.is_set():
+            try:
+                self.tick()
+            except Exception as ex:
+                self.last_error = ex
+            stop.wait(self.interval)
+
+    def tick(self)->None:
+        """Polls the device list once and notifies subscribers of changed
+        values. A failing callback is recorded as `last_error` and does not
+        keep the other subscribers from being notified."""
+        events = self.watcher.poll()
+        with self._lock:
+            if not events and not self._new_subscriptions:
+                return
+            self._new_subscriptions = False
+            subscriptions = list(self.subscriptions)
+        snapshot = self.watcher.snapshot
+        for subscription in subscriptions:
+            if subscription.ain is None:
+                ains = snapshot.keys()
+            elif subscription.ain in snapshot:
+                ains = [subscription.ain]
+            else:
+                continue
+            for ain in ains:
+                values = extract_fields(snapshot[ain][1], subscription.fields)
+                if values != subscription.last_values.get(ain):
+                    subscription.last_values[ain] = values
+                    try:
+                        subscription.callback(ain, values)
+                    except Exception as ex:
+                        self.last_error = ex
+
@@ -0,0 +1,268 @@
+"""Runs the idle detection of `HomeAutoDevice.switch_off_when_idle` offline
+for many combinations of its parameters.
+
+Each trial runs on a `VirtualClock` against either a simulated smart plug
+(identified by its seed) or a device from a recorded trace, so a trial
+takes milliseconds instead of minutes. Trials are distributed over all
+cores with a process pool. For each parameter combination, the results
+table reports
+
+- the time until switch-off (from the start of monitoring),
+- the share of false switch-offs, i.e. switch-offs followed by power
+  values above `power_threshold` within `lookahead` seconds (the
+  appliance was only pausing in the middle of a burst),
+- the number of requests sent to the device.
+
+Example (from the command line):
+
+    python -m sb4dfritzlib.homeauto.sweep -seeds 1000 -power 2 5 10 -cycles 2 3 6
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from .simulations import SmartPlugSimulator
+from .traces import TraceReplay, ReplayDevice, TraceEnded
+from ..utilities.clock import VirtualClock
+
+
+# default values of the swept parameters
+DEFAULT_GRID = {
+    'power_threshold': [5],
+    'network_threshold': [0.95],
+    'idle_cycles': [2],
+}
+# columns of the results table
+COLUMNS = [
+    'power_threshold', 'network_threshold', 'idle_cycles', 'trials',
+    'switched_off', 'mean_time', 'median_time', 'p95_time',
+    'false_switch_offs', 'false_rate', 'mean_requests',
+]
+
+
+class _TrialTimeout(Exception):
+    """Raised inside a trial when its maximum duration has passed."""
+
+
+def parameter_grid(**values)->list[dict]:
+    """Returns all combinations of the given parameter values, e.g.
+    `parameter_grid(power_threshold=[2, 5], idle_cycles=[2, 3])`. Missing
+    parameters take their values from `DEFAULT_GRID`."""
+    grid = {**DEFAULT_GRID, **{key:list(val) for key, val in values.items()}}
+    keys = list(grid)
+    return [dict(zip(keys, combo)) for combo in itertools.product(*grid.values())]
+
+
+def simulator_sources(seeds)->list[tuple]:
+    """Returns trial sources for simulated plugs. `seeds` is either a
+    number of seeds (0, 1, 2, ...) or an iterable of seeds."""
+    seeds = range(seeds) if isinstance(seeds, int) else seeds
+    return [("simulator", seed) for seed in seeds]
+
+
+def trace_sources(paths:list[str])->list[tuple]:
+    """Returns one trial source per recorded device in the given traces."""
+    sources = []
+    for path in paths:
+        with TraceReplay(path, speed=None) as replay:
+            sources += [("trace", path, ain) for ain in replay.ains]
+    return sources
+
+
+def _open_device(source:tuple):
+    """Creates the device of a trial source and returns it together with
+    the object whose requests are counted and the name of its method."""
+    if source[0] == "simulator":
+        device = SmartPlugSimulator(clock=VirtualClock(), seed=source[1])
+        # NOTE: the simulated plug answers via its sensor
+        return device, device.sensor, "send_basic_device_stats"
+    if source[0] == "trace":
+        _, path, ain = source
+        device = ReplayDevice(TraceReplay(path, speed=None), ain)
+        return device, device, "_fetch_raw_basic_device_stats"
+    raise ValueError(f"unknown trial source: {source!r}")
+
+
+def run_trial(params:dict, source:tuple, max_duration:float=3600, lookahead:float=120)->dict:
+    """Runs `switch_off_when_idle` once and returns its outcome.
+
+    ARGUMENTS:
+    - params : keyword arguments for `switch_off_when_idle`
+    - source : trial source (see `simulator_sources`, `trace_sources`)
+    - max_duration : trial is aborted after this many (virtual) seconds
+    - lookahead : period after switch-off checked for false switch-offs
+    """
+    device, target, method = _open_device(source)
+    clock = device.clock
+    start = clock.now()
+    deadline = start + timedelta(seconds=max_duration)
+    # count requests
+    requests = 0
+    send = getattr(target, method)
+    def counting_send(*args, **kwargs):
+        nonlocal requests
+        requests += 1
+        return send(*args, **kwargs)
+    setattr(target, method, counting_send)
+    # abort the monitoring loop after `max_duration`
+    get_record = device.get_latest_power_record
+    def get_record_until_deadline():
+        if clock.now() > deadline:
+            raise _TrialTimeout()
+        return get_record()
+    device.get_latest_power_record = get_record_until_deadline
+    try:
+        device.switch_off_when_idle(debug_mode=True, **params)
+        switch_off_time = clock.now()
+    except (_TrialTimeout, TraceEnded):
+        # deadline or end of the recording reached
+        switch_off_time = None
+    result = {
+        **params,
+        'source': source,
+        'switched_off': switch_off_time is not None,
+        'time': (switch_off_time - start).total_seconds() if switch_off_time else None,
+        'requests': requests,
+        'false_switch_off': False,
+    }
+    # check whether the appliance would have consumed power afterwards
+    if switch_off_time is not None:
+        if isinstance(device, ReplayDevice):
+            # NOTE: the recording cannot be looked at past its end
+            lookahead = min(lookahead, device.replay.end_time - clock.time())
+        clock.sleep(max(lookahead, 0))
+        power_stats = device.get_basic_device_stats(use_cache=False)['power']
+        grid = timedelta(seconds=power_stats['grid'])
+        for idx, value in enumerate(power_stats['data']):
+            if power_stats['datatime'] - idx * grid <= switch_off_time:
+                break
+            if value / 100 >= params.get('power_threshold', 5):
+                result['false_switch_off'] = True
+                break
+    if isinstance(device, ReplayDevice):
+        device.replay.close()
+    return result
+
+
+def _run_trials(tasks:list[tuple])->list[dict]:
+    # NOTE: module level function, so it can be sent to worker processes
+    return [run_trial(*task) for task in tasks]
+
+
+def summarize(results:list[dict])->list[dict]:
+    """Aggregates trial results per parameter combination."""
+    groups:dict[tuple,list[dict]] = {}
+    for result in results:
+        key = tuple(result.get(name) for name in DEFAULT_GRID)
+        groups.setdefault(key, []).append(result)
+    rows = []
+    for key, group in groups.items():
+        times = sorted(item['time'] for item in group if item['switched_off'])
+        false_count = sum(item['false_switch_off'] for item in group)
+        rows.append({
+            **dict(zip(DEFAULT_GRID, key)),
+            'trials': len(group),
+            'switched_off': len(times),
+            'mean_time': statistics.fmean(times) if times else None,
+            'median_time': statistics.median(times) if times else None,
+            'p95_time': times[min(int(0.95 * len(times)), len(times) - 1)] if times else None,
+            'false_switch_offs': false_count,
+            'false_rate': false_count / len(times) if times else None,
+            'mean_requests': statistics.fmean(item['requests'] for item in group),
+        })
+    return rows
+
+
+def run_sweep(
+        grid:list[dict],
+        sources:list[tuple],
+        max_duration:float=3600,
+        lookahead:float=120,
+        processes:int=None,
+        chunksize:int=None,
+        )->list[dict]:
+    """Runs every parameter combination of `grid` against every trial
+    source in parallel and returns the summarized results table.
+
+    ARGUMENTS:
+    - grid : parameter combinations (see `parameter_grid`)
+    - sources : trial sources (see `simulator_sources`, `trace_sources`)
+    - max_duration : maximum (virtual) duration of a trial in seconds
+    - lookahead : period after switch-off checked for false switch-offs
+    - processes : number of worker processes (default: all cores), use 1
+      to run in the current process
+    - chunksize : number of trials per task sent to a worker (optional)
+    """
+    tasks = [
+        (params, source, max_duration, lookahead)
+        for params in grid for source in sources
+    ]
+    if not processes:
+        # NOTE: respect CPU affinity where supported (e.g. in containers)
+        affinity = getattr(os, "sched_getaffinity", None)
+        processes = len(affinity(0)) if affinity else os.cpu_count() or 1
+    if processes == 1:
+        return summarize(_run_trials(tasks))
+    # few large chunks keep the overhead of inter-process communication low
+    chunksize = chunksize if chunksize else max(1, len(tasks) // (processes * 4))
+    chunks = [tasks[idx:idx + chunksize] for idx in range(0, len(tasks), chunksize)]
+    results = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for chunk_results in executor.map(_run_trials, chunks):
+            results += chunk_results
+    return summarize(results)
+
+
+def format_table(rows:list[dict])->str:
+    """Formats the results table for console output."""
+    def fmt(value):
+        if value is None:
+            return "-"
+        if isinstance(value, float):
+            return f"{value:.2f}"
+        return str(value)
+    cells = [COLUMNS] + [[fmt(row[col]) for col in COLUMNS] for row in rows]
+    widths = [max(len(line[idx]) for line in cells) for idx in range(len(COLUMNS))]
+    lines = [" | ".join(cell.rjust(width) for cell, width in zip(line, widths)) for line in cells]
+    lines.insert(1, "-+-".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+
+def write_csv(rows:list[dict], path:str)->None:
+    """Writes the results table to a CSV file."""
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Parameter sweep for the idle detection of sb4dfritz."
+    )
+    parser.add_argument("-seeds", type=int, default=100, help="Number of simulator seeds.")
+    parser.add_argument("-traces", nargs="*", default=[], help="Recorded trace files.")
+    parser.add_argument("-power", nargs="+", type=float, default=DEFAULT_GRID['power_threshold'],
+                        help="Values of `power_threshold` (in Watts).")
+    parser.add_argument("-network", nargs="+", type=float, default=DEFAULT_GRID['network_threshold'],
+                        help="Values of `network_threshold` (in seconds).")
+    parser.add_argument("-cycles", nargs="+", type=int, default=DEFAULT_GRID['idle_cycles'],
+                        help="Values of `idle_cycles`.")
+    parser.add_argument("-duration", type=float, default=3600, help="Maximum trial duration (in seconds).")
+    parser.add_argument("-processes", type=int, default=None, help="Number of worker processes.")
+    parser.add_argument("-csv", default=None, help="Path of CSV output file.")
+    args = parser.parse_args()
+    grid = parameter_grid(
+        power_threshold=args.power,
+        network_threshold=args.network,
+        idle_cycles=args.cycles,
+    )
+    sources = simulator_sources(args.seeds) + trace_sources(args.traces)
+    rows = run_sweep(grid, sources, max_duration=args.duration, processes=args.processes)
+    print(format_table(rows))
+    if args.csv:
+        write_csv(rows, args.csv)
@@ -0,0 +1,247 @@
+"""Records raw responses of FRITZ! smart home devices into compact binary
+trace files and replays them.
+
+A trace file starts with the 8 byte magic `SB4DTRC1`, followed by records
+consisting of a fixed-size header and two variable-size fields:
+
+    timestamp (float64) | kind (uint8) | AIN length (uint16) |
+    payload length (uint32) | AIN (ASCII) | payload (zlib compressed)
+
+Replays memory-map the trace file and only keep a small index of record
+positions in RAM, so even multi-day recordings open instantly."""
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime
+from .devicemodels import HomeAutoDevice
+from .cache import StatsCache
+from ..utilities.clock import SYSTEM_CLOCK, ScaledClock, VirtualClock
+from ..utilities.bitmask import FRITZ_DECT_200
+
+
+MAGIC = b"SB4DTRC1"
+RECORD_HEADER = struct.Struct("<dBHI")
+# kinds of recorded responses
+KIND_BASIC_DEVICE_STATS = 1
+KIND_DEVICE_LIST = 2
+
+
+class TraceEnded(Exception):
+    """The clock of a `TraceReplay` has passed the last record."""
+
+
+class TraceRecorder():
+    """Appends raw responses with receive timestamps to a trace file.
+
+    To record a device, set its `trace_recorder` attribute (or the one of
+    `HomeAutoDevice` to record all devices). To record device lists, wrap
+    the fetch function of a `DeviceListWatcher`:
+
+        watcher.fetch_raw = recorder.wrap_device_list(watcher.fetch_raw)
+
+    ARGUMENTS:
+    - path : path of the trace file (appended to if it exists)
+    - clock : clock providing the receive timestamps (optional)
+    - compression : zlib compression level (default: 6)
+    """
+
+    def __init__(self, path:str, clock=SYSTEM_CLOCK, compression:int=6):
+        self.path = path
+        self.clock = clock
+        self.compression = compression
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "ab")
+        if is_new:
+            self._file.write(MAGIC)
+        self.records = 0
+
+    def record(self, kind:int, ain:str, payload:bytes, timestamp:float=None)->None:
+        """Appends one record to the trace file."""
+        timestamp = self.clock.time() if timestamp is None else timestamp
+        ain_bytes = ain.encode("ascii")
+        payload = zlib.compress(payload, self.compression)
+        header = RECORD_HEADER.pack(timestamp, kind, len(ain_bytes), len(payload))
+        with self._lock:
+            self._file.write(header + ain_bytes + payload)
+            self.records += 1
+
+    def record_basic_device_stats(self, ain:str, payload:bytes)->None:
+        """Records a raw `getbasicdevicestats` response."""
+        self.record(KIND_BASIC_DEVICE_STATS, ain, payload)
+
+    def record_device_list(self, payload:bytes)->None:
+        """Records a raw `getdevicelistinfos` response."""
+        self.record(KIND_DEVICE_LIST, "", payload)
+
+    def wrap_device_list(self, fetch_raw):
+        """Returns a version of `fetch_raw` that records each response."""
+        def fetch_and_record(sid:str)->bytes:
+            payload = fetch_raw(sid)
+            self.record_device_list(payload)
+            return payload
+        return fetch_and_record
+
+    def flush(self)->None:
+        with self._lock:
+            self._file.flush()
+
+    def close(self)->None:
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TraceReplay():
+    """Serves recorded responses according to the time of its clock.
+
+    ARGUMENTS:
+    - path : path of the trace file
+    - speed : replay speed relative to real time (default: 1), or None to
+      replay on a `VirtualClock` that only advances while sleeping
+    """
+
+    def __init__(self, path:str, speed:float|None=1.0):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a trace file")
+        # index: (kind, AIN) -> (timestamps, offsets of payloads, payload lengths)
+        self._index:dict[tuple[int,str],tuple[list,list,list]] = {}
+        self.start_time, self.end_time = self._build_index()
+        start = datetime.fromtimestamp(self.start_time)
+        self.clock = VirtualClock(start) if speed is None else ScaledClock(start, speed)
+        # separate cache, so replayed and live statistics are never mixed
+        self.stats_cache = StatsCache()
+
+    def _build_index(self)->tuple[float,float]:
+        data = self._map
+        position = len(MAGIC)
+        size = len(data)
+        first, last = None, None
+        while position + RECORD_HEADER.size <= size:
+            timestamp, kind, ain_length, payload_length = \
+                RECORD_HEADER.unpack_from(data, position)
+            position += RECORD_HEADER.size
+            # NOTE: AINs are looked up without spaces
+            ain = data[position:position + ain_length].decode("ascii").replace(" ", "")
+            position += ain_length
+            if position + payload_length > size:
+                # NOTE: ignore truncated last record (e.g. recorder killed)
+                break
+            times, offsets, lengths = self._index.setdefault((kind, ain), ([], [], []))
+            times.append(timestamp)
+            offsets.append(position)
+            lengths.append(payload_length)
+            position += payload_length
+            first = timestamp if first is None else min(first, timestamp)
+            last = timestamp if last is None else max(last, timestamp)
+        if first is None:
+            raise ValueError(f"{self.path} contains no records")
+        return first, last
+
+    @property
+    def ains(self)->list[str]:
+        """AINs of all devices with recorded statistics."""
+        return sorted(ain for kind, ain in self._index if kind == KIND_BASIC_DEVICE_STATS)
+
+    @property
+    def finished(self)->bool:
+        """True if the clock has passed the last record."""
+        return self.clock.time() > self.end_time
+
+    def payload(self, kind:int, ain:str="", timestamp:float=None)->bytes:
+        """Returns the latest payload of given kind and AIN recorded at or
+        before `timestamp` (default: current time of the clock). Raises
+        `KeyError` if nothing of this kind was recorded for the AIN and
+        `TraceEnded` past the last record of the trace."""
+        entry = self._index.get((kind, ain.replace(" ", "")))
+        if entry is None:
+            raise KeyError(f"{self.path} has no records of kind {kind} for AIN '{ain}'")
+        times, offsets, lengths = entry
+        timestamp = self.clock.time() if timestamp is None else timestamp
+        if timestamp > self.end_time:
+            raise TraceEnded(f"{self.path} ended {timestamp - self.end_time:.1f} s ago")
+        idx = bisect.bisect_right(times, timestamp) - 1
+        # before the first record, serve the first one
+        idx = max(idx, 0)
+        offset = offsets[idx]
+        return zlib.decompress(self._map[offset:offset + lengths[idx]])
+
+    def getbasicdevicestats_raw(self, ain:str, sid:str=None)->bytes:
+        """Replays a raw `getbasicdevicestats` response (see `payload`)."""
+        return self.payload(KIND_BASIC_DEVICE_STATS, ain)
+
+    def getdevicelistinfos_raw(self, sid:str=None)->bytes:
+        """Replays a raw `getdevicelistinfos` response (see `payload`).
+        Can be used as `fetch_raw` of a `DeviceListWatcher`."""
+        return self.payload(KIND_DEVICE_LIST)
+
+    def get_devices(self)->list["ReplayDevice"]:
+        """Returns one replayed device per recorded AIN."""
+        return [ReplayDevice(self, ain) for ain in self.ains]
+
+    def close(self)->None:
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ReplayDevice(HomeAutoDevice):
+    """A device whose statistics are served from a `TraceReplay`. Its
+    clock is the clock of the replay, so timing follows the recording."""
+
+    # simulated duration of a request in seconds
+    request_duration:float = 0.01
+
+    def __init__(self, replay:TraceReplay, ain:str, name:str=None):
+        self.replay = replay
+        self.clock = replay.clock
+        self.stats_cache = replay.stats_cache
+        self.sid = None
+        self.ain = ain
+        self.name = name if name else f"Replay {ain}"
+        self.model = "Trace Replay"
+        self.device_id = None
+        self.present = True
+        self.capabilities = FRITZ_DECT_200
+        self.is_switchable = True
+        self.switch_mode = "manuell"
+        self._switch_state = True
+
+    def get_switch_state(self)->bool:
+        """Get current switch state (on=True ,off=False)."""
+        return self._switch_state
+
+    def set_switch(self, state:bool)->bool:
+        """Set switch state (on=True ,off=False)."""
+        self._switch_state = bool(state)
+        return self._switch_state
+
+    def toggle_switch(self)->bool:
+        """Toggle switch state."""
+        return self.set_switch(not self._switch_state)
+
+    def _fetch_raw_basic_device_stats(self)->bytes:
+        # NOTE: let some time pass as on a real network, otherwise polling
+        # loops on a virtual clock would never advance
+        self.clock.sleep(self.request_duration)
+        return self.replay.getbasicdevicestats_raw(self.ain)
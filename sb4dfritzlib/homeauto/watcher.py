@@ -0,0 +1,228 @@
+"""Watches the device list of a FRITZ!Box and emits events whenever
+devices are added, removed, switched, or change their presence or power
+consumption."""
+
+import hashlib
+from ..connection import ahahttp
+
+
+###  EVENTS  ###
+
+class DeviceEvent():
+    """Base class of all events emitted by `DeviceListWatcher`."""
+
+    def __init__(self, ain:str, device:dict):
+        self.ain = ain
+        self.device = device
+
+    def __repr__(self):
+        return f"{type(self).__name__}(ain={self.ain!r})"
+
+
+class DeviceAdded(DeviceEvent):
+    """A device appeared in the device list."""
+
+
+class DeviceRemoved(DeviceEvent):
+    """A device disappeared from the device list."""
+
+
+class DeviceChanged(DeviceEvent):
+    """At least one field of a device changed. The attribute `changes` maps
+    field paths (e.g. 'switch/state') to `(old, new)` tuples."""
+
+    def __init__(self, ain:str, device:dict, changes:dict[str,tuple]):
+        super().__init__(ain, device)
+        self.changes = changes
+
+    def __repr__(self):
+        return f"{type(self).__name__}(ain={self.ain!r}, changes={self.changes!r})"
+
+
+class StateChanged(DeviceEvent):
+    """The switch state of a device changed (on=True, off=False)."""
+
+    def __init__(self, ain:str, device:dict, old:bool, new:bool):
+        super().__init__(ain, device)
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return f"{type(self).__name__}(ain={self.ain!r}, old={self.old}, new={self.new})"
+
+
+class PresenceChanged(DeviceEvent):
+    """The presence of a device changed (connected=True, absent=False)."""
+
+    def __init__(self, ain:str, device:dict, old:bool, new:bool):
+        super().__init__(ain, device)
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return f"{type(self).__name__}(ain={self.ain!r}, old={self.old}, new={self.new})"
+
+
+class PowerThresholdCrossed(DeviceEvent):
+    """The power consumption of a device crossed the power threshold of
+    the watcher. Power values are given in Watts."""
+
+    def __init__(self, ain:str, device:dict, old:float, new:float, threshold:float):
+        super().__init__(ain, device)
+        self.old = old
+        self.new = new
+        self.threshold = threshold
+        self.rising = new >= threshold
+
+    def __repr__(self):
+        return f"{type(self).__name__}(ain={self.ain!r}, old={self.old}, new={self.new})"
+
+
+###  SNAPSHOTS AND DIFFS  ###
+
+def flatten_device(device:dict, prefix:str="")->dict[str,str]:
+    """Flattens a nested device dictionary into a dictionary mapping
+    field paths like 'powermeter/power' to leaf values."""
+    flat = {}
+    for key, value in device.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten_device(value, prefix=path + "/"))
+        elif isinstance(value, list):
+            for idx, item in enumerate(value):
+                item_path = f"{path}/{idx}"
+                if isinstance(item, dict):
+                    flat.update(flatten_device(item, prefix=item_path + "/"))
+                else:
+                    flat[item_path] = item
+        else:
+            flat[path] = value
+    return flat
+
+
+def diff_devices(old:dict[str,str], new:dict[str,str])->dict[str,tuple]:
+    """Computes the field-level difference of two flattened devices as a
+    dictionary mapping field paths to `(old, new)` tuples."""
+    changes = {}
+    for path in old.keys() | new.keys():
+        old_value = old.get(path)
+        new_value = new.get(path)
+        if old_value != new_value:
+            changes[path] = (old_value, new_value)
+    return changes
+
+
+def _to_bool(value)->bool|None:
+    """Converts '0'/'1' strings as used by AHA-HTTP to booleans."""
+    try:
+        return bool(int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_watts(value)->float|None:
+    """Converts power values in mW as used by AHA-HTTP to Watts."""
+    try:
+        return int(value) / 1000
+    except (TypeError, ValueError):
+        return None
+
+
+###  WATCHER  ###
+
+class DeviceListWatcher():
+    """Polls `getdevicelistinfos` and emits typed events on changes.
+
+    The raw response is hashed first, so unchanged device lists are never
+    parsed. Changed device lists are compared field by field with the
+    previous snapshot.
+
+    ARGUMENTS:
+    - session : object providing a valid SID as attribute `sid`,
+      usually a `FritzBoxSession`
+    - power_threshold : power threshold in Watts for `PowerThresholdCrossed`
+    - fetch_raw : function mapping a SID to the raw device list (optional,
+      default: `ahahttp.getdevicelistinfos_raw` for the box at the address
+      `session.ip`)
+    """
+
+    def __init__(self, session, power_threshold:float=5, fetch_raw=None):
+        self.session = session
+        self.power_threshold = power_threshold
+        self.fetch_raw = fetch_raw if fetch_raw else \
+            lambda sid: ahahttp.getdevicelistinfos_raw(sid, getattr(session, 'ip', None))
+        # most recent snapshot: AIN -> (device, flattened device)
+        self.snapshot:dict[str,tuple[dict,dict]] = {}
+        self._digest = None
+        self._callbacks = []
+        # counters
+        self.polls = 0
+        self.parses = 0
+
+    def subscribe(self, callback)->None:
+        """Registers a function that is called with each emitted event."""
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback)->None:
+        """Removes a previously registered callback."""
+        self._callbacks.remove(callback)
+
+    def poll(self)->list[DeviceEvent]:
+        """Fetches the device list once and returns the resulting events.
+        Callbacks are run on each event as well."""
+        self.polls += 1
+        raw = self.fetch_raw(self.session.sid)
+        return self.process(raw)
+
+    def process(self, raw:bytes)->list[DeviceEvent]:
+        """Processes a raw `getdevicelistinfos` response and returns the
+        resulting events."""
+        # skip parsing entirely if nothing changed
+        digest = hashlib.blake2b(raw, digest_size=16).digest()
+        if digest == self._digest:
+            return []
+        self._digest = digest
+        self.parses += 1
+        # build new snapshot
+        devices = ahahttp.parse_devicelistinfos(raw)
+        snapshot = {}
+        for device in devices:
+            ain = device['identifier'].replace(" ", "")
+            snapshot[ain] = (device, flatten_device(device))
+        # compare with previous snapshot
+        events = self._compare(self.snapshot, snapshot)
+        self.snapshot = snapshot
+        for event in events:
+            for callback in list(self._callbacks):
+                callback(event)
+        return events
+
+    def _compare(self, old_snapshot:dict, new_snapshot:dict)->list[DeviceEvent]:
+        events = []
+        for ain in old_snapshot.keys() - new_snapshot.keys():
+            events.append(DeviceRemoved(ain, old_snapshot[ain][0]))
+        for ain, (device, flat) in new_snapshot.items():
+            if ain not in old_snapshot:
+                events.append(DeviceAdded(ain, device))
+                continue
+            changes = diff_devices(old_snapshot[ain][1], flat)
+            if changes:
+                events.append(DeviceChanged(ain, device, changes))
+                events.extend(self._typed_events(ain, device, changes))
+        return events
+
+    def _typed_events(self, ain:str, device:dict, changes:dict)->list[DeviceEvent]:
+        events = []
+        if 'switch/state' in changes:
+            old, new = (_to_bool(val) for val in changes['switch/state'])
+            events.append(StateChanged(ain, device, old, new))
+        if 'present' in changes:
+            old, new = (_to_bool(val) for val in changes['present'])
+            events.append(PresenceChanged(ain, device, old, new))
+        if 'powermeter/power' in changes:
+            old, new = (_to_watts(val) for val in changes['powermeter/power'])
+            threshold = self.power_threshold
+            if old is not None and new is not None \
+                    and (old >= threshold) != (new >= threshold):
+                events.append(PowerThresholdCrossed(ain, device, old, new, threshold))
+        return events
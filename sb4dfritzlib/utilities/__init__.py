@@ -5,3 +5,17 @@ from . import bitmask
 from . import stats
 from .stats import is_stats_dict, prepare_stats_dict
 from . import xml
+
+from . import clock
+from .clock import SystemClock, ScaledClock, VirtualClock, SYSTEM_CLOCK
+
+from . import timers
+from .timers import TimerService
+
+from . import powerlog
+from .powerlog import PowerLogWriter
+
+from . import metrics
+from . import quantiles
+from .quantiles import P2Quantile, LATENCIES
+from . import tracing
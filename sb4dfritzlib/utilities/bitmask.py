@@ -25,6 +25,35 @@ are encoded in a bit mask. According to the AHA-HTTP documentation (German):
     Beispiel FD300: binär 101000000(320), Bit6(HKR) und Bit8(Temperatursensor) sind gesetzt
 """
 
+from enum import IntFlag
+
+
+class Capability(IntFlag):
+    """Function classes of a smart home device as flags, so capabilities
+    can be combined and tested without decoding the bit mask, e.g.
+    `Capability.SWITCHABLE in Capability(35712)`."""
+    NONE = 0
+    HANFUN_DEVICE = 1 << 0
+    LIGHT = 1 << 2
+    ALARM_SENSOR = 1 << 4
+    BUTTON = 1 << 5
+    RADIATOR_CONTROL = 1 << 6
+    ENERGY = 1 << 7
+    TEMPERATURE = 1 << 8
+    OUTLET = 1 << 9
+    REPEATER = 1 << 10
+    MICROPHONE = 1 << 11
+    HANFUN_UNIT = 1 << 13
+    SWITCHABLE = 1 << 15
+    LEVEL = 1 << 16
+    COLOR = 1 << 17
+    BLIND = 1 << 18
+    HUMIDITY = 1 << 20
+
+
+# capabilities of a FRITZ!DECT 200 smart plug (functionbitmask 35712)
+FRITZ_DECT_200 = Capability(35712)
+
 BIT_MASK_DECODER = {
     0: "HAN-FUN device",
     2: "light/lamp",
@@ -49,7 +78,10 @@ def decode(num:int)->list[bool]:
     # binary expansion of `num` as an integer
     return [bool((num >> k) & 1) for k in range(24)]
 
+def capabilities(num:int|str)->Capability:
+    """Returns the capabilities encoded in a function bit mask."""
+    return Capability(int(num))
+
 def features(num:int)->list[str]:
-    bitmask = decode(num)
-    decoded = [BIT_MASK_DECODER[k] for k in BIT_MASK_DECODER if bitmask[k]]
+    decoded = [BIT_MASK_DECODER[k] for k in BIT_MASK_DECODER if (num >> k) & 1]
     return decoded
@@ -0,0 +1,112 @@
+"""Provides clocks for timing code.
+
+`SystemClock` uses real time and `ScaledClock` a sped up version of it.
+`VirtualClock` only advances when asked to, so simulations spanning hours
+run instantly and reproducibly."""
+
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime
+from .timers import TimerHandle, SHARED_TIMER_SERVICE
+
+
+class SystemClock():
+    """Clock based on the system time."""
+
+    def now(self)->datetime:
+        """Returns the current local time."""
+        return datetime.now()
+
+    def time(self)->float:
+        """Returns the current time as unix timestamp."""
+        return time.time()
+
+    def sleep(self, seconds:float)->None:
+        """Blocks for the given number of seconds."""
+        time.sleep(seconds)
+
+    def call_later(self, delay:float, callback, *args)->TimerHandle:
+        """Runs `callback(*args)` after `delay` seconds on the thread of the
+        shared timer service. Returns a handle with a `cancel` method."""
+        return SHARED_TIMER_SERVICE.call_later(delay, callback, *args)
+
+
+class ScaledClock(SystemClock):
+    """Clock that starts at a given time and runs `speed` times as fast as
+    real time. Sleeping and timers are shortened accordingly.
+
+    ARGUMENTS:
+    - start : initial time
+    - speed : speed relative to real time (default: 1)
+    """
+
+    def __init__(self, start:datetime, speed:float=1.0):
+        self.speed = speed
+        self._start = start.timestamp()
+        self._origin = time.monotonic()
+
+    def now(self)->datetime:
+        return datetime.fromtimestamp(self.time())
+
+    def time(self)->float:
+        return self._start + (time.monotonic() - self._origin) * self.speed
+
+    def sleep(self, seconds:float)->None:
+        time.sleep(seconds / self.speed)
+
+    def call_later(self, delay:float, callback, *args):
+        return super().call_later(delay / self.speed, callback, *args)
+
+
+class VirtualClock():
+    """Clock that only advances through `sleep` and `advance`. Callbacks
+    scheduled with `call_later` run synchronously once their time has come.
+
+    ARGUMENTS:
+    - start : initial time (optional, default: 2025-01-01 00:00:00)
+    """
+
+    def __init__(self, start:datetime=None):
+        start = start if start else datetime(2025, 1, 1)
+        self._time = start.timestamp()
+        self._timers:list[tuple[float,int,TimerHandle]] = []
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+
+    def now(self)->datetime:
+        """Returns the current virtual time."""
+        return datetime.fromtimestamp(self._time)
+
+    def time(self)->float:
+        """Returns the current virtual time as unix timestamp."""
+        return self._time
+
+    def sleep(self, seconds:float)->None:
+        """Advances the clock instead of blocking."""
+        self.advance(seconds)
+
+    def advance(self, seconds:float)->None:
+        """Advances the clock, running all callbacks that become due on
+        the way in chronological order."""
+        with self._lock:
+            target = self._time + max(seconds, 0)
+            while self._timers and self._timers[0][0] <= target:
+                when, _, handle = heapq.heappop(self._timers)
+                self._time = max(self._time, when)
+                if not handle.cancelled:
+                    handle.callback(*handle.args)
+            self._time = target
+
+    def call_later(self, delay:float, callback, *args)->TimerHandle:
+        """Schedules `callback(*args)` to run once the clock has advanced
+        by `delay` seconds. Returns a handle with a `cancel` method."""
+        with self._lock:
+            handle = TimerHandle(self._time + delay, callback, args)
+            heapq.heappush(self._timers, (handle.when, next(self._counter), handle))
+            return handle
+
+
+# default clock used throughout the library
+SYSTEM_CLOCK = SystemClock()
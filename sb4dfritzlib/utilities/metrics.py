@@ -0,0 +1,226 @@
+"""Collects counters and histograms of requests to the FRITZ!Box and
+exports them in the Prometheus text format.
+
+Metrics are disabled by default. While disabled, instrumented code only
+checks the module attribute `ENABLED`, so the cost is negligible. Enable
+metrics with `enable()` and optionally serve them via HTTP:
+
+    from sb4dfritzlib.utilities import metrics
+    metrics.enable()
+    metrics.start_http_server(9464)     # http://127.0.0.1:9464/metrics
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# if False, instrumented code records nothing
+ENABLED = False
+
+# default histogram buckets for durations in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def enable()->None:
+    """Starts recording metrics."""
+    global ENABLED
+    ENABLED = True
+
+
+def disable()->None:
+    """Stops recording metrics (recorded values are kept)."""
+    global ENABLED
+    ENABLED = False
+
+
+def _format_labels(names:tuple[str], values:tuple, extra:str="")->str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value)->str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter():
+    """Monotonically increasing values by label values."""
+
+    type = "counter"
+
+    def __init__(self, name:str, help:str, labelnames:tuple[str]=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values:dict[tuple,float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels:tuple=(), amount:float=1)->None:
+        """Increases the value for the given label values (in the order of
+        `labelnames`)."""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels:tuple=())->float:
+        return self._values.get(labels, 0)
+
+    def samples(self)->list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+            for labels, value in items
+        ]
+
+
+class Histogram():
+    """Distribution of observed values in fixed buckets by label values."""
+
+    type = "histogram"
+
+    def __init__(self, name:str, help:str, labelnames:tuple[str]=(), buckets:tuple=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts (last one: +Inf), sum]
+        self._values:dict[tuple,list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, labels:tuple=())->None:
+        """Records a value for the given label values."""
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][idx] += 1
+            entry[1] += value
+
+    def count(self, labels:tuple=())->int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def samples(self)->list[str]:
+        with self._lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        lines = []
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry():
+    """Collection of metrics exported together."""
+
+    def __init__(self):
+        self.metrics:list = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name:str, help:str, labelnames:tuple[str]=())->Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name:str, help:str, labelnames:tuple[str]=(), buckets:tuple=DURATION_BUCKETS)->Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def exposition(self)->str:
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+# registry of all metrics of sb4dfritzlib
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    "sb4dfritz_requests_total",
+    "Requests sent to the FRITZ!Box.",
+    ("interface", "command", "status", "box"),
+)
+REQUEST_DURATION = REGISTRY.histogram(
+    "sb4dfritz_request_duration_seconds",
+    "Duration of requests to the FRITZ!Box.",
+    ("interface", "command", "box"),
+)
+RESPONSE_BYTES = REGISTRY.counter(
+    "sb4dfritz_response_bytes_total",
+    "Size of responses received from the FRITZ!Box.",
+    ("interface", "command", "box"),
+)
+PARSE_DURATION = REGISTRY.histogram(
+    "sb4dfritz_parse_duration_seconds",
+    "Time spent parsing responses.",
+    ("command",),
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1),
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "sb4dfritz_stats_cache_lookups_total",
+    "Lookups in the cache for device statistics.",
+    ("result",),
+)
+LOGINS = REGISTRY.counter(
+    "sb4dfritz_logins_total",
+    "Logins to obtain a new SID.",
+    ("box", "result"),
+)
+RELOGINS = REGISTRY.counter(
+    "sb4dfritz_relogins_total",
+    "Logins because the SID of a session had expired.",
+    ("box",),
+)
+
+
+def observe_request(interface:str, command:str, box:str, status, seconds:float, size:int=0)->None:
+    """Records one request (status is the HTTP status code or 'error')."""
+    REQUESTS.inc((interface, command, str(status), box))
+    REQUEST_DURATION.observe(seconds, (interface, command, box))
+    if size:
+        RESPONSE_BYTES.inc((interface, command, box), size)
+
+
+###  HTTP ENDPOINT  ###
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.server.registry.exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port:int=9464, host:str="127.0.0.1", registry:Registry=REGISTRY)->ThreadingHTTPServer:
+    """Serves the metrics at `http://host:port/metrics` from a daemon
+    thread. Returns the server (stop it with `shutdown()`)."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(
+        name="sb4dfritz metrics server", target=server.serve_forever, daemon=True
+    ).start()
+    return server
@@ -0,0 +1,279 @@
+"""Streams power records (see `HomeAutoDevice.get_latest_power_record`)
+to log files.
+
+Records are handed to a background thread and written in batches, so
+logging never blocks the monitoring loop. Each batch is flushed right
+away, so at most one batch is lost if the process dies. Log files are
+rotated by size and/or age, and rotated segments can be gzip compressed.
+
+Two formats are supported:
+- CSV (default) with the columns
+  `date,starttime,datatime,endtime,duration,latency,power`
+- a compact binary format (file extension `.pwr`): the 8 byte magic
+  `SB4DPWR1` followed by fixed-size little-endian records of the unix
+  timestamps of start time, datatime and end time (float64) and
+  duration, latency and power (float32), 36 bytes per record.
+"""
+
+import gzip
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+
+
+CSV_HEADER = b"date,starttime,datatime,endtime,duration,latency,power\n"
+BINARY_MAGIC = b"SB4DPWR1"
+BINARY_RECORD = struct.Struct("<dddfff")
+
+
+def encode_csv(records:list[dict])->bytes:
+    """Encodes power records as CSV rows."""
+    rows = []
+    for record in records:
+        start:datetime = record['starttime']
+        data:datetime = record['datatime']
+        end:datetime = record['endtime']
+        # NOTE: f-strings are much faster than `strftime`
+        rows.append(
+            f"{start.year:04d}-{start.month:02d}-{start.day:02d},"
+            f"{start.hour:02d}:{start.minute:02d}:{start.second:02d}.{start.microsecond // 10000:02d},"
+            f"{data.hour:02d}:{data.minute:02d}:{data.second:02d},"
+            f"{end.hour:02d}:{end.minute:02d}:{end.second:02d}.{end.microsecond // 10000:02d},"
+            f"{record['duration']:0.2f},{record['latency']:0.2f},{record['power']:0.2f}\n"
+        )
+    return "".join(rows).encode("ascii")
+
+
+def encode_binary(records:list[dict])->bytes:
+    """Encodes power records in the binary format."""
+    return b"".join(
+        BINARY_RECORD.pack(
+            record['starttime'].timestamp(),
+            record['datatime'].timestamp(),
+            record['endtime'].timestamp(),
+            record['duration'],
+            record['latency'],
+            record['power'],
+        )
+        for record in records
+    )
+
+
+def read_binary(path:str)->list[dict]:
+    """Reads a binary power log (gzip compressed if the name ends with
+    `.gz`) and returns its power records."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as file:
+        data = file.read()
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError(f"{path} is not a binary power log")
+    records = []
+    # NOTE: ignore a truncated last record (e.g. process killed)
+    end = len(data) - (len(data) - len(BINARY_MAGIC)) % BINARY_RECORD.size
+    for start, datatime, endtime, duration, latency, power in \
+            BINARY_RECORD.iter_unpack(data[len(BINARY_MAGIC):end]):
+        records.append({
+            'power': power,
+            'datatime': datetime.fromtimestamp(datatime),
+            'starttime': datetime.fromtimestamp(start),
+            'endtime': datetime.fromtimestamp(endtime),
+            'duration': duration,
+            'latency': latency,
+        })
+    return records
+
+
+# available formats: name -> (file header, encoder)
+FORMATS = {
+    'csv': (CSV_HEADER, encode_csv),
+    'binary': (BINARY_MAGIC, encode_binary),
+}
+
+
+class PowerLogWriter():
+    """Appends power records to a log file from a background thread.
+
+    ARGUMENTS:
+    - path : path of the log file
+    - format : 'csv' or 'binary' (default: 'binary' for `.pwr` files,
+      'csv' otherwise)
+    - max_bytes : rotate once the file exceeds this size (optional)
+    - max_age : rotate once the file is older than this many seconds
+      (optional)
+    - compress : if True, rotated segments are gzip compressed
+    - batch_size : maximum number of records written at once
+    - flush_interval : maximum time in seconds a record waits to be written
+    - queue_size : maximum number of pending records; further records are
+      dropped (and counted in `dropped`) instead of blocking
+    - on_error : function called as `on_error(exception)` if a batch
+      cannot be written (default: print the traceback to stderr)
+    """
+
+    def __init__(
+            self,
+            path:str,
+            format:str=None,
+            max_bytes:int=None,
+            max_age:float=None,
+            compress:bool=False,
+            batch_size:int=256,
+            flush_interval:float=1.0,
+            queue_size:int=10000,
+            on_error=None,
+            ):
+        self.path = path
+        self.format = format if format else ('binary' if path.endswith(".pwr") else 'csv')
+        self.header, self.encode = FORMATS[self.format]
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._opened = None
+        self._size = 0
+        # counters
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        # batches that could not be written
+        self.errors = 0
+        self.last_error:Exception = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._open()
+        self._thread = threading.Thread(
+            name="sb4dfritz power log writer", target=self._run, daemon=True
+        )
+        self._thread.start()
+
+    def write(self, record:dict)->bool:
+        """Queues a power record for writing. Never blocks; returns False
+        if the record had to be dropped."""
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self)->None:
+        """Writes all pending records and closes the log file."""
+        if self._thread.is_alive():
+            # NOTE: None signals the writer thread to stop
+            self._queue.put(None)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self):
+        is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, "ab")
+        if is_new:
+            self._file.write(self.header)
+        self._size = self._file.tell()
+        self._opened = time.monotonic()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            # collect records until the batch is full or the deadline passes
+            # (counted from the first record of the batch)
+            while len(batch) < self.batch_size:
+                try:
+                    if batch:
+                        record = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    else:
+                        record = self._queue.get()
+                        deadline = time.monotonic() + self.flush_interval
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+            try:
+                if batch:
+                    self._write_batch(batch)
+            except Exception as ex:
+                self._report(ex)
+        self._file.close()
+
+    def _report(self, ex:Exception):
+        """Records a failed batch and reports it (the writer thread keeps
+        running)."""
+        self.errors += 1
+        self.last_error = ex
+        try:
+            if self.on_error:
+                self.on_error(ex)
+            else:
+                print(f"power log {self.path}: writing failed:", file=sys.stderr)
+                traceback.print_exception(ex, file=sys.stderr)
+        except Exception:
+            # NOTE: a failing error handler must not stop the writer thread
+            pass
+
+    def _write_batch(self, batch:list[dict]):
+        # NOTE: reopening may have failed after an earlier error
+        if self._file.closed:
+            self._open()
+        if self._needs_rotation():
+            try:
+                self._rotate()
+            except Exception as ex:
+                # NOTE: the batch is still written to the reopened file
+                self._report(ex)
+        data = self.encode(batch)
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        self.written += len(batch)
+
+    def _needs_rotation(self)->bool:
+        if self._size <= len(self.header):
+            return False
+        too_big = self.max_bytes is not None and self._size >= self.max_bytes
+        too_old = self.max_age is not None and time.monotonic() - self._opened >= self.max_age
+        return too_big or too_old
+
+    def _rotate(self):
+        """Renames the current log file to `<path>.<timestamp>` (gzip
+        compressed if enabled) and starts a new one. If this fails, the
+        writer goes on with the file at `path`."""
+        self._file.close()
+        try:
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            target = f"{self.path}.{stamp}"
+            suffix = 1
+            while os.path.exists(target) or os.path.exists(target + ".gz"):
+                target = f"{self.path}.{stamp}-{suffix}"
+                suffix += 1
+            os.replace(self.path, target)
+            if self.compress:
+                try:
+                    with open(target, "rb") as source, gzip.open(target + ".gz", "wb") as sink:
+                        while chunk := source.read(1 << 20):
+                            sink.write(chunk)
+                except BaseException:
+                    # NOTE: keep the uncompressed segment
+                    if os.path.exists(target + ".gz"):
+                        os.remove(target + ".gz")
+                    raise
+                os.remove(target)
+            self.rotations += 1
+        finally:
+            self._open()
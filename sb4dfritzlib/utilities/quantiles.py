@@ -0,0 +1,200 @@
+"""Streaming quantile estimation in constant memory.
+
+`P2Quantile` implements the P² algorithm (Jain & Chlamtac, 1985), which
+tracks one quantile with five markers. `WindowedQuantile` restarts its
+estimate every `window` samples, so it follows drifting distributions,
+e.g. request durations changing with the load of the box.
+`LatencyTracker` keeps windowed quantiles of request durations per box
+and command. The transport records every successful request in
+`LATENCIES`:
+
+    from sb4dfritzlib.utilities.quantiles import LATENCIES
+    LATENCIES.quantile("fritz.box", "getbasicdevicestats", 0.9)
+"""
+
+import threading
+
+
+class P2Quantile():
+    """Estimates the `p`-quantile of a stream of values."""
+
+    __slots__ = ('p', 'count', '_heights', '_positions', '_desired', '_increments')
+
+    def __init__(self, p:float):
+        if not 0 < p < 1:
+            raise ValueError("p must be between 0 and 1")
+        self.p = p
+        self.count = 0
+        # marker heights (the first five values until initialized)
+        self._heights:list[float] = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self._increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, value:float)->None:
+        self.count += 1
+        heights = self._heights
+        if self.count <= 5:
+            heights.append(value)
+            heights.sort()
+            return
+        positions = self._positions
+        # find the cell of the value, extending the extreme markers
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+        for idx in range(cell + 1, 5):
+            positions[idx] += 1
+        for idx in range(5):
+            self._desired[idx] += self._increments[idx]
+        # adjust the three middle markers
+        for idx in range(1, 4):
+            delta = self._desired[idx] - positions[idx]
+            if (delta >= 1 and positions[idx + 1] - positions[idx] > 1) or \
+                    (delta <= -1 and positions[idx - 1] - positions[idx] < -1):
+                step = 1 if delta > 0 else -1
+                height = self._parabolic(idx, step)
+                if not heights[idx - 1] < height < heights[idx + 1]:
+                    height = self._linear(idx, step)
+                heights[idx] = height
+                positions[idx] += step
+
+    def _parabolic(self, idx:int, step:int)->float:
+        q, n = self._heights, self._positions
+        return q[idx] + step / (n[idx + 1] - n[idx - 1]) * (
+            (n[idx] - n[idx - 1] + step) * (q[idx + 1] - q[idx]) / (n[idx + 1] - n[idx])
+            + (n[idx + 1] - n[idx] - step) * (q[idx] - q[idx - 1]) / (n[idx] - n[idx - 1])
+        )
+
+    def _linear(self, idx:int, step:int)->float:
+        q, n = self._heights, self._positions
+        return q[idx] + step * (q[idx + step] - q[idx]) / (n[idx + step] - n[idx])
+
+    def value(self)->float|None:
+        """Returns the current estimate (None without values)."""
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            # exact quantile of the few values seen so far
+            idx = min(int(self.p * self.count), self.count - 1)
+            return self._heights[idx]
+        return self._heights[2]
+
+
+class WindowedQuantile():
+    """Estimates the `p`-quantile of the recent values of a stream: the
+    estimate covers the last `window` to `2 * window` values."""
+
+    __slots__ = ('p', 'window', '_current', '_previous')
+
+    def __init__(self, p:float, window:int=500):
+        self.p = p
+        self.window = window
+        self._current = P2Quantile(p)
+        self._previous:P2Quantile = None
+
+    @property
+    def count(self)->int:
+        """Number of values the estimate is based on."""
+        # NOTE: the previous estimator has seen all values of the current one
+        return self._previous.count if self._previous else self._current.count
+
+    def add(self, value:float)->None:
+        # NOTE: adding to both estimators keeps the estimate smooth when
+        # the windows rotate
+        if self._previous:
+            self._previous.add(value)
+        self._current.add(value)
+        if self._current.count >= self.window:
+            self._previous = self._current
+            self._current = P2Quantile(self.p)
+
+    def value(self)->float|None:
+        if self._previous:
+            return self._previous.value()
+        return self._current.value()
+
+
+class LatencyTracker():
+    """Windowed quantiles of request durations by box and command.
+
+    ARGUMENTS:
+    - quantiles : quantiles tracked from the first request on (others are
+      tracked from their first query on)
+    - window : number of recent requests the estimates cover (see
+      `WindowedQuantile`)
+    """
+
+    def __init__(self, quantiles:tuple[float]=(0.5, 0.9, 0.99), window:int=500):
+        self.quantiles = tuple(quantiles)
+        self.window = window
+        # (box, command) -> {p: WindowedQuantile}
+        self._sketches:dict[tuple[str,str],dict[float,WindowedQuantile]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, box:str, command:str, seconds:float)->None:
+        """Records the duration of a request."""
+        key = (box, command)
+        with self._lock:
+            sketches = self._sketches.get(key)
+            if sketches is None:
+                sketches = self._sketches[key] = {
+                    p:WindowedQuantile(p, self.window) for p in self.quantiles
+                }
+            for sketch in sketches.values():
+                sketch.add(seconds)
+
+    def quantile(self, box:str, command:str, p:float, min_samples:int=20)->float|None:
+        """Returns the estimated `p`-quantile of recent durations of the
+        given command, None if there are fewer than `min_samples`."""
+        with self._lock:
+            sketches = self._sketches.get((box, command))
+            if sketches is None:
+                return None
+            sketch = sketches.get(p)
+            if sketch is None:
+                sketch = sketches[p] = WindowedQuantile(p, self.window)
+            if sketch.count < min_samples:
+                return None
+            return sketch.value()
+
+    def keys(self)->list[tuple[str,str]]:
+        """Returns the tracked `(box, command)` pairs."""
+        with self._lock:
+            return list(self._sketches)
+
+    def reset(self)->None:
+        with self._lock:
+            self._sketches.clear()
+
+
+# durations of all successful requests to FRITZ!Boxes
+LATENCIES = LatencyTracker()
+
+
+def parse_quantile(spec:str)->float:
+    """Converts a quantile given as e.g. "p90" or "p99.9" to 0.9 or 0.999."""
+    if not isinstance(spec, str) or not spec.startswith("p"):
+        raise ValueError(f"quantile must be given as e.g. 'p90', got {spec!r}")
+    p = float(spec[1:]) / 100
+    if not 0 < p < 1:
+        raise ValueError(f"quantile out of range: {spec!r}")
+    return p
+
+
+def resolve_threshold(threshold:float|str, box:str, command:str, fallback:float)->float:
+    """Returns a duration threshold in seconds. Thresholds given as
+    quantile, e.g. "p90", are estimated from the recent durations of the
+    command in `LATENCIES`; `fallback` is used until enough requests have
+    been recorded."""
+    if not isinstance(threshold, str):
+        return threshold
+    estimate = LATENCIES.quantile(box, command, parse_quantile(threshold))
+    return estimate if estimate is not None else fallback
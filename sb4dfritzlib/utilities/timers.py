@@ -0,0 +1,132 @@
+"""Provides a timer service running all scheduled callbacks on a single
+thread, so the number of threads stays constant no matter how many timers
+are scheduled or cancelled."""
+
+import heapq
+import itertools
+import sys
+import threading
+import time
+import traceback
+
+
+class TimerHandle():
+    """Handle for a callback scheduled with `call_later`."""
+
+    def __init__(self, when:float, callback, args:tuple=(), service=None):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._done = False
+        self._service = service
+
+    def cancel(self)->None:
+        """Prevents the callback from being run."""
+        if not self.cancelled and not self._done:
+            self.cancelled = True
+            if self._service:
+                self._service._cancelled()
+
+
+class TimerService():
+    """Runs callbacks at given times on one daemon thread. Pending timers
+    are kept in a heap; cancelled timers are removed lazily.
+
+    NOTE: callbacks run on the timer thread and should return quickly.
+
+    ARGUMENTS:
+    - name : name of the timer thread
+    - on_error : function called as `on_error(handle, exception)` if a
+      callback fails (default: print the traceback to stderr)
+    """
+
+    # compact the heap once it holds more cancelled timers than this
+    COMPACTION_THRESHOLD = 1024
+
+    def __init__(self, name:str="sb4dfritz timer service", on_error=None):
+        self.name = name
+        self.on_error = on_error
+        # failed callbacks
+        self.errors = 0
+        self.last_error:Exception = None
+        self._heap:list[tuple[float,int,TimerHandle]] = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._num_cancelled = 0
+        self._thread:threading.Thread = None
+
+    def __len__(self):
+        """Number of pending timers."""
+        return len(self._heap) - self._num_cancelled
+
+    def call_later(self, delay:float, callback, *args)->TimerHandle:
+        """Runs `callback(*args)` after `delay` seconds. Returns a handle
+        with a `cancel` method."""
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, when:float, callback, *args)->TimerHandle:
+        """Runs `callback(*args)` at `when` (in terms of `time.monotonic`)."""
+        handle = TimerHandle(when, callback, args, service=self)
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._counter), handle))
+            # wake up the timer thread if the new timer is the next one
+            if self._heap[0][2] is handle:
+                self._condition.notify()
+            self._ensure_thread()
+        return handle
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(name=self.name, target=self._run, daemon=True)
+            self._thread.start()
+
+    def _cancelled(self):
+        with self._condition:
+            self._num_cancelled += 1
+            if self._num_cancelled > max(self.COMPACTION_THRESHOLD, len(self._heap) // 2):
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._num_cancelled = 0
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    # drop cancelled timers at the top
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                        self._num_cancelled = max(self._num_cancelled - 1, 0)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                _, _, handle = heapq.heappop(self._heap)
+                # NOTE: mark as done, so a late `cancel` is not counted
+                handle._done = True
+            try:
+                handle.callback(*handle.args)
+            except Exception as ex:
+                self._report(handle, ex)
+
+    def _report(self, handle:TimerHandle, ex:Exception):
+        """Records a failed callback and reports it (the timer thread keeps
+        running)."""
+        self.errors += 1
+        self.last_error = ex
+        try:
+            if self.on_error:
+                self.on_error(handle, ex)
+            else:
+                print(f"{self.name}: callback {handle.callback!r} failed:", file=sys.stderr)
+                traceback.print_exception(ex, file=sys.stderr)
+        except Exception:
+            # NOTE: a failing error handler must not stop the timer thread
+            pass
+
+
+# timer service shared by all `SystemClock` instances
+SHARED_TIMER_SERVICE = TimerService()
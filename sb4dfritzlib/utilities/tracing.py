@@ -0,0 +1,293 @@
+"""Span-style tracing hooks and a sampling profiler to find out where the
+time of each poll goes.
+
+Instrumented code wraps phases in spans:
+
+    with tracing.span("http", ain=ain):
+        ...
+
+Registered hooks are called when spans start and end. Without hooks,
+`span` returns a shared no-op span, so tracing costs next to nothing when
+turned off. `ChromeTraceSink` writes all spans to a trace-event JSON file
+that can be opened in `chrome://tracing` or https://ui.perfetto.dev:
+
+    with tracing.ChromeTraceSink("trace.json", profile=True):
+        device.switch_off_when_idle()
+
+NOTE: spans measure real time, also for simulations on a `VirtualClock`.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+
+# registered hooks
+_hooks:list["SpanHook"] = []
+# open spans by thread ID (innermost last, only threads with open spans;
+# a dict instead of `threading.local`, so the profiler sees all threads)
+_open_spans:dict[int,list["Span"]] = {}
+
+
+class SpanHook():
+    """Base class of hooks. `on_start` and `on_end` are called with each
+    span on the thread running it."""
+
+    def on_start(self, span:"Span")->None:
+        pass
+
+    def on_end(self, span:"Span")->None:
+        pass
+
+
+def add_hook(hook:SpanHook)->None:
+    """Registers a hook (and thereby turns tracing on)."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook:SpanHook)->None:
+    """Removes a hook (tracing is off once no hooks are left)."""
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+class Span():
+    """A timed phase with attributes. Times are `time.perf_counter` values."""
+
+    __slots__ = ('name', 'attributes', 'start', 'end', 'thread_id', 'parent')
+
+    def __init__(self, name:str, attributes:dict):
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+        self.end = None
+        self.thread_id = None
+        self.parent:Span = None
+
+    def __repr__(self):
+        return f"Span({self.name!r}, {self.attributes!r})"
+
+    @property
+    def duration(self)->float|None:
+        """Duration in seconds (None while the span is open)."""
+        return None if self.end is None else self.end - self.start
+
+    def set(self, **attributes)->None:
+        """Adds attributes, e.g. results only known at the end."""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        stack = _open_spans.setdefault(self.thread_id, [])
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        for hook in list(_hooks):
+            hook.on_start(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        stack = _open_spans.get(self.thread_id)
+        if stack and stack[-1] is self:
+            stack.pop()
+            # NOTE: drop the entry, so short-lived threads do not leak
+            if not stack:
+                _open_spans.pop(self.thread_id, None)
+        for hook in list(_hooks):
+            hook.on_end(self)
+        return False
+
+
+class _NullSpan():
+    """Span used while tracing is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes)->None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name:str, **attributes)->Span|_NullSpan:
+    """Returns a context manager timing a phase named `name`."""
+    if not _hooks:
+        return _NULL_SPAN
+    return Span(name, attributes)
+
+
+###  PROFILER  ###
+
+class SamplingProfiler():
+    """Samples the call stacks of threads at a fixed interval from a
+    background thread. Samples are prefixed with the names of the open
+    spans, e.g. `poll;http;sessions.py:send;...`.
+
+    ARGUMENTS:
+    - interval : time between samples in seconds
+    - thread_ids : threads to sample (default: thread calling `start`)
+    - on_sample : function called as `on_sample(thread_id, stack)` for
+      each sample (optional)
+    """
+
+    def __init__(self, interval:float=0.001, thread_ids:list[int]=None, on_sample=None):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.on_sample = on_sample
+        # folded stack -> number of samples
+        self.counts:dict[str,int] = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread:threading.Thread = None
+
+    def start(self)->"SamplingProfiler":
+        if self.thread_ids is None:
+            self.thread_ids = [threading.get_ident()]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            name="sb4dfritz sampling profiler", target=self._run, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self)->None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in self.thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = self._folded_stack(thread_id, frame)
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+                self.samples += 1
+                if self.on_sample:
+                    self.on_sample(thread_id, stack)
+
+    @staticmethod
+    def _folded_stack(thread_id:int, frame)->str:
+        calls = []
+        while frame is not None:
+            code = frame.f_code
+            calls.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        spans = [item.name for item in _open_spans.get(thread_id, ())]
+        return ";".join(spans + calls[::-1])
+
+    def top(self, n:int=10)->list[tuple[str,int]]:
+        """Returns the `n` most frequent innermost frames with their
+        number of samples."""
+        totals = {}
+        for stack, count in self.counts.items():
+            frame = stack.rsplit(";", 1)[-1]
+            totals[frame] = totals.get(frame, 0) + count
+        return sorted(totals.items(), key=lambda item: -item[1])[:n]
+
+    def write_folded(self, path:str)->None:
+        """Writes the samples in the folded format of flame graph tools."""
+        with open(path, "w") as file:
+            for stack, count in sorted(self.counts.items()):
+                file.write(f"{stack} {count}\n")
+
+
+###  CHROME TRACE SINK  ###
+
+class ChromeTraceSink(SpanHook):
+    """Collects spans and writes them as Chrome trace-event JSON file.
+
+    ARGUMENTS:
+    - path : path of the trace file (written on `close`)
+    - profile : if True, a `SamplingProfiler` runs while the sink is
+      active and its samples appear as instant events in the trace
+    - interval : sampling interval of the profiler in seconds
+    - max_events : further events are dropped (and counted in `dropped`)
+    """
+
+    def __init__(self, path:str, profile:bool=False, interval:float=0.001, max_events:int=1000000):
+        self.path = path
+        self.max_events = max_events
+        self.events:list[dict] = []
+        self.dropped = 0
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self.profiler = SamplingProfiler(interval, on_sample=self._add_sample) if profile else None
+
+    def start(self)->"ChromeTraceSink":
+        """Registers the sink (and starts the profiler if enabled)."""
+        add_hook(self)
+        if self.profiler:
+            self.profiler.start()
+        return self
+
+    def close(self)->None:
+        """Unregisters the sink and writes the trace file."""
+        if self.profiler:
+            self.profiler.stop()
+        remove_hook(self)
+        self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _append(self, event:dict):
+        with self._lock:
+            if len(self.events) < self.max_events:
+                self.events.append(event)
+            else:
+                self.dropped += 1
+
+    def on_end(self, span:Span)->None:
+        self._append({
+            'name': span.name,
+            'ph': 'X',
+            'ts': (span.start - self._origin) * 1e6,
+            'dur': (span.end - span.start) * 1e6,
+            'pid': self._pid,
+            'tid': span.thread_id,
+            'args': {key:_jsonable(val) for key, val in span.attributes.items()},
+        })
+
+    def _add_sample(self, thread_id:int, stack:str):
+        self._append({
+            'name': stack.rsplit(";", 1)[-1],
+            'ph': 'i',
+            's': 't',
+            'ts': (time.perf_counter() - self._origin) * 1e6,
+            'pid': self._pid,
+            'tid': thread_id,
+            'args': {'stack': stack},
+        })
+
+    def write(self)->None:
+        with self._lock:
+            events = list(self.events)
+        with open(self.path, "w") as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+def _jsonable(value):
+    return value if isinstance(value, (str, int, float, bool, type(None))) else str(value)